@@ -44,10 +44,9 @@
 #
 
 
-import weechat, string, os, subprocess, base64, time, imp, sys
-
-# Dont create .pyc file
-sys.dont_write_bytecode = True
+import weechat, os, base64, binascii, time
+import ircrypt_core
+from ircrypt_core import MessageParts, MAX_PART_LEN, MSG_PART_TIMEOUT
 
 # Constants used in this script
 SCRIPT_NAME    = 'ircrypt-keyex'
@@ -57,101 +56,213 @@ SCRIPT_LICENSE = 'GLP3'
 SCRIPT_DESC    = 'IRCrypt-KeyEx: Addon for IRCrypt to enable key exchange via public key authentication'
 SCRIPT_HELP_TEXT = '''%(bold)sIRCrypt-KeyEx command options: %(normal)s
 list                                                    List public key fingerprints
-start              [-server <server>] <nick>            Start key exchange with nick
+start              [-server <server>] <nick> [<nick> ...] Start key exchange with nicks
+start              [-server <server>] -channel <channel> Start key exchange with all nicks in channel
 remove-public-key  [-server <server>] <nick>            Remove public key id for nick
+prune              [--older-than <days>]                Remove public keys not used for some time
 
 %(bold)sExamples: %(normal)s
 Start key exchange with a user
    /ircrypt-keyex start nick
+Start key exchange with all users in a channel
+   /ircrypt-keyex start -channel #IRCrypt
 Remove public key identifier for a user:
    /ircrypt-keyex remove-public-key nick
+Remove all public keys not used within the last 30 days:
+   /ircrypt-keyex prune --older-than 30
 
 %(bold)sConfiguration: %(normal)s
 Tip: You can list all options and what they are currently set to by executing:
    /set ircrypt-keyex.*
-%(bold)sircrypt-keyex.general.binary %(normal)s
-   This will set the GnuPG binary used for encryption and decryption. IRCrypt-keyex
-   will try to set this automatically.
+%(bold)sircrypt.general.binary %(normal)s
+   IRCrypt-KeyEx uses the GnuPG binary configured for IRCrypt.
+%(bold)sircrypt-keyex.bulk.max_concurrent %(normal)s
+   If a key exchange is started with several nicks at once, this is the maximum
+   number of key exchanges which are running at the same time.
+%(bold)sircrypt-keyex.bulk.interval %(normal)s
+   Number of seconds to wait between starting two key exchanges of a bulk key
+   exchange. This keeps IRCrypt-KeyEx from flooding the server.
+%(bold)sircrypt-keyex.general.timeout %(normal)s
+   Number of seconds without any activity after which a key exchange is
+   aborted.
+%(bold)sircrypt-keyex.general.prune_after %(normal)s
+   If set to a value greater than zero, public keys which were not used for
+   this number of days are automatically removed from the IRCrypt keyring
+   once a day. This is also the default age used by the prune command.
 ''' % {'bold':weechat.color('bold'), 'normal':weechat.color('-bold')}
 
-MAX_PART_LEN     = 300
-MSG_PART_TIMEOUT = 300 # 5min
+PRUNE_DEFAULT    = 90  # days
+INIT_TIMEOUT     = 30  # seconds
 
 
 # Global variables and memory used to store message parts, pending requests,
 # configuration options, keys, etc.
-ircrypt                  = None
+ircrypt_initialized      = False
 ircrypt_sym_key_memory   = {}
 ircrypt_config_file      = None
 ircrypt_config_section   = {}
 ircrypt_config_option    = {}
 ircrypt_asym_id          = {}
+ircrypt_asym_last_used   = {}
 ircrypt_pub_keys_memory  = {}
 ircrypt_key_ex_memory    = {}
 ircrypt_gpg_homedir      = None
 ircrypt_gpg_id           = None
+ircrypt_bulk_key_ex      = []
+ircrypt_bulk_timer       = None
+ircrypt_profiler         = None
+ircrypt_gpg_ready        = True
+ircrypt_gpg_init_output  = ['', '']
+ircrypt_pending          = []
+ircrypt_binary_hook      = None
+ircrypt_store            = None
 
 
-class MeassageParts:
-	'''Class used for storing parts of messages which were split after
-	encryption due to their length.'''
-
-	modified = 0
-	last_id  = None
-	message  = ''
-
-	def update(self, id, msg):
-		'''This method updates an already existing message part by adding a new
-		part to the old ones and updating the identifier of the latest received
-		message part.
-		'''
-		# Check if id is correct. If not, throw away old parts:
-		if self.last_id and self.last_id != id+1:
-			self.message = ''
-		# Check if the are old message parts which belong due to their old age
-		# probably not to this message:
-		if time.time() - self.modified > MSG_PART_TIMEOUT:
-			self.message = ''
-		self.last_id = id
-		self.message = msg + self.message
-		self.modified = time.time()
-
-
-class KeyExchange:
+class KeyExchange(object):
 	'''Class used for key exchange
 
 	@pub_key_receive indicates wether the public key has not yet received
 	@pub_key_send indicates wether the public key has not yet been send
 	@parts specify the number of keyparts
-	@sym_key is the symmetric key
+	@sym_key is the symmetric key (as bytearray, so that it can be wiped)
 	@sym_received incicates wether the symmetric key is completed
+	@created is the time the key exchange was started
+	@modified is the time of the last activity of the key exchange
 	'''
 
-	pub_key_receive = False
-	pub_key_send = False
-	parts = 0
-	sym_key  = ''
-	sym_received = False
+	__slots__ = ('pub_key_receive', 'pub_key_send', 'parts', 'sym_key',
+			'sym_received', 'created', 'modified')
 
 	def __init__(self, pub_key_receive, pub_key_send):
 		'''This function initialize the instance'''
 		self.pub_key_receive = pub_key_receive
 		self.pub_key_send = pub_key_send
+		self.parts = 0
+		self.sym_key = bytearray()
+		self.sym_received = False
+		self.created = self.modified = time.time()
 
 	def update(self, keypart):
-		'''This function update the symmetric key and do the XOR operation'''
-		if self.sym_key == '':
-			self.sym_key = keypart
+		'''This function update the symmetric key and do the XOR operation.
+		The key parts are combined as one integer instead of byte by byte.
+		'''
+		if not self.parts:
+			self.sym_key = bytearray(keypart)
 		else:
-			self.sym_key = ''.join(chr(ord(x) ^ ord(y)) for x, y in
-					zip(self.sym_key, keypart))
+			length = min(len(self.sym_key), len(keypart))
+			sym_key = bytearray(length)
+			if length:
+				combined = int(binascii.hexlify(self.sym_key[:length]), 16) ^ \
+						int(binascii.hexlify(keypart[:length]), 16)
+				sym_key[:] = binascii.unhexlify(('%0*x' % (2 * length,
+					combined)).encode('ascii'))
+			self.wipe()
+			self.sym_key = sym_key
 
 		self.parts = self.parts + 1
 
+	def key(self):
+		'''Return the base64 encoded symmetric key'''
+		return base64.b64encode(bytes(self.sym_key)).decode('ascii')
+
+	def wipe(self):
+		'''Overwrite the symmetric key in memory. This is best-effort only: the
+		key parts (as returned by os.urandom and GnuPG), the integers and hex
+		strings used to combine them and the base64 encoded key passed to
+		IRCrypt are immutable copies which cannot be wiped and are left to the
+		garbage collector.
+		'''
+		self.sym_key[:] = bytearray(len(self.sym_key))
+
+
+class BulkKeyExchange:
+	'''Class used for key exchanges with many nicks at once
+
+	@server is the server the nicks are on
+	@pending is the list of nicks not yet contacted
+	@active maps the targets of running key exchanges to their nicks
+	@succeeded and @failed are lists of finished nicks
+	@buffer is the buffer progress information are printed to
+	'''
+
+	def __init__(self, server, nicks, buffer):
+		'''This function initialize the instance'''
+		self.server = server
+		self.pending = list(nicks)
+		self.active = {}
+		self.succeeded = []
+		self.failed = []
+		self.buffer = buffer
+		self.started = time.time()
+
+	def total(self):
+		'''Return the number of nicks handled by this bulk key exchange'''
+		return len(self.pending) + len(self.active) + len(self.succeeded) \
+				+ len(self.failed)
+
+	def finish(self, target, success):
+		'''Mark the key exchange with target as finished. Returns True if the
+		key exchange belonged to this bulk key exchange.'''
+		if target not in self.active:
+			return False
+		nick = self.active.pop(target)
+		if success:
+			self.succeeded.append(nick)
+		else:
+			self.failed.append(nick)
+		ircrypt_info('Key exchange with %s %s (%i/%i)' % (nick,
+			'succeeded' if success else 'failed',
+			len(self.succeeded) + len(self.failed), self.total()), self.buffer)
+		return True
+
+
+def ircrypt_error(msg, buf):
+	'''Print errors to a given buffer. Errors are printed in red and have the
+	weechat error prefix.
+	'''
+	weechat.prnt(buf, weechat.prefix('error') + weechat.color('red') +
+			('\n' + weechat.color('red')).join(msg.split('\n')))
+
+
+def ircrypt_warn(msg, buf=''):
+	'''Print warnings. If no buffer is set, the default weechat buffer is used.
+	Warnin are printed in gray without marker.
+	'''
+	weechat.prnt(buf, weechat.color('gray') +
+			('\n' + weechat.color('gray')).join(msg.split('\n')))
+
+
+def ircrypt_info(msg, buf=None):
+	'''Print ifo message to specified buffer. If no buffer is set, the current
+	foreground buffer is used to print the message.
+	'''
+	if buf is None:
+		buf = weechat.current_buffer()
+	weechat.prnt(buf, msg)
+
+
+def ircrypt_gpg_binary():
+	'''Get the GnuPG binary found by IRCrypt.
+	'''
+	return weechat.config_string(weechat.config_get('ircrypt.general.binary'))
+
+
+def ircrypt_gnupg(stdin, *args):
+	'''Execute the GnuPG binary used by IRCrypt with given input and options.
+
+	:param stdin: Input for GnuPG
+	:param  args: Additional command line options for GnuPG
+	:returns:     Tuple containing returncode, stdout and stderr
+	'''
+	return ircrypt_core.gnupg(ircrypt_gpg_binary(), stdin, *args)
+
 
 def ircrypt_gpg_init():
-	'''Initialize GnuPG'''
-	global ircrypt_gpg_homedir, ircrypt_gpg_id
+	'''Initialize GnuPG. The keyring is probed by a process running in the
+	background, so that loading the script is not delayed. Key exchange
+	messages received meanwhile are queued.
+	'''
+	global ircrypt_gpg_homedir, ircrypt_gpg_ready
 	# This should usually be ~/.weechat/ircrypt
 	ircrypt_gpg_homedir = '%s/ircrypt' % weechat.info_get("weechat_dir", "")
 	try:
@@ -160,28 +271,70 @@ def ircrypt_gpg_init():
 		pass
 
 	# Probe for GPG key
-	(ret, out, err) = ircrypt.ircrypt_gnupg(b'', '--homedir', ircrypt_gpg_homedir,
-			'--list-secret-keys', '--with-fingerprint', '--with-colon')
+	ircrypt_gpg_init_output[:] = ['', '']
+	hook = weechat.hook_process_hashtable(ircrypt_gpg_binary(), {
+		'arg1': '--batch',
+		'arg2': '--no-tty',
+		'arg3': '--homedir',
+		'arg4': ircrypt_gpg_homedir,
+		'arg5': '--list-secret-keys',
+		'arg6': '--with-fingerprint',
+		'arg7': '--with-colon'},
+		INIT_TIMEOUT * 1000, 'ircrypt_gpg_init_cb', '')
+	ircrypt_gpg_ready = not hook
+	return weechat.WEECHAT_RC_OK
 
-	# GnuPG returncode
-	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
-		return weechat.WEECHAT_RC_ERROR
-	elif err:
-		ircrypt.ircrypt_warn(err.decode('utf-8'), '')
 
-	# There is a secret key
-	if out:
-		try:
-			ircrypt_gpg_id = out.decode('utf-8').split('fpr')[-1].split('\n')[0].strip(':')
-			ircrypt.ircrypt_info('Found private gpg key with fingerprint %s' %
-					ircrypt_gpg_id, '')
-			return weechat.WEECHAT_RC_OK
-		except:
-			ircrypt.ircrypt_error('Unable to get key id', '')
+def ircrypt_gpg_init_cb(data, command, returncode, out, err):
+	'''Callback for the process probing for the GPG key'''
+	global ircrypt_gpg_id
+	ircrypt_gpg_init_output[0] += out
+	ircrypt_gpg_init_output[1] += err
+	if returncode == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+		return weechat.WEECHAT_RC_OK
+	out, err = ircrypt_gpg_init_output
+	ircrypt_gpg_init_output[:] = ['', '']
 
+	try:
+		# GnuPG returncode
+		if returncode:
+			ircrypt_error(err or 'GnuPG failed', weechat.current_buffer())
+			return weechat.WEECHAT_RC_ERROR
+		elif err:
+			ircrypt_warn(err, '')
+
+		# There is a secret key
+		if out:
+			try:
+				ircrypt_gpg_id = out.split('fpr')[-1].split('\n')[0].strip(':')
+				ircrypt_info('Found private gpg key with fingerprint %s' %
+						ircrypt_gpg_id, '')
+				return weechat.WEECHAT_RC_OK
+			except:
+				ircrypt_error('Unable to get key id', '')
+
+		return ircrypt_gpg_generate_key()
+	finally:
+		ircrypt_gpg_init_done()
+
+
+def ircrypt_gpg_init_done():
+	'''Mark the initialization of GnuPG as finished, handle all messages which
+	were queued meanwhile and remove unused public keys.
+	'''
+	global ircrypt_gpg_ready
+	ircrypt_gpg_ready = True
+	pending = ircrypt_pending[:]
+	del ircrypt_pending[:]
+	for buffer, command in pending:
+		weechat.command(buffer, command)
+	ircrypt_prune_timer_cb('', 0)
+
+
+def ircrypt_gpg_generate_key():
+	'''Generate the GPG key used for the key exchange'''
 	# Try to generate a key
-	ircrypt.ircrypt_warn('No private key for assymetric encryption was found in the '
+	ircrypt_warn('No private key for assymetric encryption was found in the '
 			+ 'IRCrypt GPG keyring. IRCrypt will now try to automatically generate a '
 			+ 'new key. This might take quite some time as this procedure depends on '
 			+ 'the gathering of enough entropy for generating cryptographically '
@@ -189,7 +342,7 @@ def ircrypt_gpg_init():
 			+ 'authentication) until this process is done. However, it does not'
 			+ 'affect the symmetric encryption which can already be used. You '
 			+ 'will be notified once the process is done.')
-	binary = weechat.config_string(weechat.config_get('ircrypt.general.binary'))
+	binary = ircrypt_gpg_binary()
 	hook = weechat.hook_process_hashtable(binary, {
 		'stdin': '1',
 		'arg1': '--batch',
@@ -216,12 +369,12 @@ def ircrypt_key_generated_cb(data, command, errorcode, out, err):
 
 	# Error
 	if errorcode:
-		ircrypt.ircrypt_error(err, '')
+		ircrypt_error(err, '')
 		return weechat.WEECHAT_RC_ERROR
 	elif err:
-		ircrypt.ircrypt_warn(err)
+		ircrypt_warn(err)
 
-	ircrypt.ircrypt_info('A private key for asymmetric encryption was successfully'
+	ircrypt_info('A private key for asymmetric encryption was successfully'
 			+ 'generated and can now be used for communication.')
 	return ircrypt_gpg_init()
 
@@ -238,7 +391,7 @@ def ircrypt_receive_key_ex_ping(server, args, info):
 
 	# Check if own gpg key exists
 	if not ircrypt_gpg_id:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
 		return ''
@@ -247,14 +400,14 @@ def ircrypt_receive_key_ex_ping(server, args, info):
 	try:
 		fingerprint = args.split('>KEY-EX-PING')[-1].split(' (')[0].lstrip(' ')
 	except:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
 		return ''
 
 	# Wrong fingerprint: Error
 	if fingerprint and fingerprint != ircrypt_gpg_id:
-		ircrypt.ircrypt_error('%s tries key exchange with wrong fingerprint' \
+		ircrypt_error('%s tries key exchange with wrong fingerprint' \
 				% info['nick'], weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-PING-WITH-INVALID-FINGERPRINT' % (server, info['nick']))
@@ -262,9 +415,10 @@ def ircrypt_receive_key_ex_ping(server, args, info):
 
 	# Send back a >KEY-EX-PONG with optional fingerprint and create an instance
 	# of the class KeyExchange
-	target = '%s/%s' % (server, info['nick'])
-	gpg_id = ircrypt_asym_id.get(target.lower())
+	target = ircrypt_key_ex_target(server, info['nick'])
+	gpg_id = ircrypt_asym_id.get(target)
 	if gpg_id:
+		ircrypt_asym_id_touch(target)
 		weechat.command('','/mute -all notice -server %s %s >KEY-EX-PONG %s' \
 				% (server, info['nick'], gpg_id))
 		if fingerprint:
@@ -286,7 +440,7 @@ def ircrypt_receive_key_ex_pong(server, args, info):
 	'''This function handles incomming >KEY-EX-PONG notices'''
 	global ircrypt_gpg_id, ircrypt_key_ex_memory
 
-	target = '%s/%s' % (server, info['nick'])
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# No instance of KeyExchange: Error
 	if not ircrypt_key_ex_memory.get(target):
@@ -298,14 +452,11 @@ def ircrypt_receive_key_ex_pong(server, args, info):
 
 	# Wrong fingerprint: Error and try to delete instance of KeyExchange
 	if fingerprint and fingerprint != ircrypt_gpg_id:
-		ircrypt.ircrypt_error('%s tries key exchange with wrong fingerprint' \
+		ircrypt_error('%s tries key exchange with wrong fingerprint' \
 				% info['nick'], weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-PING-WITH-INVALID-FINGERPRINT' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# If correct fingerprint, the public key must not been sent
@@ -331,7 +482,7 @@ def ircrypt_receive_next_phase(server, args, info):
 	'''This function handles incomming >KEY-EX-NEXT-PHASE notices'''
 	global ircrypt_gpg_id, ircrypt_key_ex_memory
 
-	target = '%s/%s' % (server, info['nick'])
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# No instance of KeyExchange: Error
 	if not ircrypt_key_ex_memory.get(target):
@@ -354,30 +505,29 @@ def ircrypt_public_key_send(server, nick):
 	'''This function sends away own public key'''
 	global ircrypt_gpg_homedir, ircrypt_gpg_id, ircrypt_key_ex_memory
 
+	target = ircrypt_key_ex_target(server, nick)
+
 	# Export own public key and b64encode the public key. Print error if
 	# necessary.
 	if not ircrypt_gpg_id:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
-				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
+				'>UCRY-INTERNAL-ERROR' % (server, nick))
 		return ''
 
-	(ret, out, err) = ircrypt.ircrypt_gnupg(b'', '--homedir', ircrypt_gpg_homedir,
+	(ret, out, err) = ircrypt_gnupg(b'', '--homedir', ircrypt_gpg_homedir,
 			'--export', ircrypt_gpg_id)
 
 	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
+		ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
-				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+				'>UCRY-INTERNAL-ERROR' % (server, nick))
+		ircrypt_key_ex_abort(target)
 		return ''
 	elif err:
-		ircrypt.ircrypt_warn(err.decode('utf-8'))
+		ircrypt_warn(err.decode('utf-8'))
 
-	pub_key = base64.b64encode(out)
+	pub_key = base64.b64encode(out).decode('ascii')
 
 	# Partition the public key and send it away
 	for i in range(1 + (len(pub_key) // MAX_PART_LEN))[::-1]:
@@ -395,7 +545,7 @@ def ircrypt_public_key_get(server, args, info):
 	pre, message    = args.split('>PUB-EX-', 1)
 	number, message = message.split(' ', 1)
 
-	target = ('%s/%s' % (server, info['nick'])).lower()
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# Check if we got the last part of the message otherwise put the message
 	# into a global memory and quit
@@ -403,7 +553,7 @@ def ircrypt_public_key_get(server, args, info):
 		if not target in ircrypt_pub_keys_memory:
 			# - First element is list of requests
 			# - Second element is currently received request
-			ircrypt_pub_keys_memory[target] = ircrypt.MessageParts()
+			ircrypt_pub_keys_memory[target] = MessageParts()
 		# Add parts to current request
 		ircrypt_pub_keys_memory[target].update(int(number), message)
 		return ''
@@ -417,27 +567,21 @@ def ircrypt_public_key_get(server, args, info):
 	# If no request for a public key: Error and try to delete instance of
 	# KeyExchange
 	if not ircrypt_key_ex_memory[target].pub_key_receive:
-		ircrypt.ircrypt_error('%s sends his public key without inquiry' % info['nick'],
+		ircrypt_error('%s sends his public key without inquiry' % info['nick'],
 				weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-NO-REQUEST-FOR-PUBLIC-KEY' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# If there is a public identifier: Error and try to delete instance of
 	# KeyExchange
 	key_id = ircrypt_asym_id.get(target)
 	if key_id:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Get whole message
@@ -451,61 +595,49 @@ def ircrypt_public_key_get(server, args, info):
 	try:
 		message = base64.b64decode(message)
 	except:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Import public key
-	(ret, out, err) = ircrypt.ircrypt_gnupg(message, '--homedir', ircrypt_gpg_homedir,
+	(ret, out, err) = ircrypt_gnupg(message, '--homedir', ircrypt_gpg_homedir,
 			'--keyid-format', '0xlong', '--import')
 
 	# Print error (There are the information about the imported public key)
 	# and quit key exchange if necessary
 	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
+		ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Try to get public key identifier contained in the stderr output.
 	try:
 		gpg_id = err.decode('utf-8').split('0x',1)[1].split(':',1)[0]
 	except:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Probe for GPG fingerprint
-	(ret, out, err) = ircrypt.ircrypt_gnupg(b'', '--homedir', ircrypt_gpg_homedir,
+	(ret, out, err) = ircrypt_gnupg(b'', '--homedir', ircrypt_gpg_homedir,
 			'--fingerprint', '--with-colon')
 
 	# Print error (There are the information about the imported public key)
 	# and quit key exchange if necessary
 	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
+		ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 	elif err:
-		ircrypt.ircrypt_warn(err.decode('utf-8'))
+		ircrypt_warn(err.decode('utf-8'))
 
 	# There is a secret key
 	try:
@@ -513,17 +645,15 @@ def ircrypt_public_key_get(server, args, info):
 				if (gpg_id + ':') in line and line.startswith('fpr:') ][-1]
 		gpg_id = out.split('fpr')[-1].strip(':')
 	except:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Set asymmetric identifier and remember that the public key was received
-	ircrypt_asym_id[target.lower()] = gpg_id
+	ircrypt_asym_id[target] = gpg_id
+	ircrypt_asym_id_touch(target)
 	ircrypt_key_ex_memory[target].pub_key_receive = False
 
 	# Send status back
@@ -542,7 +672,7 @@ def ircrypt_receive_key_ex_pub_received(server, args, info):
 	'''This function handles incomming >PUB-KEY-RECEIVED notices'''
 	global ircrypt_gpg_id, ircrypt_key_ex_memory
 
-	target = '%s/%s' % (server, info['nick'])
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# No instance of KeyExchange: Error
 	if not ircrypt_key_ex_memory.get(target):
@@ -568,23 +698,21 @@ def ircrypt_sym_key_send(server, nick):
 	# Create part of key
 	keypart = os.urandom(64)
 
-	target = '%s/%s' % (server, nick)
+	target = ircrypt_key_ex_target(server, nick)
+	ircrypt_asym_id_touch(target)
 
-	(ret, out, err) = ircrypt.ircrypt_gnupg(keypart, '--homedir', ircrypt_gpg_homedir,
+	(ret, out, err) = ircrypt_gnupg(keypart, '--homedir', ircrypt_gpg_homedir,
 			'-s', '--trust-model', 'always', '-e', '-r', ircrypt_asym_id[target])
 
 	# Print error and quit key exchange if necessary
 	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
+		ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
-				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+				'>UCRY-INTERNAL-ERROR' % (server, nick))
+		ircrypt_key_ex_abort(target)
 		return ''
 	elif err:
-		ircrypt.ircrypt_warn(err.decode('utf-8'))
+		ircrypt_warn(err.decode('utf-8'))
 
 	# Update symmetric key
 	ircrypt_key_ex_memory[target].update(keypart)
@@ -596,13 +724,11 @@ def ircrypt_sym_key_send(server, nick):
 		# If the symmetric key is also complete by the counterpart set symmetric
 		# key
 		if ircrypt_key_ex_memory[target].sym_received:
-			weechat.command('','/ircrypt set-key -server %s %s %s' \
-					% (server, info['nick'],
-						base64.b64encode(ircrypt_key_ex_memory[target].sym_key)))
+			ircrypt_sym_key_set(server, nick)
 
 	# Print encrypted part of the symmetric key in multiple notices
-	out = base64.b64encode(out)
-	for i in range(1 + (len(out) / MAX_PART_LEN))[::-1]:
+	out = base64.b64encode(out).decode('ascii')
+	for i in range(1 + (len(out) // MAX_PART_LEN))[::-1]:
 		msg = '>SYM-EX-%i %s' % (i, out[i*MAX_PART_LEN:(i+1)*MAX_PART_LEN])
 		weechat.command('','/mute -all notice -server %s %s %s' % (server, nick, msg))
 
@@ -614,24 +740,22 @@ def ircrypt_sym_key_get(server, args, info):
 	pre, message    = args.split('>SYM-EX-', 1)
 	number, message = message.split(' ', 1)
 
-	catchword = (server, info['channel'], info['nick'])
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# Decrypt only if we got last part of the message
 	# otherwise put the message into a global memory and quit
 	if int(number) != 0:
-		if not catchword in ircrypt_sym_key_memory:
-			ircrypt_sym_key_memory[catchword] = ircrypt.MessageParts()
-		ircrypt_sym_key_memory[catchword].update(int(number), message)
+		if not target in ircrypt_sym_key_memory:
+			ircrypt_sym_key_memory[target] = MessageParts()
+		ircrypt_sym_key_memory[target].update(int(number), message)
 		return ''
 
 	# Get whole message
 	try:
-		message = message + ircrypt_sym_key_memory[catchword].message
+		message = message + ircrypt_sym_key_memory[target].message
 	except KeyError:
 		pass
 
-	target = ('%s/%s' % (server, info['nick'])).lower()
-
 	# No instance of KeyExchange: Error
 	if not ircrypt_key_ex_memory.get(target):
 		weechat.command('','/mute -all notice -server %s %s '
@@ -641,52 +765,41 @@ def ircrypt_sym_key_get(server, args, info):
 	# No request for symmtric key exchange: Error and try to delete instance
 	if (ircrypt_key_ex_memory[target].pub_key_send or
 			ircrypt_key_ex_memory[target].pub_key_receive):
-		ircrypt.ircrypt_error('%s sends symmetric key without inquiry' % info['nick'],
+		ircrypt_error('%s sends symmetric key without inquiry' % info['nick'],
 				weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-NO-REQUEST-FOR-SYMMETRIC-KEY' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Decode base64 encoded message
 	try:
 		message = base64.b64decode(message)
 	except TypeError:
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Decrypt
-	(ret, out, err) = ircrypt.ircrypt_gnupg(message, '--homedir',
+	(ret, out, err) = ircrypt_gnupg(message, '--homedir',
 			ircrypt_gpg_homedir, '-d')
 
 	# Print error and quit key exchange if necessary
 	if ret:
-		ircrypt.ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
+		ircrypt_error(err.decode('utf-8'), weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s '
 				'>UCRY-INTERNAL-ERROR' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Remove old messages from memory
 	try:
-		del ircrypt_sym_key_memory[catchword]
+		del ircrypt_sym_key_memory[target]
 	except KeyError:
 		pass
 
-	target = '%s/%s' % (server, info['nick'])
-
 	# Update symmetric key
 	ircrypt_key_ex_memory[target].update(out)
 
@@ -698,9 +811,7 @@ def ircrypt_sym_key_get(server, args, info):
 		# If the symmetric key is also complete by the counterpart set symmetric
 		# key
 		if ircrypt_key_ex_memory[target].sym_received:
-			weechat.command('','/ircrypt set-key -server %s %s %s' \
-					% (server, info['nick'],
-						base64.b64encode(ircrypt_key_ex_memory[target].sym_key)))
+			ircrypt_sym_key_set(server, info['nick'])
 
 	return ''
 
@@ -709,7 +820,7 @@ def ircrypt_receive_key_ex_sym_received(server, args, info):
 	'''This functions handles incomming >KEY-EX-SYM-RECEIVED notices'''
 	global ircrypt_gpg_id, ircrypt_key_ex_memory
 
-	target = '%s/%s' % (server, info['nick'])
+	target = ircrypt_key_ex_target(server, info['nick'])
 
 	# No instance of KeyExchange: Error
 	if not ircrypt_key_ex_memory.get(target):
@@ -720,13 +831,10 @@ def ircrypt_receive_key_ex_sym_received(server, args, info):
 	# No request for symmetric key exchange: Error and try to delete instance
 	if (ircrypt_key_ex_memory[target].pub_key_send or
 			ircrypt_key_ex_memory[target].pub_key_receive):
-		ircrypt.ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
+		ircrypt_error('Error in IRCrypt key exchange', weechat.current_buffer())
 		weechat.command('','/mute -all notice -server %s %s'
 				'>UCRY-NO-REQUEST-FOR-SYMMETRIC-KEY' % (server, info['nick']))
-		try:
-			del ircrypt_key_ex_memory[target]
-		except KeyError:
-			pass
+		ircrypt_key_ex_abort(target)
 		return ''
 
 	# Remember that the counterpart has received the symmetric key
@@ -735,13 +843,157 @@ def ircrypt_receive_key_ex_sym_received(server, args, info):
 	# If the symmetric key is also complete by the counterpart set symmetric
 	# key
 	if ircrypt_key_ex_memory[target].parts == 2:
-			weechat.command('','/ircrypt set-key -server %s %s %s' \
-					% (server, info['nick'],
-						base64.b64encode(ircrypt_key_ex_memory[target].sym_key)))
+		ircrypt_sym_key_set(server, info['nick'])
 
 	return ''
 
 
+def ircrypt_sym_key_set(server, nick):
+	'''Set the symmetric key negotiated with nick and close the key exchange'''
+	target = ircrypt_key_ex_target(server, nick)
+	weechat.command('','/ircrypt set-key -server %s %s %s' \
+			% (server, nick, ircrypt_key_ex_memory[target].key()))
+	ircrypt_key_ex_finish(target, True)
+
+
+def ircrypt_key_ex_target(server, nick):
+	'''Get the normalized key used for the key exchange memories'''
+	return ('%s/%s' % (server, nick)).lower()
+
+
+def ircrypt_key_ex_abort(target):
+	'''Forget a failed key exchange with target'''
+	ircrypt_key_ex_finish(target, False)
+
+
+def ircrypt_key_ex_finish(target, success):
+	'''Remove a finished key exchange and all related message parts from
+	memory and report the result to a bulk key exchange the exchange may belong
+	to.
+	'''
+	key_ex = ircrypt_key_ex_memory.get(target)
+	if key_ex:
+		key_ex.wipe()
+	for memory in (ircrypt_key_ex_memory, ircrypt_pub_keys_memory,
+			ircrypt_sym_key_memory):
+		try:
+			del memory[target]
+		except KeyError:
+			pass
+	for bulk in ircrypt_bulk_key_ex:
+		if bulk.finish(target, success):
+			break
+
+
+def ircrypt_key_ex_reaper_cb(data, remaining_calls):
+	'''Timer callback aborting key exchanges without activity for longer than
+	the configured timeout and removing orphaned message parts.
+	'''
+	timeout = weechat.config_integer(ircrypt_config_option['timeout'])
+	now = time.time()
+
+	for target, key_ex in list(ircrypt_key_ex_memory.items()):
+		if now - key_ex.modified > timeout:
+			ircrypt_warn('Key exchange with %s timed out' % target)
+			ircrypt_key_ex_abort(target)
+
+	for memory in (ircrypt_pub_keys_memory, ircrypt_sym_key_memory):
+		for target, parts in list(memory.items()):
+			if now - parts.modified > MSG_PART_TIMEOUT:
+				del memory[target]
+
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_bulk_start(server, nicks, buffer):
+	'''Start key exchanges with a list of nicks. The key exchanges are run by
+	the bulk timer which limits the number of exchanges running at the same
+	time and the rate at which they are started.
+	'''
+	global ircrypt_bulk_timer
+
+	# Check if own gpg key exists
+	if not ircrypt_gpg_id:
+		ircrypt_error('No GPG key generated', buffer)
+		return weechat.WEECHAT_RC_ERROR
+
+	# Remove duplicates and our own nick
+	own_nick = (weechat.info_get('irc_nick', server) or '').lower()
+	seen = set()
+	unique = []
+	for nick in nicks:
+		if nick.lower() in seen or nick.lower() == own_nick:
+			continue
+		seen.add(nick.lower())
+		unique.append(nick)
+	if not unique:
+		ircrypt_error('No nicks to exchange keys with', buffer)
+		return weechat.WEECHAT_RC_ERROR
+
+	ircrypt_bulk_key_ex.append(BulkKeyExchange(server, unique, buffer))
+	ircrypt_info('Start key exchange with %i nicks on server %s. This may '
+			'take some time.' % (len(unique), server), buffer)
+
+	if not ircrypt_bulk_timer:
+		interval = weechat.config_integer(ircrypt_config_option['interval'])
+		ircrypt_bulk_timer = weechat.hook_timer(interval * 1000, 0, 0,
+				'ircrypt_bulk_timer_cb', '')
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_bulk_timer_cb(data, remaining_calls):
+	'''Timer callback running bulk key exchanges. On every call, at most one
+	new key exchange is started if the limit of concurrent key exchanges allows
+	it. Stalled key exchanges are aborted by the key exchange reaper.
+	'''
+	global ircrypt_bulk_timer
+
+	max_concurrent = weechat.config_integer(ircrypt_config_option['max_concurrent'])
+	now = time.time()
+
+	# Start next key exchange if possible
+	active = sum([len(bulk.active) for bulk in ircrypt_bulk_key_ex])
+	for bulk in ircrypt_bulk_key_ex:
+		if active >= max_concurrent:
+			break
+		if bulk.pending:
+			nick = bulk.pending.pop(0)
+			target = ircrypt_key_ex_target(bulk.server, nick)
+			bulk.active[target] = nick
+			ircrypt_command_start(bulk.server, nick, True)
+			break
+
+	# Print summary of finished bulk key exchanges
+	for bulk in ircrypt_bulk_key_ex[:]:
+		if bulk.pending or bulk.active:
+			continue
+		ircrypt_bulk_key_ex.remove(bulk)
+		msg = 'Key exchange on server %s finished after %i seconds: %i succeeded, ' \
+				'%i failed' % (bulk.server, now - bulk.started, len(bulk.succeeded),
+						len(bulk.failed))
+		if bulk.failed:
+			msg += '\nFailed: %s' % ' '.join(bulk.failed)
+		ircrypt_info(msg, bulk.buffer)
+
+	# Stop timer if there is nothing left to do
+	if not ircrypt_bulk_key_ex:
+		weechat.unhook(ircrypt_bulk_timer)
+		ircrypt_bulk_timer = None
+
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_channel_nicks(server, channel):
+	'''Get a list of all nicks in channel on server'''
+	nicks = []
+	infolist = weechat.infolist_get('irc_nick', '', '%s,%s' % (server, channel))
+	if infolist:
+		while weechat.infolist_next(infolist):
+			nicks.append(weechat.infolist_string(infolist, 'name'))
+		weechat.infolist_free(infolist)
+	return nicks
+
+
 def ircrypt_config_init():
 	''' This method initializes the configuration file. It creates sections and
 	options in memory and prepares the handling of key sections.
@@ -751,6 +1003,42 @@ def ircrypt_config_init():
 	if not ircrypt_config_file:
 		return
 
+	# bulk key exchange
+	ircrypt_config_section['bulk'] = weechat.config_new_section(
+			ircrypt_config_file, 'bulk', 0, 0, '', '', '', '', '', '', '', '',
+			'', '')
+	if not ircrypt_config_section['bulk']:
+		weechat.config_free(ircrypt_config_file)
+		return
+	ircrypt_config_option['max_concurrent'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['bulk'],
+			'max_concurrent', 'integer',
+			'Maximum number of concurrent key exchanges in a bulk key exchange',
+			'', 1, 100, '5', '5', 0, '', '', '', '', '', '')
+	ircrypt_config_option['interval'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['bulk'],
+			'interval', 'integer',
+			'Seconds between starting two key exchanges in a bulk key exchange',
+			'', 1, 3600, '2', '2', 0, '', '', '', '', '', '')
+
+	# general options
+	ircrypt_config_section['general'] = weechat.config_new_section(
+			ircrypt_config_file, 'general', 0, 0, '', '', '', '', '', '', '', '',
+			'', '')
+	if not ircrypt_config_section['general']:
+		weechat.config_free(ircrypt_config_file)
+		return
+	ircrypt_config_option['timeout'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'timeout', 'integer',
+			'Seconds without activity after which a key exchange is aborted',
+			'', 10, 86400, '300', '300', 0, '', '', '', '', '', '')
+	ircrypt_config_option['prune_after'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'prune_after', 'integer',
+			'Automatically remove public keys not used for this number of days '
+			'(0 to disable)', '', 0, 36500, '0', '0', 0, '', '', '', '', '', '')
+
 	# public key identifier
 	ircrypt_config_section['asym_id'] = weechat.config_new_section(
 			ircrypt_config_file, 'asym_id', 0, 0,
@@ -786,7 +1074,16 @@ def ircrypt_config_asym_id_read_cb(data, config_file, section_name, option_name,
 	'''
 	global ircrypt_asym_id
 
-	ircrypt_asym_id[option_name.lower()] = value
+	# Values are stored as “<fingerprint> <last used>”. Keys without time stamp
+	# are considered to be used now.
+	value = value.split()
+	if not value:
+		return weechat.WEECHAT_CONFIG_OPTION_SET_ERROR
+	ircrypt_asym_id[option_name.lower()] = value[0]
+	try:
+		ircrypt_asym_last_used[option_name.lower()] = int(value[1])
+	except (IndexError, ValueError):
+		ircrypt_asym_last_used[option_name.lower()] = int(time.time())
 	return weechat.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
 
 
@@ -796,20 +1093,62 @@ def ircrypt_config_asym_id_write_cb(data, config_file, section_name):
 	global ircrypt_asym_id
 
 	weechat.config_write_line(config_file, section_name, '')
+	if ircrypt_store:
+		return weechat.WEECHAT_RC_OK
 	for target, asym_id in sorted(list(ircrypt_asym_id.items())):
-		weechat.config_write_line(config_file, target.lower(), asym_id)
+		weechat.config_write_line(config_file, target.lower(), '%s %i' %
+				(asym_id, ircrypt_asym_last_used.get(target, time.time())))
 
 	return weechat.WEECHAT_RC_OK
 
 
+def ircrypt_store_open():
+	'''Open the SQLite database set by ircrypt.general.store and move the public
+	key identifiers read from the configuration file to it. If no database is
+	set, they are written to the configuration file.
+	'''
+	global ircrypt_store, ircrypt_asym_id, ircrypt_asym_last_used
+	if ircrypt_store:
+		ircrypt_store.close()
+		ircrypt_store = None
+	path = weechat.config_string(weechat.config_get('ircrypt.general.store'))
+	if path and ircrypt_core.sqlite3:
+		path = path.replace('%h', weechat.info_get('weechat_dir', ''))
+		try:
+			ircrypt_store = ircrypt_core.Store(path)
+			migrate = bool(ircrypt_asym_id)
+			ircrypt_asym_id = ircrypt_core.StoredDict(ircrypt_store,
+					'asym_id', ircrypt_asym_id)
+			ircrypt_asym_last_used = ircrypt_core.StoredDict(
+					ircrypt_store, 'asym_last_used', ircrypt_asym_last_used)
+		except ircrypt_core.sqlite3.Error as e:
+			ircrypt_error('Could not open key store %s: %s' % (path, e),
+					'')
+			ircrypt_store = None
+		else:
+			# Remove moved identifiers from the configuration file
+			if migrate:
+				ircrypt_config_write()
+			return
+	ircrypt_asym_id = dict(ircrypt_asym_id)
+	ircrypt_asym_last_used = dict(ircrypt_asym_last_used)
+
+
+def ircrypt_store_config_cb(data, option, value):
+	'''Follow changes of the key store set for IRCrypt'''
+	ircrypt_store_open()
+	ircrypt_config_write()
+	return weechat.WEECHAT_RC_OK
+
+
 def ircrypt_command_list():
 	'''ircrypt command to list fingerprints'''
 	out = '\n'.join([' %s : %s' % x for x in ircrypt_asym_id.items()])
-	ircrypt.ircrypt_info('Fingerprint:\n' + out if out else 'No known Fingerprints')
+	ircrypt_info('Fingerprint:\n' + out if out else 'No known Fingerprints')
 	return weechat.WEECHAT_RC_OK
 
 
-def ircrypt_command_start(server, nick):
+def ircrypt_command_start(server, nick, quiet=False):
 	'''This function is called when the user starts a key exchange'''
 	global ircrypt_asym_id, ircrypt_key_ex_memory, ircrypt_gpg_id
 
@@ -819,15 +1158,16 @@ def ircrypt_command_start(server, nick):
 
 	# Check if own gpg key exists
 	if not ircrypt_gpg_id:
-		ircrypt.ircrypt_error('No GPG key generated')
+		ircrypt_error('No GPG key generated', weechat.current_buffer())
 		return weechat.WEECHAT_RC_ERROR
 
 	# Send >KEY-EX-PING with optional gpg fingerprint and create instance of
 	# KeyExchange
-	target = '%s/%s' % (server, nick)
-	gpg_id = ircrypt_asym_id.get(target.lower())
+	target = ircrypt_key_ex_target(server, nick)
+	gpg_id = ircrypt_asym_id.get(target)
 	text = '(Trying to initialte key exchange via IRCrypt-KeyEx)'
 	if gpg_id:
+		ircrypt_asym_id_touch(target)
 		weechat.command('','/mute -all notice -server %s %s >KEY-EX-PING %s %s' \
 				% (server, nick, gpg_id, text))
 		ircrypt_key_ex_memory[target] = KeyExchange(False, True)
@@ -837,7 +1177,9 @@ def ircrypt_command_start(server, nick):
 		ircrypt_key_ex_memory[target] = KeyExchange(True, True)
 
 	# print information
-	ircrypt.ircrypt_info('Start key exchange with %s on server %s. This may take some '
+	if quiet:
+		return weechat.WEECHAT_RC_OK
+	ircrypt_info('Start key exchange with %s on server %s. This may take some '
 			'time. The exchange will be ignored if %s has no IRCrypt-KeyEx.' \
 			% (nick,	server, nick))
 
@@ -850,20 +1192,96 @@ def ircrypt_command_remove_public_key(target):
 
 	# Check if public key is set and print error in current buffer otherwise
 	if target.lower() not in ircrypt_asym_id:
-		ircrypt.ircrypt_error('No existing public key for %s.' % target, weechat.current_buffer())
+		ircrypt_error('No existing public key for %s.' % target, weechat.current_buffer())
 		return weechat.WEECHAT_RC_ERROR
 	# Delete public key (first in gpg then in config file) and print status
 	# message in current buffer
-	(ret, out, err) = ircrypt.ircrypt_gnupg(b'', '--yes', '--homedir',
+	(ret, out, err) = ircrypt_gnupg(b'', '--yes', '--homedir',
 			ircrypt_gpg_homedir,'--delete-key', ircrypt_asym_id[target.lower()])
 
 	if ret:
-		ircrypt.ircrypt_error('Could not delete public key in gpg', weechat.current_buffer())
+		ircrypt_error('Could not delete public key in gpg', weechat.current_buffer())
 		return weechat.WEECHAT_RC_ERROR
 	elif err:
-		ircrypt.ircrypt_warn(err.decode('utf-8'))
+		ircrypt_warn(err.decode('utf-8'))
 	del ircrypt_asym_id[target.lower()]
-	ircrypt.ircrypt_info('Removed asymmetric identifier for %s' % target)
+	ircrypt_asym_last_used.pop(target.lower(), None)
+	ircrypt_info('Removed asymmetric identifier for %s' % target)
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_asym_id_touch(target):
+	'''Remember that the public key of target was just used'''
+	ircrypt_asym_last_used[target] = int(time.time())
+
+
+def ircrypt_prune(days, buffer=''):
+	'''Remove all public keys from the IRCrypt keyring which were not used for
+	the given number of days. All keys are removed with a single call of GnuPG.
+	Keys still used by other targets or by running key exchanges are kept.
+
+	:param days: Minimum number of days a key must have been unused
+	:returns: Number of removed public key identifiers or None on error
+	'''
+	limit = time.time() - days * 86400
+	stale = [target for target in ircrypt_asym_id
+			if ircrypt_asym_last_used.get(target, 0) < limit
+			and target not in ircrypt_key_ex_memory]
+	if not stale:
+		return 0
+
+	# Keep fingerprints which are still in use for other targets
+	in_use = set([fpr for target, fpr in ircrypt_asym_id.items()
+		if target not in stale])
+	fingerprints = sorted(set([ircrypt_asym_id[target] for target in stale])
+			- in_use)
+
+	if fingerprints:
+		(ret, out, err) = ircrypt_gnupg(b'', '--yes', '--homedir',
+				ircrypt_gpg_homedir, '--delete-keys', *fingerprints)
+		if ret:
+			ircrypt_error('Could not delete public keys in gpg:\n%s' %
+					err.decode('utf-8'), buffer)
+			return None
+		elif err:
+			ircrypt_warn(err.decode('utf-8'), buffer)
+
+	for target in stale:
+		del ircrypt_asym_id[target]
+		ircrypt_asym_last_used.pop(target, None)
+	return len(stale)
+
+
+def ircrypt_command_prune(buffer, argv):
+	'''ircrypt command to remove public keys not used for some time'''
+	days = weechat.config_integer(ircrypt_config_option['prune_after']) \
+			or PRUNE_DEFAULT
+	if argv[1:2] == ['--older-than']:
+		try:
+			days = int(argv[2])
+		except (IndexError, ValueError):
+			ircrypt_error('--older-than requires a number of days', buffer)
+			return weechat.WEECHAT_RC_ERROR
+		del argv[1:3]
+	if len(argv) != 1:
+		return weechat.WEECHAT_RC_ERROR
+
+	removed = ircrypt_prune(days, buffer)
+	if removed is None:
+		return weechat.WEECHAT_RC_ERROR
+	ircrypt_info('Removed %i public key identifiers not used within the '
+			'last %i days' % (removed, days), buffer)
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_prune_timer_cb(data, remaining_calls):
+	'''Timer callback for the automatic removal of unused public keys'''
+	days = weechat.config_integer(ircrypt_config_option['prune_after'])
+	if days > 0:
+		removed = ircrypt_prune(days)
+		if removed:
+			ircrypt_info('Removed %i public key identifiers not used within '
+					'the last %i days' % (removed, days), '')
 	return weechat.WEECHAT_RC_OK
 
 
@@ -873,14 +1291,18 @@ def ircrypt_command(data, buffer, args):
 
 	argv = [a for a in args.split(' ') if a]
 
-	if argv and not argv[0] in ['list', 'remove-public-key', 'start']:
-		ircrypt.ircrypt_error('%sUnknown command. Try  /help ircrypt-keyex', buffer)
+	if argv and not argv[0] in ['list', 'remove-public-key', 'start', 'prune']:
+		ircrypt_error('%sUnknown command. Try  /help ircrypt-keyex', buffer)
 		return weechat.WEECHAT_RC_ERROR
 
 	# list
 	if not argv or argv == ['list']:
 		return ircrypt_command_list()
 
+	# prune
+	if argv[0] == 'prune':
+		return ircrypt_command_prune(buffer, argv)
+
 	# Check if a server was set
 	if (len(argv) > 2 and argv[1] == '-server'):
 		server = argv[2]
@@ -894,7 +1316,7 @@ def ircrypt_command(data, buffer, args):
 	# All remaining commands need a server name
 	if not server:
 		# if no server was set print message in ircrypt buffer and throw error
-		ircrypt.ircrypt_error('Unknown Server. Please use -server to specify server', buffer)
+		ircrypt_error('Unknown Server. Please use -server to specify server', buffer)
 		return weechat.WEECHAT_RC_ERROR
 
 	# For the remaining commands we need at least one additional argument
@@ -904,9 +1326,15 @@ def ircrypt_command(data, buffer, args):
 	target = '%s/%s' % (server, argv[1])
 
 	if argv[0] == 'start':
+		# Start key exchange with all nicks in a channel
+		if argv[1] == '-channel':
+			if len(argv) != 3:
+				return weechat.WEECHAT_RC_ERROR
+			return ircrypt_bulk_start(server, ircrypt_channel_nicks(server,
+				argv[2]), buffer)
 		if len(argv) == 2:
 			return ircrypt_command_start(server, argv[1])
-		return weechat.WEECHAT_RC_ERROR
+		return ircrypt_bulk_start(server, argv[1:], buffer)
 
 	# Remove public key from another user
 	if argv[0] == 'remove-public-key':
@@ -920,27 +1348,43 @@ def ircrypt_command(data, buffer, args):
 
 def ircrypt_notice_hook(data, msgtype, server, args):
 
+	# Handle key exchange messages once the GPG key is known
+	if not ircrypt_gpg_ready and ('>KEY-EX-' in args or '>SYM-EX-' in args
+			or '>PUB-EX-' in args):
+		ircrypt_pending.append((weechat.buffer_search('irc', 'server.%s' % server),
+			'/server fakerecv %s' % args))
+		return ''
+
 	info = weechat.info_get_hashtable('irc_message_parse', { 'message': args })
 
+	# Remember activity of running key exchange
+	key_ex = ircrypt_key_ex_memory.get(ircrypt_key_ex_target(server, info['nick']))
+	if key_ex:
+		key_ex.modified = time.time()
+
+	# Any error reported by the counterpart ends the key exchange
+	if '>UCRY-' in args:
+		ircrypt_key_ex_abort(ircrypt_key_ex_target(server, info['nick']))
+
 	if '>UCRY-INTERNAL-ERROR' in args:
-		ircrypt.ircrypt_error('%s on server %s reported an error during the key exchange' \
+		ircrypt_error('%s on server %s reported an error during the key exchange' \
 				% (info['nick'], server), weechat.current_buffer())
 		return ''
 	elif '>UCRY-NO-KEY-EXCHANGE' in args:
-		ircrypt.ircrypt_error('%s on server %s reported an error during the key exchange' \
+		ircrypt_error('%s on server %s reported an error during the key exchange' \
 				% (info['nick'], server), weechat.current_buffer())
 		return ''
 	elif '>UCRY-PING-WITH-INVALID-FINGERPRINT' in args:
-		ircrypt.ircrypt_error('%s on server %s reported that your fingerprint known does'
+		ircrypt_error('%s on server %s reported that your fingerprint known does'
 				'not match his own fingerprint' % (info['nick'], server),
 				weechat.current_buffer())
 		return ''
 	elif '>UCRY-NO-REQUEST-FOR-PUBLIC-KEY' in args:
-		ircrypt.ircrypt_error('%s on server %s reported an error during the key exchange' \
+		ircrypt_error('%s on server %s reported an error during the key exchange' \
 				% (info['nick'], server), weechat.current_buffer())
 		return ''
 	elif '>UCRY-NO-REQUEST-FOR-SYMMETRIC-KEY' in args:
-		ircrypt.ircrypt_error('%s on server %s reported an error during the key exchange' \
+		ircrypt_error('%s on server %s reported an error during the key exchange' \
 				% (info['nick'], server), weechat.current_buffer())
 		return ''
 	# Different hooks
@@ -962,10 +1406,52 @@ def ircrypt_notice_hook(data, msgtype, server, args):
 	return args
 
 
+def ircrypt_profile_signal_cb(data, signal, action):
+	'''Start or stop profiling the hooks of ircrypt-keyex or write the collected
+	statistics. The signal is sent by /ircrypt profile.
+	'''
+	global ircrypt_profiler
+	if not ircrypt_profiler:
+		ircrypt_profiler = ircrypt_core.Profiler(globals(),
+				('ircrypt_notice_hook',))
+	if action == 'start':
+		ircrypt_profiler.start()
+	elif action == 'stop':
+		ircrypt_profiler.stop()
+	elif action == 'dump':
+		path = '%s/ircrypt-keyex_profile.txt' % weechat.info_get('weechat_dir', '')
+		if ircrypt_profiler.dump(path):
+			ircrypt_info('Profile written to %s' % path)
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_info_sessions_cb(data, info_name, arguments):
+	'''Provide the number of active key exchanges per server, e.g. for the
+	metrics exported by IRCrypt.
+	'''
+	sessions = {}
+	for target in ircrypt_key_ex_memory:
+		server = target.rsplit('/', 1)[0]
+		sessions[server] = sessions.get(server, 0) + 1
+	return ','.join(['%s=%i' % x for x in sorted(sessions.items())])
+
+
+def ircrypt_info_memory_cb(data, info_name, arguments):
+	'''Provide a summary of the data kept in memory by the key exchange for
+	/ircrypt memory.
+	'''
+	core = ircrypt_core
+	return '\n'.join([
+		core.memory_report('Key exchanges', [(target, len(key_ex.sym_key),
+			key_ex.created) for target, key_ex in ircrypt_key_ex_memory.items()]),
+		core.memory_report('Public key parts', [(target, parts.size(),
+			parts.modified) for target, parts in ircrypt_pub_keys_memory.items()]),
+		core.memory_report('Symmetric key parts', [(target, parts.size(),
+			parts.modified) for target, parts in ircrypt_sym_key_memory.items()])])
+
+
 def ircrypt_load(data, signal, ircrypt_path):
-	global ircrypt
-	if ircrypt_path.endswith('ircrypt.py'):
-		ircrypt = imp.load_source('ircrypt', ircrypt_path)
+	if ircrypt_path.endswith('ircrypt.py') and not ircrypt_initialized:
 		ircrypt_init()
 	return weechat.WEECHAT_RC_OK
 
@@ -979,35 +1465,67 @@ def ircrypt_check_ircrypt():
 
 
 def ircrypt_init():
+	'''Initialize the key exchange once IRCrypt is loaded. Only its
+	configuration is used, the encryption functions are shared via
+	ircrypt_core.
+	'''
+	global ircrypt_binary_hook, ircrypt_initialized
+	ircrypt_initialized = True
 	# Initialize configuration
 	ircrypt_config_init()
 	ircrypt_config_read()
-	# Look for GnuPG binary
-	if weechat.config_string(weechat.config_get('ircrypt.general.binary')):
-		# Initialize public key authentification
-		ircrypt_gpg_init()
-		# Register Hooks
-		weechat.hook_modifier('irc_in_notice', 'ircrypt_notice_hook', '')
-		weechat.hook_command('ircrypt-keyex', 'Commands of the Addon IRCrypt-keyex',
-				'[list] '
-				'| remove-public-key [-server <server>] <nick> '
-				'| start [-server <server>] <nick> ',
-				SCRIPT_HELP_TEXT,
-				'list '
-				'|| remove-public-key %(nicks)|-server %(irc_servers) %- '
-				'|| start %(nicks)|-server %(irc_servers) %- ',
-				'ircrypt_command', '')
+	ircrypt_store_open()
+	weechat.hook_config('ircrypt.general.store', 'ircrypt_store_config_cb', '')
+	# Look for GnuPG binary. IRCrypt might still be looking for it.
+	if ircrypt_gpg_binary():
+		ircrypt_init_gpg()
 	else:
-		ircrypt.ircrypt_error('GnuPG not found', weechat.current_buffer())
+		ircrypt_binary_hook = weechat.hook_config('ircrypt.general.binary',
+				'ircrypt_binary_config_cb', '')
+
+
+def ircrypt_binary_config_cb(data, option, value):
+	'''Finish the initialization once IRCrypt found the GnuPG binary'''
+	global ircrypt_binary_hook
+	if value and ircrypt_binary_hook:
+		weechat.unhook(ircrypt_binary_hook)
+		ircrypt_binary_hook = None
+		ircrypt_init_gpg()
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_init_gpg():
+	# Initialize public key authentification
+	ircrypt_gpg_init()
+	# Register Hooks
+	weechat.hook_modifier('irc_in_notice', 'ircrypt_notice_hook', '')
+	weechat.hook_timer(60 * 1000, 0, 0, 'ircrypt_key_ex_reaper_cb', '')
+	weechat.hook_timer(24 * 3600 * 1000, 0, 0, 'ircrypt_prune_timer_cb', '')
+	weechat.hook_info('ircrypt_keyex_sessions', 'Number of active key '
+			'exchanges per server (server=count,...)', '',
+			'ircrypt_info_sessions_cb', '')
+	weechat.hook_info('ircrypt_keyex_memory', 'Memory used by key exchanges '
+			'(for /ircrypt memory)', '', 'ircrypt_info_memory_cb', '')
+	weechat.hook_signal('ircrypt_profile', 'ircrypt_profile_signal_cb', '')
+	weechat.hook_command('ircrypt-keyex', 'Commands of the Addon IRCrypt-keyex',
+			'[list] '
+			'| remove-public-key [-server <server>] <nick> '
+			'| start [-server <server>] <nick> [<nick> ...] '
+			'| start [-server <server>] -channel <channel> '
+			'| prune [--older-than <days>] ',
+			SCRIPT_HELP_TEXT,
+			'list '
+			'|| remove-public-key %(nicks)|-server %(irc_servers) %- '
+			'|| start %(nicks)|-channel|-server %(nicks)|%(irc_channel)|%(irc_servers) %(nicks)|%* '
+			'|| prune --older-than',
+			'ircrypt_command', '')
 
 
 # register plugin
 if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
 		SCRIPT_DESC, 'ircrypt_unload_script', 'UTF-8'):
 
-	ircrypt_path = ircrypt_check_ircrypt()
-	if ircrypt_path:
-		ircrypt = imp.load_source('ircrypt', ircrypt_path)
+	if ircrypt_check_ircrypt():
 		ircrypt_init()
 	else:
 		weechat.hook_signal('python_script_loaded', 'ircrypt_load', '')
@@ -1018,4 +1536,6 @@ def ircrypt_unload_script():
 	script is unloaded.
 	'''
 	ircrypt_config_write()
+	if ircrypt_store:
+		ircrypt_store.close()
 	return weechat.WEECHAT_RC_OK
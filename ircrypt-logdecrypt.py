@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# IRCrypt: Decrypt IRCrypt messages in IRC log files
+# ==================================================
+#
+# Copyright (C) 2013-2014
+#    Lars Kiesow   <lkiesow@uos.de>
+#    Sven Haardiek <sven@haardiek.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+#
+# == About ==================================================================
+#
+#  Decrypt IRCrypt messages (>CRY-[id.]n or >CRY-[id.]i/n) contained in
+#  WeeChat logs, bouncer (ZNC) logs or raw IRC lines. Messages encrypted with
+#  session keys (>CRY2-) are decrypted as well if the Python module
+#  cryptography is installed. The keys are read from the IRCrypt configuration
+#  file (ircrypt.conf). Log files are processed as stream, message parts are
+#  reassembled per sender and messages are decrypted by a pool of processes.
+#  The output keeps the order of the input.
+#
+#  Usage:
+#
+#    python ircrypt-logdecrypt.py -c ~/.weechat/ircrypt.conf \
+#        ~/.weechat/logs/irc.freenode.#IRCrypt.weechatlog
+#    python ircrypt-logdecrypt.py -s freenode -t '#IRCrypt' -k secret < znc.log
+#
+# == Project ================================================================
+#
+# This plug-in is part of the IRCrypt project. For mor information or to
+# participate, please visit
+#
+#   https://github.com/IRCrypt
+#
+
+
+import sys, os, re, collections, multiprocessing, argparse
+import ircrypt_core
+
+# Log formats. Each expression has to match everything in front of the message
+# and provides the nick of the sender and optionally the channel.
+LOG_FORMATS = collections.OrderedDict([
+	('weechat', re.compile(r'^[^\t]*\t[~&@%+]?(?P<nick>[^\t]*)\t')),
+	('znc',     re.compile(r'^\[[^\]]*\] <(?P<nick>[^>]*)> ')),
+	('irc',     re.compile(r'^(?:@\S+ )?:(?P<nick>[^! ]+)\S* PRIVMSG '
+		r'(?P<channel>\S+) :')),
+	])
+
+# Number of messages which may be decrypted ahead of the output per process
+WINDOW_PER_PROCESS = 8
+
+
+def read_keys(config_file):
+	'''Read the keys from an IRCrypt configuration file.
+
+	:param config_file: Path to ircrypt.conf
+	:returns: Pattern dictionary mapping lower case server/channel to keys
+	'''
+	keys = ircrypt_core.PatternDict()
+	section = None
+	with open(config_file) as f:
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			if line.startswith('[') and line.endswith(']'):
+				section = line[1:-1]
+				continue
+			if section != 'keys' or ' = ' not in line:
+				continue
+			target, key = line.split(' = ', 1)
+			if len(key) > 1 and key[0] == key[-1] == '"':
+				key = key[1:-1]
+			keys[target.strip().lower()] = key
+	return keys
+
+
+def weechat_log_target(filename):
+	'''Get server and channel from the name of a WeeChat log file
+	(irc.<server>.<channel>.weechatlog).
+	'''
+	name = os.path.basename(filename)
+	if not name.startswith('irc.') or not name.endswith('.weechatlog'):
+		return None, None
+	name = name[len('irc.'):-len('.weechatlog')]
+	if not '.' in name:
+		return None, None
+	return name.split('.', 1)
+
+
+def parse_line(line, log_format=None, pre='CRY'):
+	'''Parse a log line containing a message part.
+
+	:returns: Tuple containing everything in front of the part, the nick of the
+	          sender, the channel (or None), the number of the part, the total
+	          number of parts (None if sent last part first), the message id (or
+	          None) and its content or None if the line contains no message
+	          part.
+	'''
+	part = ircrypt_core.parse_part(line, pre)
+	if not part:
+		return None
+	before, number, total, msgid, content = part
+	formats = [LOG_FORMATS[log_format]] if log_format else LOG_FORMATS.values()
+	for expression in formats:
+		match = expression.match(before)
+		if match:
+			channel = match.groupdict().get('channel')
+			return (before, match.group('nick'), channel, number, total, msgid,
+					content)
+	return None
+
+
+def decrypt_job(job):
+	'''Decrypt a message in a worker process.
+	'''
+	binary, key, message = job
+	return ircrypt_core.decrypt_data(binary, key, message)
+
+
+class LogDecryptor:
+	'''Class used for decrypting a stream of log lines. Decrypted lines are
+	returned in the order of the input while up to window messages are
+	decrypted in parallel.
+	'''
+
+	def __init__(self, binary, keys, pool, window, log_format=None):
+		self.binary      = binary
+		self.keys        = ircrypt_core.PatternDict(keys)
+		self.pool        = pool
+		self.window      = window
+		self.log_format  = log_format
+		self.reassembler = ircrypt_core.DecodingReassembler()
+		self.sessions    = ircrypt_core.SessionCache()
+		self.pending     = collections.deque()
+		self.running     = 0
+		self.errors      = 0
+
+	def process(self, lines, server=None, channel=None):
+		'''Decrypt lines of one log. Lines are yielded as soon as they and all
+		lines before them are processed.
+		'''
+		for line in lines:
+			line = line.rstrip('\r\n')
+			pre = 'CRY2' if '>CRY2-' in line else 'CRY'
+			part = parse_line(line, self.log_format, pre)
+			if not part:
+				self.pending.append((line, None))
+			else:
+				before, nick, target, number, total, msgid, content = part
+				target = target or channel or nick
+				if not target or target[0] not in '#&':
+					target = nick
+				key = self.keys.match(('%s/%s' % (server, target)).lower())
+				# Lines of targets without key are passed through unchanged
+				if not key:
+					self.pending.append((line, None))
+					continue
+				try:
+					message = self.reassembler.update((server, target, nick, msgid,
+						pre), number, content, total=total, origin=nick)
+					if message is None:
+						continue
+					# Session keys are fast enough to be used right away
+					if pre == 'CRY2':
+						self.pending.append((before + ircrypt_core.decrypt_session(
+							self.sessions, '%s/%s' % (server, target), key, message,
+							nick), None))
+						continue
+				except ValueError as e:
+					self.errors += 1
+					sys.stderr.write('Could not decrypt message: %s\n' % e)
+					self.pending.append((before + '[undecryptable message]', None))
+					continue
+				self.pending.append((before, self.pool.apply_async(decrypt_job,
+					((self.binary, key, message),))))
+				self.running += 1
+			for result in self.flush(self.running >= self.window):
+				yield result
+		for result in self.flush(True, True):
+			yield result
+
+	def flush(self, wait, drain=False):
+		'''Yield lines from the front of the queue which are done. If wait is set,
+		wait until the first message is decrypted. If drain is set, wait until all
+		messages are decrypted.
+		'''
+		while self.pending:
+			before, result = self.pending[0]
+			if result is None:
+				self.pending.popleft()
+				yield before
+				continue
+			if not wait and not result.ready():
+				return
+			self.pending.popleft()
+			self.running -= 1
+			wait = drain
+			(ret, out, err) = result.get()
+			if ret:
+				self.errors += 1
+				sys.stderr.write('Could not decrypt message: %s\n' %
+						err.decode('utf-8', 'replace').strip())
+				yield before + '[undecryptable message]'
+			else:
+				yield before + out
+
+
+def main(argv=None):
+	'''Command line interface.
+	'''
+	parser = argparse.ArgumentParser(
+			description='Decrypt IRCrypt messages in IRC log files')
+	parser.add_argument('files', nargs='*', help='log files (default: stdin)')
+	parser.add_argument('-c', '--config', help='IRCrypt configuration file')
+	parser.add_argument('-s', '--server', help='server the log belongs to')
+	parser.add_argument('-t', '--target', help='channel or nick the log belongs '
+			'to (default: channel of the message or from WeeChat log file name)')
+	parser.add_argument('-k', '--key', help='key for server/target')
+	parser.add_argument('-f', '--format', choices=list(LOG_FORMATS),
+			help='log format (default: detect)')
+	parser.add_argument('-j', '--processes', type=int, default=0,
+			help='number of processes (default: number of CPU cores)')
+	parser.add_argument('-b', '--binary', help='GnuPG binary to use')
+	args = parser.parse_args(argv)
+
+	keys = read_keys(args.config) if args.config else {}
+	if args.key:
+		if not args.server or not args.target:
+			parser.error('--key requires --server and --target')
+		keys[('%s/%s' % (args.server, args.target)).lower()] = args.key
+
+	binary = args.binary or ircrypt_core.find_gpg_binary(('gpg', 'gpg2'))[0]
+	if not binary:
+		sys.stderr.write('GnuPG could not be found\n')
+		return 1
+
+	processes = args.processes or multiprocessing.cpu_count()
+	pool = multiprocessing.Pool(processes)
+	decryptor = LogDecryptor(binary, keys, pool, processes * WINDOW_PER_PROCESS,
+			args.format)
+	try:
+		for filename in args.files or ['-']:
+			server, target = weechat_log_target(filename)
+			server = args.server or server
+			target = args.target or target
+			f = sys.stdin if filename == '-' else open(filename)
+			try:
+				for line in decryptor.process(f, server, target):
+					sys.stdout.write(line + '\n')
+			finally:
+				if f is not sys.stdin:
+					f.close()
+	finally:
+		pool.close()
+		pool.join()
+	return 1 if decryptor.errors else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
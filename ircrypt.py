@@ -43,7 +43,11 @@
 #
 
 
-import weechat, string, os, subprocess, base64, time
+import weechat, string, os, base64, time, hashlib, collections
+import multiprocessing
+import ircrypt_core
+from ircrypt_core import MessageParts, MSG_PART_TIMEOUT, BurstMessage, \
+		DecryptionStream
 
 # Constants used in this script
 SCRIPT_NAME    = 'ircrypt'
@@ -59,18 +63,32 @@ remove-key         [-server <server>] <target>          Remove key for target
 set-cipher         [-server <server>] <target> <cipher> Set specific cipher for target
 remove-cipher      [-server <server>] <target>          Remove specific cipher for target
 plain              [-server <s>] [-channel <ch>] <msg>  Send unencrypted message
+cache              [clear]                              Show or clear decryption cache
+profile            start|stop|dump                      Profile hooks of IRCrypt
+trace              [<number>]                           Show slowest received messages
+memory                                                  Show memory used by IRCrypt
 
 %(bold)sExamples: %(normal)s
 Set the key for a channel:
    /ircrypt set-key -server freenet #IRCrypt key
 Remove the key:
    /ircrypt remove-key #IRCrypt
+Use a key for all channels starting with #team- on all servers and for
+everything else on freenode (the most specific key is used):
+   /ircrypt set-key -server * #team-* key
+   /ircrypt set-key -server freenode * otherkey
 Switch to a specific cipher for a channel:
    /ircrypt set-cipher -server freenode #IRCrypt TWOFISH
 Unset the specific cipher for a channel:
    /ircrypt remove-cipher #IRCrypt
 Send unencrypted “Hello” to current channel
    /ircrypt plain Hello
+Find out why WeeChat is slow in encrypted channels. The statistics are
+written to ircrypt_profile.txt (and ircrypt-keyex_profile.txt) in the WeeChat
+home directory:
+   /ircrypt profile start
+   /ircrypt profile dump
+   /ircrypt profile stop
 
 %(bold)sConfiguration: %(normal)s
 Tip: You can list all options and what they are currently set to by executing:
@@ -91,72 +109,295 @@ Tip: You can list all options and what they are currently set to by executing:
 %(bold)sircrypt.general.binary %(normal)s
    This will set the GnuPG binary used for encryption and decryption. IRCrypt
    will try to set this automatically.
+%(bold)sircrypt.general.backend %(normal)s
+   If set to gpgme, messages are decrypted using the Python bindings of GPGME
+   (module gpg) instead of calling the GnuPG binary directly. All other
+   operations and messages decrypted in parallel still use the GnuPG binary.
+   If the module is not installed, the GnuPG binary is used.
+%(bold)sircrypt.general.forward_parts %(normal)s
+   Long messages are split into several parts. By default, the last part is
+   sent first (>CRY-n). If this option is enabled, the first part is sent
+   first and each part contains the number of parts (>CRY-i/n). Receivers then
+   start decrypting the message with its first part and can display it right
+   after its last part arrives. IRCrypt reads both formats, but older versions
+   of IRCrypt cannot read messages sent this way.
+%(bold)sircrypt.general.message_ids %(normal)s
+   If this option is enabled, the parts of long messages are tagged with a
+   short message id (>CRY-id.n). Receivers reassemble each message on its own,
+   so several long messages can be received at once and a lost part affects
+   only its own message. IRCrypt reads messages with and without id, but
+   older versions of IRCrypt cannot read tagged messages.
+%(bold)sircrypt.general.session_keys %(normal)s
+   If this option is enabled, messages are not encrypted by GnuPG but with
+   AES-GCM (>CRY2-). The key is derived once from the passphrase of the
+   channel (e.g. one exchanged with ircrypt-keyex) and a new key is derived
+   from it every hour. Each message contains a counter and replayed messages
+   are rejected. This is much faster than starting GnuPG for every message,
+   but needs the Python module cryptography. Without it, messages are
+   encrypted by GnuPG. Older versions of IRCrypt cannot read these messages.
+   The option applies to all channels and is not negotiated with the other
+   users, so enable it only if everyone in your channels can read these
+   messages. Private messages are always encrypted by GnuPG. Messages played
+   back by a bouncer cannot be decrypted again. They are shown from the
+   decryption cache or as “[replayed message]”.
+%(bold)sircrypt.general.trace %(normal)s
+   If this option is enabled, the time each stage of the decryption of a
+   received message takes is recorded for the last 512 messages.
+   Use /ircrypt trace [<number>] to show the slowest of them per channel. The
+   stages are: parse (parsing the IRC message), key (key lookup), parts
+   (buffering and base64 decoding of the message parts), check (checking the
+   encrypted message and the cache), base64 (encoding for parallel
+   decryption), spawn (starting GnuPG), gpg (waiting for GnuPG), decrypt
+   (session keys) and output (waiting for earlier messages to be displayed).
+%(bold)sircrypt.general.store %(normal)s
+   If set, keys and channel specific ciphers are stored in this SQLite
+   database instead of the configuration file (%%h is replaced by the WeeChat
+   home). Every change is written to the database immediately. Keys and
+   ciphers found in the configuration file are moved to the database. The
+   public key identifiers of ircrypt-keyex are stored in the same database.
+   Clear the option to move them back to the configuration files, e.g.:
+      /set ircrypt.general.store %%h/ircrypt.db
+%(bold)sircrypt.metrics.file %(normal)s
+   If set, metrics are written to this file in the Prometheus text format
+   every ircrypt.metrics.interval seconds. This includes latency histograms for
+   encryption and decryption, the number of started GnuPG processes and failed
+   decryptions, partially received messages and active key exchanges, all
+   labeled by server. The file is replaced atomically and can be read by the
+   textfile collector of the Prometheus node exporter, e.g.:
+      /set ircrypt.metrics.file /var/lib/node_exporter/ircrypt.prom
+%(bold)sircrypt.burst.threshold %(normal)s
+   If more encrypted messages than this arrive within one second (e.g. when
+   joining many channels or when a bouncer plays back a backlog), they are
+   decrypted by several GnuPG processes running in parallel. The messages are
+   displayed in the order they were received. Set to 0 to always decrypt
+   messages one after another.
+%(bold)sircrypt.burst.processes %(normal)s
+   Maximum number of GnuPG processes used for decrypting a burst of messages
+   and messages sent first part first while they are received. At most two of
+   the latter are decrypted per sender. If set to 0, the number of CPU cores is
+   used.
+%(bold)sircrypt.cache.size %(normal)s
+   Number of decrypted messages kept in memory. If the same encrypted message
+   is received again (e.g. as backlog played back by a bouncer), it is not
+   decrypted again. Set to 0 to disable the cache.
+%(bold)sircrypt.cache.persistent %(normal)s
+   Store the decryption cache on disk when the script is unloaded. The cache
+   file is encrypted with the passphrase set in ircrypt.cache.passphrase.
+%(bold)sircrypt.cache.passphrase %(normal)s
+   Passphrase for the cache file. The value is evaluated, so you can use
+   secured data like “${sec.data.ircrypt_cache}”.
 ''' % {'bold':weechat.color('bold'), 'normal':weechat.color('-bold')}
 
-MAX_PART_LEN     = 300
-MSG_PART_TIMEOUT = 300 # 5min
+MAX_PART_LEN     = ircrypt_core.MAX_PART_LEN
+BURST_TIMEOUT    = 30  # seconds
+INIT_TIMEOUT     = 30  # seconds
+
+# Failed decryptions of messages from one sender after which further messages
+# from that sender are not decrypted for some time. The time doubles with every
+# further failure.
+BREAKER_FAILURES    = 3
+BREAKER_BACKOFF     = 30   # seconds
+BREAKER_MAX_BACKOFF = 3600 # seconds
+UNDECRYPTABLE       = '[undecryptable message]'
+
+# Shown instead of messages encrypted with a session key which are played back
+# (e.g. by a bouncer) but are not in the decryption cache anymore
+REPLAYED = '[replayed message]'
+
+# Number of senders whose cipher is shown by /ircrypt list
+SENDER_CIPHERS = 1000
+
+# Number of messages per sender decrypted while they are received
+STREAMS_PER_SENDER = 2
+
+# Length of the lines of ASCII armored messages passed to GnuPG. A multiple of
+# four, so that every message part can be passed on its own.
+ARMOR_LINE_LEN = 60
+
+# Number of different message ids used for long messages
+MESSAGE_IDS = 16 ** ircrypt_core.MSGID_LEN
+
+# Number of message traces kept for /ircrypt trace
+TRACE_SIZE = 512
+
+# Upper bounds of the buckets of the exported latency histograms (seconds)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
 
 # Global variables and memory used to store message parts, pending requests,
 # configuration options, keys, etc.
 ircrypt_msg_memory       = {}
+ircrypt_reassembler      = ircrypt_core.DecodingReassembler(ircrypt_msg_memory)
 ircrypt_config_file      = None
 ircrypt_config_section   = {}
 ircrypt_config_option    = {}
-ircrypt_keys             = {}
-ircrypt_cipher           = {}
+ircrypt_keys             = ircrypt_core.PatternDict()
+ircrypt_cipher           = ircrypt_core.PatternDict()
+ircrypt_store            = None
+ircrypt_config_reading   = False
 ircrypt_message_plain    = {}
-
-
-class MessageParts:
-	'''Class used for storing parts of messages which were split after
-	encryption due to their length.'''
-
-	modified = 0
-	last_id  = None
-	message  = ''
-
-	def update(self, id, msg):
-		'''This method updates an already existing message part by adding a new
-		part to the old ones and updating the identifier of the latest received
-		message part.
-		'''
-		# Check if id is correct. If not, throw away old parts:
-		if self.last_id and self.last_id != id+1:
-			self.message = ''
-		# Check if the are old message parts which belong due to their old age
-		# probably not to this message:
-		if time.time() - self.modified > MSG_PART_TIMEOUT:
-			self.message = ''
-		self.last_id = id
-		self.message = msg + self.message
-		self.modified = time.time()
+ircrypt_decrypt_cache    = collections.OrderedDict()
+ircrypt_cache_stats      = {'hits': 0, 'misses': 0}
+ircrypt_burst            = ircrypt_core.Burst()
+ircrypt_breakers         = {}
+ircrypt_sender_ciphers   = collections.OrderedDict()
+ircrypt_streams          = ircrypt_core.Streams()
+ircrypt_message_count    = 0
+ircrypt_sessions         = ircrypt_core.SessionCache()
+ircrypt_metrics          = {}
+ircrypt_latencies        = {}
+ircrypt_metrics_timer    = None
+ircrypt_traces           = collections.deque(maxlen=TRACE_SIZE)
+ircrypt_ready            = True
+ircrypt_pending          = []
+ircrypt_binary_output    = {}
+ircrypt_profiler         = ircrypt_core.Profiler(globals(),
+		('ircrypt_decrypt_hook', 'ircrypt_encrypt_hook',
+			'ircrypt_encryption_statusbar'))
+
+
+class CircuitBreaker:
+	'''Class used for tracking failed decryptions of messages from one sender.
+	If decrypting fails repeatedly, further messages are not decrypted until
+	blocked_until is reached. The sender is forgotten once the last failure is
+	longer ago than the maximum backoff.'''
+
+	failures      = 0
+	blocked_until = 0
+	suppressed    = 0
+	modified      = 0
+
+
+def ircrypt_gpg_binary():
+	'''Get the GnuPG binary used by IRCrypt and its addons.
+	'''
+	return weechat.config_string(weechat.config_get('ircrypt.general.binary'))
 
 
 def ircrypt_gnupg(stdin, *args):
-	'''Try to execute gpg with given input and options.
+	'''Try to execute gpg with given input and options. If GPGME is selected
+	as backend, it is used for decrypting symmetrically encrypted messages.
+	All other operations, including those of ircrypt-keyex, call the GnuPG
+	binary.
 
 	:param stdin: Input for GnuPG
 	:param  args: Additional command line options for GnuPG
 	:returns:     Tuple containing returncode, stdout and stderr
 	'''
-	gnupg = weechat.config_string(weechat.config_get('ircrypt.general.binary'))
-	if not gnupg:
-		return (99, '', 'GnuPG could not be found')
-	p = subprocess.Popen(
-			[gnupg, '--batch',  '--no-tty'] + list(args),
-			stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate(stdin)
-	return (p.returncode, out, err)
+	if weechat.config_string(weechat.config_get('ircrypt.general.backend')) \
+			== 'gpgme':
+		result = ircrypt_core.gpgme(stdin, *args)
+		if result:
+			return result
+	return ircrypt_core.gnupg(ircrypt_gpg_binary(), stdin, *args)
 
 
-def ircrypt_split_msg(cmd, pre, msg):
+def ircrypt_cache_get(digest):
+	'''Get a decrypted message from the decryption cache. The entry is marked
+	as recently used.
+
+	:param digest: Hash of the passphrase and the encrypted message
+	:returns: The decrypted message or None
+	'''
+	try:
+		plain = ircrypt_decrypt_cache.pop(digest)
+	except KeyError:
+		ircrypt_cache_stats['misses'] += 1
+		return None
+	ircrypt_decrypt_cache[digest] = plain
+	ircrypt_cache_stats['hits'] += 1
+	return plain
+
+
+def ircrypt_cache_put(digest, plain):
+	'''Add a decrypted message to the decryption cache and remove the least
+	recently used entries if the cache is full.
+	'''
+	size = weechat.config_integer(ircrypt_config_option['cache_size'])
+	if size <= 0:
+		return
+	ircrypt_decrypt_cache.pop(digest, None)
+	ircrypt_decrypt_cache[digest] = plain
+	while len(ircrypt_decrypt_cache) > size:
+		ircrypt_decrypt_cache.popitem(last=False)
+
+
+def ircrypt_cache_file():
+	'''Get path of the persistent decryption cache.
+	'''
+	return '%s/ircrypt_cache.gpg' % weechat.info_get('weechat_dir', '')
+
+
+def ircrypt_cache_passphrase():
+	'''Get passphrase for the persistent cache or None if the cache should not
+	be stored on disk.
+	'''
+	if not weechat.config_boolean(ircrypt_config_option['cache_persistent']):
+		return None
+	passphrase = weechat.string_eval_expression(weechat.config_string(
+		ircrypt_config_option['cache_passphrase']), {}, {}, {})
+	if not passphrase:
+		ircrypt_warn('ircrypt.cache.persistent is set, but no passphrase is '
+				'configured. The decryption cache is not stored.')
+		return None
+	return passphrase.encode('utf-8')
+
+
+def ircrypt_cache_load():
+	'''Load the persistent decryption cache from disk.
+	'''
+	passphrase = ircrypt_cache_passphrase()
+	if not passphrase:
+		return
+	try:
+		with open(ircrypt_cache_file(), 'rb') as f:
+			data = f.read()
+	except IOError:
+		return
+	(ret, out, err) = ircrypt_gnupg(passphrase + b'\n' + data,
+			'--passphrase-fd', '-', '-q', '-d')
+	if ret:
+		ircrypt_error('Could not load decryption cache:\n' + err.decode('utf-8'), '')
+		return
+	for line in out.decode('utf-8').split('\n'):
+		try:
+			digest, plain = line.split(' ', 1)
+			ircrypt_cache_put(digest, base64.b64decode(plain).decode('utf-8'))
+		except (ValueError, TypeError):
+			pass
+
+
+def ircrypt_cache_save():
+	'''Write the decryption cache encrypted to disk.
+	'''
+	passphrase = ircrypt_cache_passphrase()
+	if not passphrase:
+		return
+	data = '\n'.join(['%s %s' % (digest,
+		base64.b64encode(plain.encode('utf-8')).decode('ascii'))
+		for digest, plain in ircrypt_decrypt_cache.items()])
+	(ret, out, err) = ircrypt_gnupg(passphrase + b'\n' + data.encode('utf-8'),
+			'--symmetric', '--passphrase-fd', '-', '-q')
+	if ret:
+		ircrypt_error('Could not save decryption cache:\n' + err.decode('utf-8'), '')
+		return
+	fd = os.open(ircrypt_cache_file(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	with os.fdopen(fd, 'wb') as f:
+		f.write(out)
+
+
+def ircrypt_split_msg(cmd, pre, msg, forward=False, msgid=None):
 	'''Convert encrypted message in MAX_PART_LEN sized blocks
 	'''
-	msg = msg.rstrip()
-	return '\n'.join(['%s:>%s-%i %s' %
-		(cmd, pre, i // MAX_PART_LEN, msg[i:i+MAX_PART_LEN])
-		for i in range(0, len(msg), MAX_PART_LEN)][::-1])
+	return ircrypt_core.split(cmd, pre, msg, MAX_PART_LEN, forward, msgid)
+
+
+def ircrypt_message_id():
+	'''Get a new id for a message split into several parts.
+	'''
+	global ircrypt_message_count
+	ircrypt_message_count = (ircrypt_message_count + 1) % MESSAGE_IDS
+	return '%x' % ircrypt_message_count
 
 
 def ircrypt_error(msg, buf):
@@ -194,74 +435,695 @@ def ircrypt_decrypt_hook(data, msgtype, server, args):
 	:param server: IRC server the message comes from.
 	:param args: IRC command line-
 	'''
+	# Pass through messages we decrypted in parallel processes
+	if ircrypt_burst.passthrough(args):
+		return args
+
+	trace = ircrypt_trace_start()
 	info = weechat.info_get_hashtable('irc_message_parse', { 'message': args })
 
 	# Check if channel is own nick and if change channel to nick of sender
 	if info['channel'][0] not in '#&':
 		info['channel'] = info['nick']
+	ircrypt_trace(trace, 'parse')
 
 	# Get key
-	key = ircrypt_keys.get(('%s/%s' % (server, info['channel'])).lower())
+	target = ('%s/%s' % (server, info['channel'])).lower()
+	key = ircrypt_keys.match(target)
+	ircrypt_trace(trace, 'key')
 
 	# Return everything as it is if we have no key
 	if not key:
 		return args
 
+	if '>CRY2-' in args:
+		return ircrypt_decrypt_session(server, info, key, args, trace)
+
 	if not '>CRY-' in args:
 		# if key exisits and no >CRY not part of message flag message as unencrypted
 		pre, message = args.split(' :', 1)
 		marker = weechat.config_string(ircrypt_config_option['unencrypted'])
 		return '%s :%s %s' % (pre, marker, message)
 
-	# if key exists and >CRY part of message start symmetric encryption
-	pre, message    = args.split('>CRY-', 1)
-	number, message = message.split(' ', 1 )
+	# Receive the message again once GnuPG is found
+	if not ircrypt_ready:
+		ircrypt_pending.append((weechat.buffer_search('irc', 'server.%s' % server),
+			'/server fakerecv %s' % args))
+		return ''
 
-	# Get key for the message memory
-	catchword = '%s.%s.%s' % (server, info['channel'], info['nick'])
+	# if key exists and >CRY part of message start symmetric encryption
+	part = ircrypt_core.parse_part(args)
+	if not part:
+		return args
+	pre, number, total, msgid, content = part
+
+	# Get key for the message memory. Parts of messages with an id are
+	# reassembled independent of other messages of the sender.
+	catchword = (server, info['channel'], info['nick'], msgid)
+
+	# Messages sent first part first are decrypted while they are received
+	stream = None
+	if total and total > 1:
+		if number == total - 1:
+			stream = ircrypt_streams.pop(catchword, None)
+		elif number or ircrypt_stream_check(server, info['nick'], content):
+			ircrypt_stream_part(catchword, key, number, content)
+		else:
+			ircrypt_stream_stop(ircrypt_streams.pop(catchword, None))
 
 	# Decrypt only if we got last part of the message
-	# otherwise put the message into a global memory and quit
-	if int(number) != 0:
-		if not catchword in ircrypt_msg_memory:
-			ircrypt_msg_memory[catchword] = MessageParts()
-		ircrypt_msg_memory[catchword].update(int(number), message)
-		return ''
-
-	# Get whole message
+	# otherwise put the message into a global memory and quit. Parts are base64
+	# decoded on arrival into a buffer starting with the passphrase for GnuPG.
+	prefix = ircrypt_core.passphrase_prefix(key)
 	try:
-		message = message + ircrypt_msg_memory[catchword].message
-		del ircrypt_msg_memory[catchword]
-	except KeyError:
-		pass
+		message = ircrypt_reassembler.update(catchword, number, content, prefix,
+				total, (server, info['nick'].lower()))
+	except ValueError:
+		ircrypt_stream_stop(stream or ircrypt_streams.pop(catchword, None))
+		ircrypt_breaker_failure(server, info['nick'],
+				'Could not Base64 decode message.',
+				weechat.buffer_search('irc', '%s.%s' % (server,info['channel'])))
+		return args
+	if message is None:
+		return ''
+	ircrypt_trace(trace, 'parts')
 
 	# Get message buffer in case we need to print an error
 	buf = weechat.buffer_search('irc', '%s.%s' % (server,info['channel']))
 
-	# Decode base64 encoded message
+	# Reject malformed messages without starting GnuPG
+	encrypted = memoryview(message)[len(prefix):]
 	try:
-		message = base64.b64decode(message)
-	except:
-		ircrypt_error('Could not Base64 decode message.', buf)
+		packet = ircrypt_core.inspect(encrypted)
+	except ValueError as e:
+		ircrypt_stream_stop(stream)
+		ircrypt_breaker_failure(server, info['nick'],
+				'Invalid encrypted message: %s' % e, buf)
 		return args
+	ircrypt_sender_cipher(server, info['nick'], packet)
+
+	# Check if we already decrypted this message using the same key
+	digest = hashlib.sha256(message).hexdigest()
+	plain = ircrypt_cache_get(digest)
+	ircrypt_trace(trace, 'check')
+
+	# Do not even try to decrypt if decryption of messages from this sender
+	# failed repeatedly
+	if plain is None and ircrypt_breaker_open(server, info['nick']):
+		ircrypt_stream_stop(stream)
+		return pre + UNDECRYPTABLE
+
+	# Pass the last part to the GnuPG process which is already decrypting the
+	# message. The message is displayed once the process is finished.
+	if stream and plain is None and stream.returncode is None:
+		msg = BurstMessage(server, info['channel'], info['nick'], args, pre, key,
+				None, digest)
+		msg.trace = trace
+		ircrypt_stream_close(stream, content, msg)
+		return ''
+	ircrypt_stream_stop(stream)
+
+	# Decrypt in parallel processes if encrypted messages pile up
+	if ircrypt_burst_active(server, info['channel']):
+		encoded = base64.b64encode(encrypted.tobytes()).decode('ascii')
+		ircrypt_trace(trace, 'base64')
+		msg = BurstMessage(server, info['channel'], info['nick'], args, pre, key,
+				encoded, digest)
+		msg.trace = trace
+		ircrypt_burst_add(msg, plain)
+		return ''
 
-	# Decrypt
-	try:
-		message = (key).encode('utf-8') + b'\n' + message
-	except:
-		# For Python 2.x
-		message = key + b'\n' + message
+	if plain is not None:
+		ircrypt_trace_done(trace, target)
+		return pre + plain
+
+	started = time.time()
+	ircrypt_metric_inc('gpg_spawns', server)
 	(ret, out, err) = ircrypt_gnupg(message,
 			'--passphrase-fd', '-', '-q', '-d')
 
 	# Get and print GPG errors/warnings
 	if ret:
-		ircrypt_error(err.decode('utf-8'), buf)
+		ircrypt_breaker_failure(server, info['nick'], err.decode('utf-8'), buf)
 		return args
 	if err:
 		ircrypt_warn(err.decode('utf-8'))
 
-	return pre + out.decode('utf-8')
+	ircrypt_metric_observe('decrypt', server, time.time() - started)
+	ircrypt_trace(trace, 'gpg')
+	ircrypt_breaker_reset(server, info['nick'])
+	plain = out.decode('utf-8')
+	ircrypt_cache_put(digest, plain)
+	ircrypt_trace_done(trace, target)
+	return pre + plain
+
+
+def ircrypt_decrypt_session(server, info, key, args, trace=None):
+	'''Decrypt a message encrypted with a session key (>CRY2-).
+
+	:param server: IRC server the message comes from
+	:param   info: Parsed IRC message
+	:param    key: Passphrase of the channel
+	:param   args: IRC command line
+	:param  trace: Trace of the message (see ircrypt_trace_start)
+	'''
+	part = ircrypt_core.parse_part(args, 'CRY2')
+	if not part:
+		return args
+	pre, number, total, msgid, content = part
+
+	catchword = (server, info['channel'], info['nick'], msgid, 'CRY2')
+	target = ('%s/%s' % (server, info['channel'])).lower()
+	buf = weechat.buffer_search('irc', '%s.%s' % (server,info['channel']))
+	try:
+		message = ircrypt_reassembler.update(catchword, number, content,
+				total=total, origin=(server, info['nick'].lower()))
+		if message is None:
+			return ''
+		ircrypt_trace(trace, 'parts')
+
+		# Messages played back e.g. by a bouncer cannot be decrypted again. They
+		# are shown from the cache, which is bound to target and sender as well.
+		digest = hashlib.sha256(('%s %s\n' % (target, info['nick'].lower()))
+				.encode('utf-8') + ircrypt_core.passphrase_prefix(key) +
+				bytes(message)).hexdigest()
+		plain = ircrypt_cache_get(digest)
+		ircrypt_trace(trace, 'check')
+		if plain is None:
+			if not ircrypt_core.AESGCM:
+				raise ValueError('The Python module cryptography is not installed')
+			started = time.time()
+			plain = ircrypt_session(target, key).decrypt(message, nick=info['nick'])
+			ircrypt_metric_observe('decrypt', server, time.time() - started)
+			ircrypt_trace(trace, 'decrypt')
+			ircrypt_cache_put(digest, plain)
+	except (ircrypt_core.ReplayError, ircrypt_core.EpochError):
+		# Played back e.g. by a bouncer. This is no failure of the sender.
+		plain = REPLAYED
+	except ValueError as e:
+		ircrypt_breaker_failure(server, info['nick'],
+				'Could not decrypt message: %s' % e, buf)
+		return args
+
+	# Keep the order if messages of this channel are still being decrypted
+	if ircrypt_burst.queues.get('%s.%s' % (server, info['channel'])):
+		msg = BurstMessage(server, info['channel'], info['nick'], args, pre, key,
+				None, None)
+		msg.trace = trace
+		ircrypt_burst_add(msg, plain)
+		return ''
+	ircrypt_trace_done(trace, target)
+	return pre + plain
+
+
+def ircrypt_session(target, key):
+	'''Get the session used for encrypting messages for target with the session
+	key derived from key. The session is created again if the key changed.
+	'''
+	return ircrypt_sessions.session(target, key)
+
+
+def ircrypt_sender_cipher(server, nick, packet):
+	'''Remember the cipher and S2K parameters used by the sender of a message.
+	Only the SENDER_CIPHERS senders who sent a message most recently are kept.
+
+	:param packet: Description of the message as returned by
+	               ircrypt_core.inspect
+	'''
+	cipher = '%(cipher)s (%(s2k)s %(hash)s' % packet
+	if packet['count']:
+		cipher += ', %i bytes' % packet['count']
+	cipher += ', %s)' % packet['packet']
+	sender = '%s/%s' % (server, nick.lower())
+	messages = ircrypt_sender_ciphers.pop(sender, (None, 0))[1]
+	ircrypt_sender_ciphers[sender] = (cipher, messages + 1)
+	while len(ircrypt_sender_ciphers) > SENDER_CIPHERS:
+		ircrypt_sender_ciphers.popitem(last=False)
+
+
+def ircrypt_breaker_open(server, nick):
+	'''Check if messages from nick should not be decrypted since decryption
+	failed repeatedly.
+	'''
+	breaker = ircrypt_breakers.get((server, nick.lower()))
+	if not breaker or time.time() >= breaker.blocked_until:
+		return False
+	breaker.suppressed += 1
+	return True
+
+
+def ircrypt_breaker_failure(server, nick, err, buf):
+	'''Remember a failed decryption of a message from nick and print the error.
+	Once decryption failed repeatedly, single errors are no longer printed.
+	Instead, a summary is printed and further messages from nick are not
+	decrypted for some time.
+	'''
+	ircrypt_metric_inc('decrypt_failures', server)
+	now = time.time()
+	breaker = ircrypt_breakers.get((server, nick.lower()))
+	if not breaker:
+		ircrypt_breaker_expire(now)
+		breaker = ircrypt_breakers[(server, nick.lower())] = CircuitBreaker()
+	breaker.modified = now
+	if now < breaker.blocked_until:
+		breaker.suppressed += 1
+		return
+	breaker.failures += 1
+	if breaker.failures < BREAKER_FAILURES:
+		ircrypt_error(err, buf)
+		return
+	backoff = min(BREAKER_BACKOFF * 2 ** (breaker.failures - BREAKER_FAILURES),
+			BREAKER_MAX_BACKOFF)
+	breaker.blocked_until = now + backoff
+	ircrypt_error('Could not decrypt %i messages from %s (%i more were ignored). '
+			'Encrypted messages from %s will not be decrypted for %i seconds.' %
+			(breaker.failures, nick, breaker.suppressed, nick, backoff), buf)
+
+
+def ircrypt_breaker_expire(now=None):
+	'''Forget senders whose last failed decryption is longer ago than the
+	maximum backoff and who are not blocked anymore.
+	'''
+	now = time.time() if now is None else now
+	for sender in [sender for sender, breaker in ircrypt_breakers.items()
+			if now - breaker.modified > BREAKER_MAX_BACKOFF
+			and now >= breaker.blocked_until]:
+		del ircrypt_breakers[sender]
+
+
+def ircrypt_breaker_reset(server=None, nick=None):
+	'''Forget failed decryptions of messages from nick on server. If no nick
+	is given, all senders on server are reset. If no server is given, all
+	senders are reset.
+	'''
+	for (breaker_server, breaker_nick) in list(ircrypt_breakers):
+		if server in (None, breaker_server) \
+				and (nick is None or nick.lower() == breaker_nick):
+			del ircrypt_breakers[(breaker_server, breaker_nick)]
+
+
+def ircrypt_burst_active(server, channel):
+	'''Check if a message should be decrypted in burst mode. This is the case
+	if more encrypted messages than the configured threshold arrived within the
+	last second or if there are still messages for this channel queued.
+	'''
+	threshold = weechat.config_integer(ircrypt_config_option['burst_threshold'])
+	return ircrypt_burst.active('%s.%s' % (server, channel), threshold)
+
+
+def ircrypt_burst_add(msg, plain=None):
+	'''Queue a message for decryption in burst mode. The message is displayed
+	once it and all messages of the same channel received before are
+	decrypted.
+
+	:param msg: BurstMessage to decrypt
+	:param plain: Already known plain text (e.g. from the cache)
+	'''
+	ircrypt_burst.add('%s.%s' % (msg.server, msg.channel), msg, plain is None)
+	if plain is not None:
+		msg.result = msg.pre + plain
+		ircrypt_burst_flush(msg.server, msg.channel)
+	else:
+		ircrypt_burst_spawn()
+
+
+def ircrypt_burst_processes():
+	'''Get the maximum number of GnuPG processes used in burst mode.
+	'''
+	processes = weechat.config_integer(ircrypt_config_option['burst_processes'])
+	if processes > 0:
+		return processes
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+
+def ircrypt_burst_spawn():
+	'''Start GnuPG processes for waiting messages as long as the maximum number
+	of processes is not reached. The encrypted message is passed to GnuPG ASCII
+	armored, since only text can be written to the stdin of a process hook.
+	'''
+	while True:
+		msg = ircrypt_burst.next(ircrypt_burst_processes() -
+				len(ircrypt_streams.running))
+		if not msg:
+			return
+		hook = ircrypt_gpg_process(msg.key, 'ircrypt_burst_process_cb',
+				msg.digest)
+		if not hook:
+			msg.result = msg.args
+			ircrypt_burst_flush(msg.server, msg.channel)
+			continue
+		ircrypt_metric_inc('gpg_spawns', msg.server)
+		ircrypt_trace(msg.trace, 'spawn')
+		ircrypt_burst.running[msg.digest] = msg
+		weechat.hook_set(hook, 'stdin', ircrypt_armor(msg.encoded) +
+				'-----END PGP MESSAGE-----\n')
+		weechat.hook_set(hook, 'stdin_close', '')
+
+
+def ircrypt_gpg_process(key, callback, data):
+	'''Start a GnuPG process decrypting an ASCII armored message passed to its
+	stdin. The passphrase and the armor header are passed right away.
+
+	:param      key: Passphrase
+	:param callback: Name of the function getting the output of the process
+	:param     data: Data passed to the callback
+	:returns:        Process hook
+	'''
+	hook = weechat.hook_process_hashtable(ircrypt_gpg_binary(), {
+		'stdin': '1',
+		'arg1': '--batch',
+		'arg2': '--no-tty',
+		'arg3': '--passphrase-fd',
+		'arg4': '-',
+		'arg5': '-q',
+		'arg6': '-d'},
+		BURST_TIMEOUT * 1000, callback, data)
+	if hook:
+		weechat.hook_set(hook, 'stdin', '%s\n-----BEGIN PGP MESSAGE-----\n\n' % key)
+	return hook
+
+
+def ircrypt_armor(encoded):
+	'''Split base64 encoded data into lines of an ASCII armored message.
+	'''
+	return ''.join([encoded[i:i+ARMOR_LINE_LEN] + '\n'
+		for i in range(0, len(encoded), ARMOR_LINE_LEN)])
+
+
+def ircrypt_burst_process_cb(data, command, returncode, out, err):
+	'''Callback for GnuPG processes decrypting messages in burst mode.
+	'''
+	msg = ircrypt_burst.running.get(data)
+	if not msg:
+		return weechat.WEECHAT_RC_OK
+	msg.out += out
+	msg.err += err
+	if returncode == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+		return weechat.WEECHAT_RC_OK
+	del ircrypt_burst.running[data]
+	ircrypt_burst_done(msg, returncode)
+	ircrypt_burst_spawn()
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_burst_done(msg, returncode):
+	'''Handle the result of a GnuPG process decrypting a message
+	asynchronously and display all messages of the channel which are ready.
+	'''
+	ircrypt_trace(msg.trace, 'gpg')
+
+	# Get and print GPG errors/warnings
+	buf = weechat.buffer_search('irc', '%s.%s' % (msg.server, msg.channel))
+	if returncode:
+		ircrypt_breaker_failure(msg.server, msg.nick, msg.err or 'GnuPG failed',
+				buf)
+		msg.result = msg.args
+	else:
+		if msg.err:
+			ircrypt_warn(msg.err)
+		ircrypt_breaker_reset(msg.server, msg.nick)
+		ircrypt_cache_put(msg.digest, msg.out)
+		ircrypt_metric_observe('decrypt', msg.server, time.time() - msg.started)
+		msg.result = msg.pre + msg.out
+	ircrypt_burst_flush(msg.server, msg.channel)
+
+
+def ircrypt_stream_check(server, nick, content):
+	'''Check if GnuPG may be started to decrypt a message while it is received.
+	This is not done if decryption of messages from the sender failed
+	repeatedly or if the first part does not look like the beginning of an
+	encrypted message. Such messages are handled once they are complete.
+
+	:param  server: IRC server the message comes from
+	:param    nick: Sender of the message
+	:param content: Base64 encoded content of the first message part
+	'''
+	if ircrypt_breaker_open(server, nick):
+		return False
+	# Do not start more processes than in burst mode
+	if ircrypt_streams.full((server, nick.lower()), STREAMS_PER_SENDER,
+			ircrypt_burst_processes() - len(ircrypt_burst.running)):
+		return False
+	try:
+		ircrypt_core.inspect(ircrypt_core.b64decode(content), complete=False)
+	except ValueError:
+		return False
+	return True
+
+
+def ircrypt_stream_part(catchword, key, number, content):
+	'''Pass a part of a message sent first part first to the GnuPG process
+	decrypting it. The process is started with the first part. If a part is
+	missing, the process is stopped and the message is decrypted once it is
+	complete.
+
+	:param catchword: Identifier of the sender
+	:param       key: Passphrase
+	:param    number: Number of the message part
+	:param   content: Base64 encoded content of the message part
+	'''
+	stream = ircrypt_streams.pop(catchword, None)
+	if number == 0:
+		ircrypt_stream_stop(stream)
+		stream = DecryptionStream(None, None)
+		stream.hook = ircrypt_gpg_process(key, 'ircrypt_stream_process_cb',
+				stream.name)
+		if not stream.hook:
+			return
+		ircrypt_metric_inc('gpg_spawns', catchword[0])
+		ircrypt_streams.start(catchword, stream,
+				(catchword[0], catchword[2].lower()))
+	elif not stream or stream.next != number or stream.returncode is not None:
+		ircrypt_stream_stop(stream)
+		return
+	stream.next = number + 1
+	weechat.hook_set(stream.hook, 'stdin', ircrypt_armor(content))
+	ircrypt_streams[catchword] = stream
+
+
+def ircrypt_stream_close(stream, content, msg):
+	'''Pass the last part of a message to the GnuPG process decrypting it.
+	Messages received afterwards in the same channel are queued until the
+	decrypted message is displayed.
+
+	:param  stream: DecryptionStream of the message
+	:param content: Base64 encoded content of the last message part
+	:param     msg: BurstMessage the result is stored in
+	'''
+	stream.msg = msg
+	ircrypt_burst.queue('%s.%s' % (msg.server, msg.channel), msg)
+	weechat.hook_set(stream.hook, 'stdin', ircrypt_armor(content) +
+			'-----END PGP MESSAGE-----\n')
+	weechat.hook_set(stream.hook, 'stdin_close', '')
+
+
+def ircrypt_stream_stop(stream):
+	'''Stop the GnuPG process of a stream which is not needed anymore.
+	'''
+	if stream and ircrypt_streams.stop(stream):
+		weechat.unhook(stream.hook)
+
+
+def ircrypt_stream_process_cb(data, command, returncode, out, err):
+	'''Callback for GnuPG processes decrypting messages while they are
+	received.
+	'''
+	stream = ircrypt_streams.running.get(data)
+	if not stream:
+		return weechat.WEECHAT_RC_OK
+	stream.out += out
+	stream.err += err
+	if returncode == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+		return weechat.WEECHAT_RC_OK
+	ircrypt_streams.finish(data, returncode)
+
+	# If the process ended before the message was complete, the message is
+	# decrypted the usual way once it is complete. If the rest of the message
+	# was not received in time, this counts as failure of the sender.
+	if stream.msg:
+		stream.msg.out = stream.out
+		stream.msg.err = stream.err
+		ircrypt_burst_done(stream.msg, returncode)
+	elif returncode == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+		server, channel, nick = stream.key[:3]
+		ircrypt_breaker_failure(server, nick, 'Message from %s was not completed '
+				'within %i seconds' % (nick, BURST_TIMEOUT),
+				weechat.buffer_search('irc', '%s.%s' % (server, channel)))
+	ircrypt_burst_spawn()
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_burst_flush(server, channel):
+	'''Display all decrypted messages of a channel for which all previously
+	received messages are decrypted as well. The messages are passed to WeeChat
+	again as if they were received from the server.
+	'''
+	server_buffer = weechat.buffer_search('irc', 'server.%s' % server)
+	for msg in ircrypt_burst.ready('%s.%s' % (server, channel)):
+		ircrypt_trace_done(msg.trace, ('%s/%s' % (server, channel)).lower())
+		weechat.command(server_buffer, '/server fakerecv %s' % msg.result)
+
+	# Report time needed for the burst once everything is decrypted
+	if not ircrypt_burst.busy() and ircrypt_burst.messages:
+		ircrypt_info('Decrypted %i messages in %.2f seconds using up to %i '
+				'processes' % (ircrypt_burst.messages,
+					time.time() - ircrypt_burst.started,
+					ircrypt_burst_processes()), '')
+		ircrypt_burst.messages = 0
+
+
+def ircrypt_trace_start():
+	'''Start the trace of a received message if tracing is enabled. A trace is
+	a list of stages of the decryption and the time each stage ended at.
+
+	:returns: New trace or None
+	'''
+	if not weechat.config_boolean(ircrypt_config_option['trace']):
+		return None
+	return [('received', time.time())]
+
+
+def ircrypt_trace(trace, stage):
+	'''Record the end of a stage of the decryption of a message.
+	'''
+	if trace is not None:
+		trace.append((stage, time.time()))
+
+
+def ircrypt_trace_done(trace, target):
+	'''Store the trace of a message which is displayed now. Only the last
+	TRACE_SIZE traces are kept.
+	'''
+	if trace is not None:
+		trace.append(('output', time.time()))
+		ircrypt_traces.append((target, trace))
+
+
+def ircrypt_metric_inc(name, server, value=1):
+	'''Increase a counter exported as metric.
+	'''
+	ircrypt_metrics[(name, server)] = ircrypt_metrics.get((name, server), 0) + value
+
+
+def ircrypt_metric_observe(operation, server, seconds):
+	'''Add the time needed for an operation to the exported latency histogram.
+	The list stored per operation and server contains the number of
+	observations per bucket followed by the sum of all observations.
+	'''
+	histogram = ircrypt_latencies.setdefault((operation, server),
+			[0] * (len(LATENCY_BUCKETS) + 2))
+	for i, bound in enumerate(LATENCY_BUCKETS):
+		if seconds <= bound:
+			histogram[i] += 1
+			break
+	else:
+		histogram[len(LATENCY_BUCKETS)] += 1
+	histogram[-1] += seconds
+
+
+def ircrypt_metrics_text():
+	'''Get all metrics in the Prometheus text format.
+	'''
+	def labels(server, **extra):
+		server = server.replace('\\', '\\\\').replace('"', '\\"')
+		return '{%s}' % ','.join(['server="%s"' % server] +
+				['%s="%s"' % x for x in sorted(extra.items())])
+
+	lines = []
+	def metric(name, kind, helptext, values):
+		lines.append('# HELP ircrypt_%s %s' % (name, helptext))
+		lines.append('# TYPE ircrypt_%s %s' % (name, kind))
+		lines.extend(['ircrypt_%s%s %s' % (name, labels(server), value)
+			for server, value in sorted(values.items())])
+
+	for operation in ('encrypt', 'decrypt'):
+		name = 'ircrypt_%s_seconds' % operation
+		lines.append('# HELP %s Time needed to %s a message' % (name, operation))
+		lines.append('# TYPE %s histogram' % name)
+		for (op, server), histogram in sorted(ircrypt_latencies.items()):
+			if op != operation:
+				continue
+			count = 0
+			for bound, observations in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+				count += observations
+				lines.append('%s_bucket%s %i' % (name, labels(server, le=bound), count))
+			lines.append('%s_sum%s %f' % (name, labels(server), histogram[-1]))
+			lines.append('%s_count%s %i' % (name, labels(server), count))
+
+	for name, helptext in (
+			('gpg_spawns', 'Number of started GnuPG processes'),
+			('decrypt_failures', 'Number of messages which could not be decrypted')):
+		metric(name + '_total', 'counter', helptext, dict([(server, value)
+			for (n, server), value in ircrypt_metrics.items() if n == name]))
+
+	# Parts of messages waiting for the remaining parts
+	messages, size = {}, {}
+	for catchword, parts in ircrypt_msg_memory.items():
+		messages[catchword[0]] = messages.get(catchword[0], 0) + 1
+		size[catchword[0]] = size.get(catchword[0], 0) + parts.size()
+	metric('reassembly_messages', 'gauge',
+			'Number of partially received messages', messages)
+	metric('reassembly_bytes', 'gauge',
+			'Size of partially received messages', size)
+
+	# Key exchanges are handled by ircrypt-keyex
+	sessions = weechat.info_get('ircrypt_keyex_sessions', '') or ''
+	metric('key_exchanges', 'gauge', 'Number of active key exchanges',
+			dict([entry.rsplit('=', 1) for entry in sessions.split(',') if entry]))
+	return '\n'.join(lines) + '\n'
+
+
+def ircrypt_metrics_write():
+	'''Write metrics to the configured file. The file is replaced atomically,
+	so that e.g. the textfile collector of the Prometheus node exporter never
+	reads an incomplete file.
+	'''
+	path = weechat.config_string(ircrypt_config_option['metrics_file'])
+	if not path:
+		return
+	path = path.replace('%h', weechat.info_get('weechat_dir', ''))
+	try:
+		with open(path + '.tmp', 'w') as f:
+			f.write(ircrypt_metrics_text())
+		os.rename(path + '.tmp', path)
+	except (IOError, OSError) as e:
+		ircrypt_error('Could not write metrics: %s' % e, '')
+
+
+def ircrypt_metrics_timer_cb(data, remaining_calls):
+	'''Timer regularly writing the metrics file.
+	'''
+	ircrypt_metrics_write()
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_metrics_config_cb(data, option):
+	'''Start, restart or stop the timer writing the metrics file if the
+	configuration changes.
+	'''
+	global ircrypt_metrics_timer
+	if ircrypt_metrics_timer:
+		weechat.unhook(ircrypt_metrics_timer)
+		ircrypt_metrics_timer = None
+	if weechat.config_string(ircrypt_config_option['metrics_file']):
+		ircrypt_metrics_timer = weechat.hook_timer(1000 * weechat.config_integer(
+			ircrypt_config_option['metrics_interval']), 0, 0,
+			'ircrypt_metrics_timer_cb', '')
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_key(server, target):
+	'''Get the key for a target on a server. Besides keys set for exactly this
+	target, keys set for patterns like server/* or */#team-* are used.
+
+	:param server: IRC server
+	:param target: Channel or nick
+	:returns:      Key or None
+	'''
+	return ircrypt_keys.match(('%s/%s' % (server, target)).lower())
 
 
 def ircrypt_encrypt_hook(data, msgtype, server, args):
@@ -289,24 +1151,43 @@ def ircrypt_encrypt_hook(data, msgtype, server, args):
 			return args
 
 	# check symmetric key
-	key = ircrypt_keys.get(('%s/%s' % (server, info['channel'])).lower())
+	key = ircrypt_key(server, info['channel'])
 	if not key:
 		# No key -> don't encrypt
 		return args
 
+	# Never send messages in clear text while GnuPG is still being looked for
+	if not ircrypt_ready:
+		ircrypt_pending.append(('', '/quote -server %s %s' % (server, args)))
+		return ''
+
 	# Get cipher
-	cipher = ircrypt_cipher.get(('%s/%s' % (server, info['channel'])).lower(),
+	cipher = ircrypt_cipher.match(('%s/%s' % (server, info['channel'])).lower(),
 			weechat.config_string(ircrypt_config_option['sym_cipher']))
 	# Get prefix and message
 	pre, message = args.split(':', 1)
 
+	msgid = None
+	if weechat.config_boolean(ircrypt_config_option['message_ids']):
+		msgid = ircrypt_message_id()
+
+	# Encrypt message with the session key if enabled. Fall back to GnuPG if the
+	# Python module cryptography is not available. Session keys are bound to the
+	# channel, so they are not used for private messages, whose target differs
+	# for sender and receiver.
+	started = time.time()
+	if weechat.config_boolean(ircrypt_config_option['session_keys']) \
+			and ircrypt_core.AESGCM and info['channel'][:1] in ('#', '&'):
+		target = ('%s/%s' % (server, info['channel'])).lower()
+		out = ircrypt_session(target, key).encrypt(message,
+				nick=weechat.info_get('irc_nick', server))
+		ircrypt_metric_observe('encrypt', server, time.time() - started)
+		return ircrypt_split_msg(pre, 'CRY2', out, msgid=msgid)
+
 	# encrypt message
-	try:
-		inp = key.encode('utf-8') + b'\n' + message.encode('utf-8')
-	except:
-		inp = key + b'\n' + message
-	(ret, out, err) = ircrypt_gnupg(inp,
-			'--symmetric', '--cipher-algo', cipher, '--passphrase-fd', '-')
+	ircrypt_metric_inc('gpg_spawns', server)
+	(ret, out, err) = ircrypt_core.encrypt(ircrypt_gpg_binary(), key, message,
+			cipher)
 
 	# Get and print GPG errors/warnings
 	if ret:
@@ -315,9 +1196,11 @@ def ircrypt_encrypt_hook(data, msgtype, server, args):
 		return args
 	if err:
 		ircrypt_warn(err.decode('utf-8'))
+	ircrypt_metric_observe('encrypt', server, time.time() - started)
 
 	# Ensure the generated messages are not too long and send them
-	return ircrypt_split_msg(pre, 'CRY', base64.b64encode(out).decode('utf-8'))
+	return ircrypt_split_msg(pre, 'CRY', out,
+			weechat.config_boolean(ircrypt_config_option['forward_parts']), msgid)
 
 
 def ircrypt_config_init():
@@ -368,6 +1251,97 @@ def ircrypt_config_init():
 			ircrypt_config_file, ircrypt_config_section['general'],
 			'binary', 'string', 'GnuPG binary to use', '', 0, 0,
 			'', '', 0, '', '', '', '', '', '')
+	ircrypt_config_option['backend'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'backend', 'integer', 'Use gpg (subprocess) or the Python GPGME '
+			'bindings (gpgme) for decrypting messages', 'subprocess|gpgme', 0, 0,
+			'subprocess', 'subprocess', 0, '', '', '', '', '', '')
+	ircrypt_config_option['forward_parts'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'forward_parts', 'boolean', 'Send parts of long messages first part '
+			'first so that receivers can decrypt them while they are received',
+			'', 0, 0, 'off', 'off', 0, '', '', '', '', '', '')
+	ircrypt_config_option['message_ids'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'message_ids', 'boolean', 'Tag parts of long messages with a message '
+			'id so that receivers can reassemble several messages at once', '',
+			0, 0, 'off', 'off', 0, '', '', '', '', '', '')
+
+	ircrypt_config_option['session_keys'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'session_keys', 'boolean', 'Encrypt messages in all channels with '
+			'AES-GCM using a session key derived from the passphrase instead of '
+			'GnuPG (needs the Python module cryptography)', '', 0, 0, 'off',
+			'off', 0, '', '', '', '', '', '')
+	ircrypt_config_option['trace'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'trace', 'boolean', 'Record the time needed for each stage of the '
+			'decryption of received messages (see /ircrypt trace)', '', 0, 0,
+			'off', 'off', 0, '', '', '', '', '', '')
+	ircrypt_config_option['store'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['general'],
+			'store', 'string', 'SQLite database to store keys and ciphers in '
+			'instead of the configuration file (empty to disable, %h is replaced '
+			'by the WeeChat home)', '', 0, 0, '', '', 0, '', '',
+			'ircrypt_store_config_cb', '', '', '')
+
+	# parallel decryption
+	ircrypt_config_section['burst'] = weechat.config_new_section(
+			ircrypt_config_file, 'burst', 0, 0, '', '', '', '', '', '', '', '',
+			'', '')
+	if not ircrypt_config_section['burst']:
+		weechat.config_free(ircrypt_config_file)
+		return
+	ircrypt_config_option['burst_threshold'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['burst'],
+			'threshold', 'integer', 'Number of encrypted messages per second '
+			'after which messages are decrypted in parallel (0 to disable)', '',
+			0, 100000, '20', '20', 0, '', '', '', '', '', '')
+	ircrypt_config_option['burst_processes'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['burst'],
+			'processes', 'integer', 'Maximum number of GnuPG processes for '
+			'parallel decryption, including messages decrypted while they are '
+			'received (0 for number of CPU cores)', '', 0, 256, '0',
+			'0', 0, '', '', '', '', '', '')
+
+	# decryption cache
+	ircrypt_config_section['cache'] = weechat.config_new_section(
+			ircrypt_config_file, 'cache', 0, 0, '', '', '', '', '', '', '', '',
+			'', '')
+	if not ircrypt_config_section['cache']:
+		weechat.config_free(ircrypt_config_file)
+		return
+	ircrypt_config_option['cache_size'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['cache'],
+			'size', 'integer', 'Number of decrypted messages to cache (0 to '
+			'disable)', '', 0, 1000000, '1000', '1000', 0, '', '', '', '', '', '')
+	ircrypt_config_option['cache_persistent'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['cache'],
+			'persistent', 'boolean', 'Store encrypted decryption cache on disk',
+			'', 0, 0, 'off', 'off', 0, '', '', '', '', '', '')
+	ircrypt_config_option['cache_passphrase'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['cache'],
+			'passphrase', 'string', 'Passphrase for the decryption cache file '
+			'(note: content is evaluated, see /help eval)', '', 0, 0, '', '', 0,
+			'', '', '', '', '', '')
+
+	# metrics
+	ircrypt_config_section['metrics'] = weechat.config_new_section(
+			ircrypt_config_file, 'metrics', 0, 0, '', '', '', '', '', '', '', '',
+			'', '')
+	if not ircrypt_config_section['metrics']:
+		weechat.config_free(ircrypt_config_file)
+		return
+	ircrypt_config_option['metrics_file'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['metrics'],
+			'file', 'string', 'File metrics are written to in the Prometheus text '
+			'format (empty to disable, %h is replaced by the WeeChat home)', '',
+			0, 0, '', '', 0, '', '', 'ircrypt_metrics_config_cb', '', '', '')
+	ircrypt_config_option['metrics_interval'] = weechat.config_new_option(
+			ircrypt_config_file, ircrypt_config_section['metrics'],
+			'interval', 'integer', 'Seconds between updates of the metrics file',
+			'', 1, 86400, '60', '60', 0, '', '', 'ircrypt_metrics_config_cb', '',
+			'', '')
 
 	# keys
 	ircrypt_config_section['keys'] = weechat.config_new_section(
@@ -388,18 +1362,29 @@ def ircrypt_config_init():
 def ircrypt_config_reload_cb(data, config_file):
 	'''Handle a reload of the configuration file.
 	'''
-	global ircrypt_keys, ircrypt_cipher
+	global ircrypt_keys, ircrypt_cipher, ircrypt_config_reading
 	# Forget Keys and ciphers to make sure they are properly reloaded and no old
 	# ones are left
-	ircrypt_keys   = {}
-	ircrypt_cipher = {}
-	return weechat.config_reload(config_file)
+	ircrypt_keys   = ircrypt_core.PatternDict()
+	ircrypt_cipher = ircrypt_core.PatternDict()
+	ircrypt_config_reading = True
+	try:
+		ret = weechat.config_reload(config_file)
+	finally:
+		ircrypt_config_reading = False
+	ircrypt_store_open()
+	return ret
 
 
 def ircrypt_config_read():
 	''' Read IRCrypt configuration file (ircrypt.conf).
 	'''
-	return weechat.config_read(ircrypt_config_file)
+	global ircrypt_config_reading
+	ircrypt_config_reading = True
+	try:
+		return weechat.config_read(ircrypt_config_file)
+	finally:
+		ircrypt_config_reading = False
 
 
 def ircrypt_config_write():
@@ -420,6 +1405,8 @@ def ircrypt_config_keys_write_cb(data, config_file, section_name):
 	'''Write passphrases to the key section of the configuration file.
 	'''
 	weechat.config_write_line(config_file, section_name, '')
+	if ircrypt_store:
+		return weechat.WEECHAT_RC_OK
 	for target, key in sorted(list(ircrypt_keys.items())):
 		weechat.config_write_line(config_file, target.lower(), key)
 
@@ -438,11 +1425,58 @@ def ircrypt_config_special_cipher_write_cb(data, config_file, section_name):
 	'''Write passphrases to the key section of the configuration file.
 	'''
 	weechat.config_write_line(config_file, section_name, '')
+	if ircrypt_store:
+		return weechat.WEECHAT_RC_OK
 	for target, cipher in sorted(list(ircrypt_cipher.items())):
 		weechat.config_write_line(config_file, target.lower(), cipher)
 	return weechat.WEECHAT_RC_OK
 
 
+def ircrypt_store_open():
+	'''Open the SQLite database set by ircrypt.general.store and move keys and
+	ciphers read from the configuration file to it. If no database is set, keys
+	and ciphers are kept in memory and written to the configuration file.
+	'''
+	global ircrypt_store, ircrypt_keys, ircrypt_cipher
+	if ircrypt_store:
+		ircrypt_store.close()
+		ircrypt_store = None
+	path = weechat.config_string(ircrypt_config_option['store'])
+	if path and not ircrypt_core.sqlite3:
+		ircrypt_error('A key store is set, but the Python module sqlite3 is not '
+				'installed. Keys are stored in the configuration file.', '')
+	elif path:
+		path = path.replace('%h', weechat.info_get('weechat_dir', ''))
+		try:
+			ircrypt_store = ircrypt_core.Store(path)
+			migrate = [dict(ircrypt_keys), dict(ircrypt_cipher)]
+			ircrypt_keys = ircrypt_core.StoredPatternDict(ircrypt_store, 'keys',
+					ircrypt_keys)
+			ircrypt_cipher = ircrypt_core.StoredPatternDict(ircrypt_store,
+					'cipher', ircrypt_cipher)
+		except ircrypt_core.sqlite3.Error as e:
+			ircrypt_error('Could not open key store %s: %s' % (path, e), '')
+			ircrypt_store = None
+		else:
+			# Remove moved keys from the configuration file
+			if any(migrate):
+				ircrypt_config_write()
+			return
+	ircrypt_keys = ircrypt_core.PatternDict(ircrypt_keys)
+	ircrypt_cipher = ircrypt_core.PatternDict(ircrypt_cipher)
+
+
+def ircrypt_store_config_cb(data, option):
+	'''Open another key store or move keys back to the configuration file if
+	ircrypt.general.store changes. While the configuration file is read, the
+	store is opened once reading is finished.
+	'''
+	if not ircrypt_config_reading:
+		ircrypt_store_open()
+		ircrypt_config_write()
+	return weechat.WEECHAT_RC_OK
+
+
 def ircrypt_command_list():
 	'''List set keys and channel specific ciphers.
 	'''
@@ -454,9 +1488,131 @@ def ircrypt_command_list():
 	ciphers = '\n'.join([' %s : %s' % x for x in ircrypt_cipher.items()])
 	ircrypt_info('Special ciphers:\n' + ciphers if ciphers
 			else 'No special ciphers set')
+
+	# List ciphers used by others
+	if ircrypt_sender_ciphers:
+		ircrypt_info('Received ciphers:\n' + '\n'.join([' %s : %s, %i messages' %
+			(sender, cipher, messages) for sender, (cipher, messages)
+			in sorted(ircrypt_sender_ciphers.items())]))
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_command_cache(argv):
+	'''Show statistics of the decryption cache or clear it.
+	'''
+	if argv[1:] == ['clear']:
+		ircrypt_decrypt_cache.clear()
+		ircrypt_info('Decryption cache cleared')
+		return weechat.WEECHAT_RC_OK
+	if argv[1:]:
+		return weechat.WEECHAT_RC_ERROR
+	hits, misses = ircrypt_cache_stats['hits'], ircrypt_cache_stats['misses']
+	ircrypt_info('Decryption cache: %i/%i entries, %i hits, %i misses (%.1f%%)' %
+			(len(ircrypt_decrypt_cache),
+				weechat.config_integer(ircrypt_config_option['cache_size']),
+				hits, misses, 100.0 * hits / ((hits + misses) or 1)))
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_command_profile(argv):
+	'''Start or stop profiling the hooks of IRCrypt and ircrypt-keyex or write
+	the collected statistics to the WeeChat home directory.
+	'''
+	if len(argv) != 2 or argv[1] not in ('start', 'stop', 'dump'):
+		return weechat.WEECHAT_RC_ERROR
+	# ircrypt-keyex runs in its own interpreter and has its own profiler
+	weechat.hook_signal_send('ircrypt_profile', weechat.WEECHAT_HOOK_SIGNAL_STRING,
+			argv[1])
+	if argv[1] == 'start':
+		ircrypt_profiler.start()
+		ircrypt_info('Profiling started')
+	elif argv[1] == 'stop':
+		ircrypt_profiler.stop()
+		ircrypt_info('Profiling stopped')
+	else:
+		path = '%s/ircrypt_profile.txt' % weechat.info_get('weechat_dir', '')
+		if ircrypt_profiler.dump(path):
+			ircrypt_info('Profile written to %s' % path)
+		else:
+			ircrypt_info('Nothing profiled yet')
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_command_trace(argv):
+	'''Show the slowest recently received messages per channel and the time
+	each stage of their decryption took.
+	'''
+	try:
+		number = int(argv[1]) if len(argv) > 1 else 5
+	except ValueError:
+		return weechat.WEECHAT_RC_ERROR
+	if not ircrypt_traces:
+		ircrypt_info('No messages traced. Enable tracing with: '
+				'/set ircrypt.general.trace on')
+		return weechat.WEECHAT_RC_OK
+	targets = {}
+	for target, trace in ircrypt_traces:
+		targets.setdefault(target, []).append(trace)
+	for target, traces in sorted(targets.items()):
+		traces.sort(key=lambda trace: trace[-1][1] - trace[0][1], reverse=True)
+		ircrypt_info('Slowest messages in %s:' % target)
+		for trace in traces[:number]:
+			stages = ['%s %.1f' % (stage, 1000 * (end - trace[i][1]))
+					for i, (stage, end) in enumerate(trace[1:])]
+			ircrypt_info('  %8.1f ms  %s' % (1000 * (trace[-1][1] - trace[0][1]),
+				'  '.join(stages)))
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_command_memory():
+	'''Show the number of entries and the approximate size of the data kept in
+	memory, including the stores of ircrypt-keyex. Partially received messages
+	are listed by sender to spot abusive senders.
+	'''
+	streams = dict([(stream.name, stream) for stream in
+		list(ircrypt_streams.values()) + list(ircrypt_streams.running.values())])
+	lines = [
+		ircrypt_core.memory_report('Message parts', [('%s/%s' % (catchword[0],
+			catchword[2]), parts.size(), parts.modified)
+			for catchword, parts in ircrypt_msg_memory.items()]),
+		ircrypt_core.memory_report('Plain messages', [(target, len(msg), created)
+			for target, (created, msg) in ircrypt_message_plain.items()]),
+		ircrypt_core.memory_report('Keys', [(target, len(key), None)
+			for target, key in ircrypt_keys.items()], 0),
+		ircrypt_core.memory_report('Ciphers', [(target, len(cipher), None)
+			for target, cipher in ircrypt_cipher.items()], 0),
+		ircrypt_core.memory_report('Decryption cache', [(digest, len(plain), None)
+			for digest, plain in ircrypt_decrypt_cache.items()], 0),
+		ircrypt_core.memory_report('Decryption streams', [('%s/%s' %
+			stream.sender, len(stream.out) + len(stream.err), None)
+			for stream in streams.values()]),
+		ircrypt_core.memory_report('Burst messages', [('%s/%s' % (msg.server,
+			msg.nick), len(msg.args) + len(msg.encoded or '') + len(msg.out) +
+			len(msg.err), msg.started) for queue in ircrypt_burst.queues.values()
+			for msg in queue]),
+		ircrypt_core.memory_report('Burst results', [(line, len(line) * count,
+			None) for line, count in ircrypt_burst.injected.items()], 0),
+		ircrypt_core.memory_report('Circuit breakers', [('%s/%s' % sender,
+			len(sender[0]) + len(sender[1]), breaker.modified)
+			for sender, breaker in ircrypt_breakers.items()]),
+		ircrypt_core.memory_report('Sender ciphers', [(sender, len(cipher), None)
+			for sender, (cipher, messages) in ircrypt_sender_ciphers.items()], 0)]
+	# The key exchange is handled by ircrypt-keyex
+	keyex = weechat.info_get('ircrypt_keyex_memory', '')
+	if keyex:
+		lines.extend(keyex.split('\n'))
+	ircrypt_info('Memory usage:\n' + '\n'.join([' ' + x for x in lines]))
 	return weechat.WEECHAT_RC_OK
 
 
+def ircrypt_target_server(target):
+	'''Get the server of a server/target combination or None if it is a
+	pattern matching several servers.
+	'''
+	server = target.split('/', 1)[0]
+	return None if '*' in server else server
+
+
 def ircrypt_command_set_keys(target, key):
 	'''Set key for target.
 
@@ -464,6 +1620,7 @@ def ircrypt_command_set_keys(target, key):
 	:param key: Key to use for target
 	'''
 	ircrypt_keys[target.lower()] = key
+	ircrypt_breaker_reset(ircrypt_target_server(target))
 	ircrypt_info('Set key for %s' % target)
 	return weechat.WEECHAT_RC_OK
 
@@ -475,6 +1632,7 @@ def ircrypt_command_remove_keys(target):
 	'''
 	try:
 		del ircrypt_keys[target.lower()]
+		ircrypt_breaker_reset(ircrypt_target_server(target))
 		ircrypt_info('Removed key for %s' % target)
 	except KeyError:
 		ircrypt_info('No existing key for %s.' % target)
@@ -535,6 +1693,22 @@ def ircrypt_command(data, buffer, args):
 	if not argv or argv == ['list']:
 		return ircrypt_command_list()
 
+	# Decryption cache
+	if argv[0] == 'cache':
+		return ircrypt_command_cache(argv)
+
+	# Profiler
+	if argv[0] == 'profile':
+		return ircrypt_command_profile(argv)
+
+	# Traces of received messages
+	if argv[0] == 'trace':
+		return ircrypt_command_trace(argv)
+
+	# Memory usage
+	if argv == ['memory']:
+		return ircrypt_command_memory()
+
 	# Check if a server was set
 	if (len(argv) > 2 and argv[1] == '-server'):
 		server = argv[2]
@@ -594,7 +1768,7 @@ def ircrypt_encryption_statusbar(*args):
 	'''
 	channel = weechat.buffer_get_string(weechat.current_buffer(), 'localvar_channel')
 	server  = weechat.buffer_get_string(weechat.current_buffer(), 'localvar_server')
-	key = ircrypt_keys.get(('%s/%s' % (server, channel)).lower())
+	key = ircrypt_key(server, channel)
 
 	# Return nothing if no key is set for current channel
 	if not key:
@@ -602,7 +1776,7 @@ def ircrypt_encryption_statusbar(*args):
 
 	# Get cipher used for current channel
 	cipher = weechat.config_string(ircrypt_config_option['sym_cipher'])
-	cipher = ircrypt_cipher.get(('%s/%s' % (server, channel)).lower(), cipher)
+	cipher = ircrypt_cipher.match(('%s/%s' % (server, channel)).lower(), cipher)
 
 	# Return marker, but replace {{cipher}}
 	marker = weechat.config_string(ircrypt_config_option['encrypted'])
@@ -613,31 +1787,65 @@ def ircrypt_find_gpg_binary(names=('gpg2','gpg')):
 	'''Check for GnuPG binary to use
 	:returns: Tuple with binary name and version.
 	'''
-	for binary in names:
-		p = subprocess.Popen([binary, '--version'],
-				stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE)
-		version = p.communicate()[0].decode('utf-8').split('\n',1)[0]
-		if not p.returncode:
-			return binary, version
-	return None, None
-
-
-def ircrypt_check_binary():
-	'''If binary is not set, try to determine it automatically
-	'''
-	cfg_option = weechat.config_get('ircrypt.general.binary')
-	gnupg = weechat.config_string(cfg_option)
-	if not gnupg:
-		(gnupg, version) = ircrypt_find_gpg_binary(('gpg','gpg2'))
-		if not gnupg:
-			ircrypt_error('Automatic detection of the GnuPG binary failed and '
-					'nothing is set manually. You wont be able to use IRCrypt like '
-					'this. Please install GnuPG or set the path to the binary to '
-					'use.', '')
-		else:
-			ircrypt_info('Found %s' % version, '')
-			weechat.config_option_set(cfg_option, gnupg, 1)
+	return ircrypt_core.find_gpg_binary(names)
+
+
+def ircrypt_check_binary(names=('gpg','gpg2')):
+	'''If binary is not set, try to determine it automatically. The binaries are
+	checked one after another by processes running in the background, so that
+	loading the script is not delayed. Until a binary is found, encrypted
+	messages are queued.
+
+	:param names: Binaries which are left to check
+	'''
+	global ircrypt_ready
+	if weechat.config_string(weechat.config_get('ircrypt.general.binary')):
+		ircrypt_init_done()
+		return
+	if not names:
+		ircrypt_error('Automatic detection of the GnuPG binary failed and '
+				'nothing is set manually. You wont be able to use IRCrypt like '
+				'this. Please install GnuPG or set the path to the binary to '
+				'use.', '')
+		ircrypt_init_done()
+		return
+	ircrypt_ready = False
+	if not weechat.hook_process_hashtable(names[0], {'arg1': '--version'},
+			INIT_TIMEOUT * 1000, 'ircrypt_check_binary_cb', ' '.join(names)):
+		ircrypt_check_binary(names[1:])
+
+
+def ircrypt_check_binary_cb(data, command, returncode, out, err):
+	'''Callback for the processes checking for the GnuPG binary.
+	'''
+	names = data.split()
+	out = ircrypt_binary_output.get(data, '') + out
+	if returncode == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+		ircrypt_binary_output[data] = out
+		return weechat.WEECHAT_RC_OK
+	ircrypt_binary_output.pop(data, None)
+	if returncode:
+		ircrypt_check_binary(names[1:])
+		return weechat.WEECHAT_RC_OK
+	ircrypt_info('Found %s' % out.split('\n', 1)[0], '')
+	weechat.config_option_set(weechat.config_get('ircrypt.general.binary'),
+			names[0], 1)
+	ircrypt_init_done()
+	return weechat.WEECHAT_RC_OK
+
+
+def ircrypt_init_done():
+	'''Mark the initialization as finished, load the decryption cache and handle
+	all messages which were queued meanwhile.
+	'''
+	global ircrypt_ready
+	if ircrypt_gpg_binary():
+		ircrypt_cache_load()
+	ircrypt_ready = True
+	pending = ircrypt_pending[:]
+	del ircrypt_pending[:]
+	for buffer, command in pending:
+		weechat.command(buffer, command)
 
 
 # register plugin
@@ -647,7 +1855,17 @@ if __name__ == '__main__' and weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR,
 	# register the modifiers
 	ircrypt_config_init()
 	ircrypt_config_read()
+	ircrypt_store_open()
 	ircrypt_check_binary()
+	if weechat.config_string(ircrypt_config_option['backend']) == 'gpgme' \
+			and not ircrypt_core.gpg:
+		ircrypt_warn('GPGME is selected as backend, but the Python module gpg '
+				'is not installed. Using the GnuPG binary instead.')
+	if weechat.config_boolean(ircrypt_config_option['session_keys']) \
+			and not ircrypt_core.AESGCM:
+		ircrypt_warn('Session keys are enabled, but the Python module '
+				'cryptography is not installed. Using GnuPG instead.')
+	ircrypt_metrics_config_cb('', '')
 	weechat.hook_modifier('irc_in_privmsg',  'ircrypt_decrypt_hook', '')
 	weechat.hook_modifier('irc_out_privmsg', 'ircrypt_encrypt_hook', '')
 
@@ -657,13 +1875,21 @@ if __name__ == '__main__' and weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR,
 			'| remove-key [-server <server>] <target> '
 			'| set-cipher [-server <server>] <target> <cipher> '
 			'| remove-cipher [-server <server>] <target> '
-			'| plain [-server <server>] [-channel <channel>] <message>',
+			'| plain [-server <server>] [-channel <channel>] <message> '
+			'| cache [clear] '
+			'| profile start|stop|dump '
+			'| trace [<number>] '
+			'| memory',
 			SCRIPT_HELP_TEXT,
 			'list || set-key %(irc_channel)|%(nicks)|-server %(irc_servers) %- '
 			'|| remove-key %(irc_channel)|%(nicks)|-server %(irc_servers) %- '
 			'|| set-cipher %(irc_channel)|-server %(irc_servers) %- '
 			'|| remove-cipher |%(irc_channel)|-server %(irc_servers) %- '
-			'|| plain |-channel %(irc_channel)|-server %(irc_servers) %-',
+			'|| plain |-channel %(irc_channel)|-server %(irc_servers) %- '
+			'|| cache clear '
+			'|| profile start|stop|dump '
+			'|| trace '
+			'|| memory',
 			'ircrypt_command', '')
 	weechat.bar_item_new('ircrypt', 'ircrypt_encryption_statusbar', '')
 	weechat.hook_signal('ircrypt_buffer_opened', 'update_encryption_status', '')
@@ -674,4 +1900,8 @@ def ircrypt_unload_script():
 	script is unloaded.
 	'''
 	ircrypt_config_write()
+	ircrypt_cache_save()
+	ircrypt_metrics_write()
+	if ircrypt_store:
+		ircrypt_store.close()
 	return weechat.WEECHAT_RC_OK
@@ -0,0 +1,1351 @@
+# -*- coding: utf-8 -*-
+#
+# IRCrypt: Secure Encryption Layer Atop IRC
+# =========================================
+#
+# Copyright (C) 2013-2014
+#    Lars Kiesow   <lkiesow@uos.de>
+#    Sven Haardiek <sven@haardiek.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+#
+# == About ==================================================================
+#
+#  The IRCrypt core contains the message framing and the encryption used by
+#  the IRCrypt protocol. It does not depend on WeeChat and can be used by
+#  bots, relays or other tools. The WeeChat script ircrypt.py is a thin layer
+#  on top of it.
+#
+#  Besides the GnuPG based protocol (>CRY-), messages can be encrypted with
+#  AES-GCM using keys derived from the channel passphrase (>CRY2-). This needs
+#  the Python module cryptography.
+#
+#  Used as a script, it encrypts or decrypts messages read from stdin:
+#
+#    echo 'Hello' | python ircrypt_core.py encrypt -k secret
+#    python ircrypt_core.py decrypt -k secret < encrypted.txt
+#
+# == Project ================================================================
+#
+# This plug-in is part of the IRCrypt project. For mor information or to
+# participate, please visit
+#
+#   https://github.com/IRCrypt
+#
+
+
+import subprocess, base64, binascii, time, sys, os, hashlib, hmac, struct, re
+import collections
+import cProfile, pstats
+
+try:
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+	from cryptography.exceptions import InvalidTag
+except ImportError:
+	AESGCM = None
+
+try:
+	import gpg
+except ImportError:
+	gpg = None
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+MAX_PART_LEN     = 300
+MSG_PART_TIMEOUT = 300 # 5min
+DEFAULT_CIPHER   = 'TWOFISH'
+
+# Encrypted messages larger than this (in bytes) are rejected without calling
+# GnuPG
+MAX_ENCRYPTED_LEN = 65536
+
+# Message ids are hexadecimal numbers with up to this number of digits
+MSGID_LEN = 3
+
+# Number of messages of one sender which are reassembled at the same time
+MESSAGES_PER_SENDER = 8
+
+# OpenPGP identifiers (RFC 4880, section 9)
+CIPHERS = {1: 'IDEA', 2: '3DES', 3: 'CAST5', 4: 'BLOWFISH', 7: 'AES',
+		8: 'AES192', 9: 'AES256', 10: 'TWOFISH', 11: 'CAMELLIA128',
+		12: 'CAMELLIA192', 13: 'CAMELLIA256'}
+HASHES = {1: 'MD5', 2: 'SHA1', 3: 'RIPEMD160', 8: 'SHA256', 9: 'SHA384',
+		10: 'SHA512', 11: 'SHA224'}
+S2K_TYPES = {0: 'simple', 1: 'salted', 3: 'iterated'}
+S2K_LENGTHS = {0: 2, 1: 10, 3: 11}
+ENCRYPTED_PACKETS = {9: 'SED', 18: 'SEIPD', 20: 'AEAD'}
+
+# Session key mode (>CRY2-)
+SESSION_VERSION    = 2
+SESSION_SALT       = b'IRCrypt session key '
+SESSION_ITERATIONS = 100000
+SESSION_HEADER     = struct.Struct('>BI4sQ') # version, epoch, sender, counter
+REKEY_INTERVAL     = 3600 # seconds
+
+
+class MessageParts:
+	'''Class used for storing parts of messages which were split after
+	encryption due to their length.'''
+
+	modified = 0
+	last_id  = None
+	message  = ''
+
+	def update(self, id, msg):
+		'''This method updates an already existing message part by adding a new
+		part to the old ones and updating the identifier of the latest received
+		message part.
+		'''
+		# Check if id is correct. If not, throw away old parts:
+		if self.last_id and self.last_id != id+1:
+			self.message = ''
+		# Check if the are old message parts which belong due to their old age
+		# probably not to this message:
+		if time.time() - self.modified > MSG_PART_TIMEOUT:
+			self.message = ''
+		self.last_id = id
+		self.message = msg + self.message
+		self.modified = time.time()
+
+	def size(self):
+		'''Get the number of bytes stored.
+		'''
+		return len(self.message)
+
+
+class Reassembler:
+	'''Class used for reassembling messages split into several parts. Parts are
+	collected per sender until the last part (the one with id 0) is received.
+	'''
+
+	def __init__(self, memory=None):
+		self.memory = {} if memory is None else memory
+
+	def update(self, sender, id, msg):
+		'''Add a message part received from sender.
+
+		:param sender: Identifier of the sender (e.g. server, channel and nick)
+		:param     id: Number of the message part
+		:param    msg: Content of the message part
+		:returns:      The complete message or None if parts are missing
+		'''
+		if id != 0:
+			if not sender in self.memory:
+				self.memory[sender] = MessageParts()
+			self.memory[sender].update(id, msg)
+			return None
+		try:
+			return msg + self.memory.pop(sender).message
+		except KeyError:
+			return msg
+
+	def expire(self, timeout=MSG_PART_TIMEOUT):
+		'''Drop parts of messages which were not completed in time.
+		'''
+		now = time.time()
+		for sender in [sender for sender, parts in self.memory.items()
+				if now - parts.modified > timeout]:
+			del self.memory[sender]
+
+
+class DecodedParts(MessageParts):
+	'''Class used for storing parts of a base64 encoded message. Each part is
+	decoded when it arrives and copied to its place in a preallocated buffer.
+	This works since all parts but the last one have the same length, which is
+	a multiple of four. Parts are either sent last part first or, if the total
+	number of parts is given, first part first.'''
+
+	tail     = None
+	data     = None
+	count    = 0
+	part_len = 0
+	origin   = None
+
+	def update(self, id, msg, prefix=b'', total=None):
+		'''Add a message part.
+
+		:param     id: Number of the message part
+		:param    msg: Base64 encoded content of the message part
+		:param prefix: Data to put in front of the decoded message
+		:param  total: Number of parts if parts are sent first part first
+		:returns:      Buffer containing prefix and decoded message if the last
+		               part to be sent was received, None otherwise
+		:raises ValueError: If the part is no valid base64 or does not fit to the
+		                    parts received before
+		'''
+		decoded = b64decode(msg)
+		if total is not None:
+			return self.update_forward(id, decoded, prefix, total)
+		# Check if id is correct and if the old parts are not too old. If not,
+		# throw away old parts:
+		if self.last_id is None or self.last_id != id+1 \
+				or time.time() - self.modified > MSG_PART_TIMEOUT:
+			self.tail = self.data = None
+		self.last_id = id
+		self.modified = time.time()
+
+		# The last part of the message is received first
+		if self.tail is None:
+			if id == 0:
+				return bytearray(prefix + decoded)
+			self.tail = decoded
+			self.count = id
+			return None
+
+		# Allocate the buffer once the length of the other parts is known
+		if self.data is None:
+			if len(self.tail) > len(decoded):
+				raise ValueError('Message part has wrong length')
+			if self.count * len(decoded) > MAX_ENCRYPTED_LEN:
+				raise ValueError('Message is too long')
+			self.part_len = len(decoded)
+			self.data = bytearray(len(prefix) + self.count * self.part_len +
+					len(self.tail))
+			self.data[:len(prefix)] = prefix
+			self.data[len(prefix) + self.count * self.part_len:] = self.tail
+		elif len(decoded) != self.part_len:
+			raise ValueError('Message part has wrong length')
+		pos = len(prefix) + id * self.part_len
+		self.data[pos:pos+self.part_len] = decoded
+		return self.data if id == 0 else None
+
+	def update_forward(self, id, decoded, prefix, total):
+		'''Add a decoded part of a message sent first part first.
+		'''
+		if not 0 <= id < total:
+			raise ValueError('Invalid message part number')
+		if id == 0:
+			if total * len(decoded) > MAX_ENCRYPTED_LEN:
+				raise ValueError('Message is too long')
+			self.data = bytearray(len(prefix) + total * len(decoded))
+			self.data[:len(prefix)] = prefix
+			self.part_len = len(decoded)
+			self.count = total
+		elif self.data is None or self.last_id != id - 1 \
+				or self.count != total \
+				or time.time() - self.modified > MSG_PART_TIMEOUT:
+			# Without the first part, the message cannot be decoded
+			self.data = None
+			self.last_id = id
+			if id == total - 1:
+				raise ValueError('Message parts are missing')
+			return None
+		elif len(decoded) > self.part_len \
+				or (id < total - 1 and len(decoded) != self.part_len):
+			raise ValueError('Message part has wrong length')
+		self.last_id = id
+		self.modified = time.time()
+		pos = len(prefix) + id * self.part_len
+		self.data[pos:pos+len(decoded)] = decoded
+		if id < total - 1:
+			return None
+		del self.data[pos+len(decoded):]
+		return self.data
+
+	def size(self):
+		'''Get the number of bytes stored.
+		'''
+		return len(self.data or self.tail or b'')
+
+
+class DecodingReassembler(Reassembler):
+	'''Class used for reassembling base64 encoded messages split into several
+	parts. Parts are decoded on arrival. The complete message is returned as
+	bytearray.
+	'''
+
+	def update(self, sender, id, msg, prefix=b'', total=None, origin=None):
+		'''Add a message part received from sender.
+
+		:param sender: Identifier of the sender (e.g. server, channel and nick)
+		:param     id: Number of the message part
+		:param    msg: Base64 encoded content of the message part
+		:param prefix: Data to put in front of the decoded message
+		:param  total: Number of parts if parts are sent first part first
+		:param origin: Identifier of the user sending the message if sender
+		               identifies single messages (e.g. by message id)
+		:returns:      Buffer containing prefix and decoded message or None if
+		               parts are missing
+		:raises ValueError: If the part is corrupt. All parts received from
+		                    sender are dropped.
+		'''
+		parts = self.memory.pop(sender, None)
+		if not parts:
+			self.expire()
+			if origin is not None:
+				self.limit(origin)
+			parts = DecodedParts()
+			parts.origin = origin
+		data = parts.update(id, msg, prefix, total)
+		if data is None:
+			self.memory[sender] = parts
+		return data
+
+	def limit(self, origin, messages=MESSAGES_PER_SENDER):
+		'''Drop the least recently updated messages of a user until another
+		message of the user can be reassembled.
+		'''
+		senders = [sender for sender, parts in self.memory.items()
+				if parts.origin == origin]
+		if len(senders) < messages:
+			return
+		senders.sort(key=lambda sender: self.memory[sender].modified)
+		for sender in senders[:len(senders) - messages + 1]:
+			del self.memory[sender]
+
+
+class BurstMessage:
+	'''Class used for storing an encrypted message which is decrypted in
+	parallel to others because too many messages arrived at once.'''
+
+	def __init__(self, server, channel, nick, args, pre, key, encoded, digest):
+		self.server  = server
+		self.channel = channel
+		self.nick    = nick
+		self.args    = args
+		self.pre     = pre
+		self.key     = key
+		self.encoded = encoded
+		self.digest  = digest
+		self.out     = ''
+		self.err     = ''
+		self.result  = None
+		self.started = time.time()
+		self.trace   = None
+
+
+class Burst:
+	'''Class used for the bookkeeping of messages decrypted in parallel
+	processes. Messages of a channel are displayed in the order they were
+	received, so each channel has its own queue. Messages wait until one of the
+	processes is free. Starting the processes and displaying the messages is
+	left to the caller.
+	'''
+
+	def __init__(self):
+		self.arrivals = collections.deque()
+		self.queues   = {}
+		self.waiting  = collections.deque()
+		self.running  = {}
+		self.injected = {}
+		self.started  = 0
+		self.messages = 0
+
+	def active(self, channel, threshold, now=None):
+		'''Check if a message of channel should be decrypted in parallel. This is
+		the case if more than threshold messages arrived within the last second or
+		if messages of the channel are still queued.
+		'''
+		if threshold <= 0:
+			return False
+		if self.queues.get(channel):
+			return True
+		now = time.time() if now is None else now
+		self.arrivals.append(now)
+		while now - self.arrivals[0] > 1:
+			self.arrivals.popleft()
+		return len(self.arrivals) > threshold
+
+	def queue(self, channel, msg):
+		'''Append a message to the queue of channel.
+		'''
+		self.queues.setdefault(channel, collections.deque()).append(msg)
+
+	def add(self, channel, msg, wait=True):
+		'''Queue a message decrypted in burst mode.
+
+		:param channel: Name of the channel the message is displayed in
+		:param     msg: BurstMessage
+		:param    wait: If the message waits for a process to decrypt it
+		'''
+		if not self.busy():
+			self.started  = time.time()
+			self.messages = 0
+		self.messages += 1
+		self.queue(channel, msg)
+		if wait:
+			self.waiting.append(msg)
+
+	def next(self, processes):
+		'''Get the next message waiting for a process if less than processes
+		are running, None otherwise.
+		'''
+		if self.waiting and len(self.running) < processes:
+			return self.waiting.popleft()
+		return None
+
+	def ready(self, channel):
+		'''Remove the messages of channel which can be displayed now. These are
+		the decrypted messages received before the first message still being
+		decrypted. The results are remembered as injected.
+
+		:returns: List of messages in the order they were received
+		'''
+		queue = self.queues.get(channel, ())
+		ready = []
+		while queue and queue[0].result is not None:
+			msg = queue.popleft()
+			self.injected[msg.result] = self.injected.get(msg.result, 0) + 1
+			ready.append(msg)
+		if not queue:
+			self.queues.pop(channel, None)
+		return ready
+
+	def passthrough(self, line):
+		'''Check if line is the result of a message displayed by the caller and
+		forget about it.
+		'''
+		count = self.injected.get(line)
+		if not count:
+			return False
+		if count > 1:
+			self.injected[line] = count - 1
+		else:
+			del self.injected[line]
+		return True
+
+	def busy(self):
+		'''Check if messages are queued or being decrypted.
+		'''
+		return bool(self.queues or self.running)
+
+
+class DecryptionStream:
+	'''Class used for a GnuPG process decrypting a message sent first part
+	first while its parts are still being received.'''
+
+	def __init__(self, name, hook):
+		self.name       = str(id(self)) if name is None else name
+		self.hook       = hook
+		self.next       = 0
+		self.out        = ''
+		self.err        = ''
+		self.returncode = None
+		self.msg        = None
+		self.key        = None
+		self.sender     = None
+
+
+class Streams(dict):
+	'''Dictionary mapping senders (e.g. server, channel, nick and message id)
+	to the DecryptionStream decrypting the message they are sending. Streams
+	with a running process are also found by name in running. Starting and
+	stopping the processes is left to the caller.
+	'''
+
+	def __init__(self):
+		dict.__init__(self)
+		self.running = {}
+
+	def full(self, sender, per_sender, total):
+		'''Check if no further process may be started for a stream of sender
+		since sender or all senders together already have too many running.
+
+		:param     sender: Identifier of the user sending the message
+		:param per_sender: Maximum number of processes per sender
+		:param      total: Maximum number of processes
+		'''
+		if len(self.running) >= total:
+			return True
+		return len([stream for stream in self.running.values()
+			if stream.sender == sender]) >= per_sender
+
+	def start(self, key, stream, sender):
+		'''Remember the running process of a new stream.
+
+		:param    key: Key the stream is stored at while parts are received
+		:param stream: DecryptionStream
+		:param sender: Identifier of the user sending the message
+		'''
+		stream.key    = key
+		stream.sender = sender
+		self.running[stream.name] = stream
+
+	def finish(self, name, returncode):
+		'''Remember that the process of a stream ended. A stream which is still
+		waiting for parts is dropped.
+
+		:returns: The stream or None if it was stopped before
+		'''
+		stream = self.running.pop(name, None)
+		if stream:
+			stream.returncode = returncode
+			if self.get(stream.key) is stream:
+				del self[stream.key]
+		return stream
+
+	def stop(self, stream):
+		'''Forget the process of a stream.
+
+		:returns: True if the process is still running and has to be stopped
+		'''
+		self.running.pop(stream.name, None)
+		return stream.returncode is None
+
+
+class PatternDict(dict):
+	'''Dictionary mapping server/target strings (e.g. keys) to values. Keys may
+	contain the wildcard * matching any number of characters, like server/* or
+	*/#team-*. Use match to get the value of the most specific matching key.
+
+	Exact keys are found by a single dictionary lookup. For everything else,
+	the patterns are compiled once the dictionary is changed and are stored in
+	buckets by their server (one bucket for patterns with a wildcard in the
+	server part). Each bucket is ordered by the number of literal characters
+	of its patterns, so the first match in a bucket is the most specific one.
+	The pattern found for a target is cached until the dictionary changes.
+	'''
+
+	CACHE_SIZE = 4096
+
+	def __init__(self, *args, **kwargs):
+		dict.__init__(self, *args, **kwargs)
+		self.index = None
+		self.cache = {}
+
+	def changed(self):
+		self.index = None
+		self.cache.clear()
+
+	def __setitem__(self, key, value):
+		dict.__setitem__(self, key, value)
+		self.changed()
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.changed()
+
+	def pop(self, *args):
+		self.changed()
+		return dict.pop(self, *args)
+
+	def popitem(self):
+		self.changed()
+		return dict.popitem(self)
+
+	def setdefault(self, key, default=None):
+		if not key in self:
+			self[key] = default
+		return self[key]
+
+	def clear(self):
+		dict.clear(self)
+		self.changed()
+
+	def update(self, *args, **kwargs):
+		dict.update(self, *args, **kwargs)
+		self.changed()
+
+	def __ior__(self, other):
+		self.update(other)
+		return self
+
+	def compile(self):
+		'''Build the index of all patterns.
+		'''
+		index = {}
+		for pattern in self:
+			if not '*' in pattern:
+				continue
+			server = pattern.split('/', 1)[0]
+			if '*' in server:
+				server = None
+			regex = re.compile('%s$' % '.*'.join(
+				[re.escape(x) for x in pattern.split('*')]), re.DOTALL)
+			index.setdefault(server, []).append(((len(pattern) -
+				pattern.count('*'), server is not None), regex, pattern))
+		for bucket in index.values():
+			bucket.sort(key=lambda entry: entry[0], reverse=True)
+		self.index = index
+
+	def match(self, target, default=None):
+		'''Get the value for target. If target is no key, the value of the most
+		specific matching pattern is returned: the one with the most literal
+		characters, preferring patterns for a specific server.
+
+		:param  target: Lower case server/target
+		:param default: Value returned if nothing matches
+		'''
+		if target in self:
+			return dict.__getitem__(self, target)
+		try:
+			pattern = self.cache[target]
+		except KeyError:
+			if self.index is None:
+				self.compile()
+			best = None
+			server = target.split('/', 1)[0]
+			for bucket in (self.index.get(server, ()), self.index.get(None, ())):
+				for entry in bucket:
+					if entry[1].match(target):
+						if not best or entry[0] > best[0]:
+							best = entry
+						break
+			pattern = best[2] if best else None
+			if len(self.cache) >= self.CACHE_SIZE:
+				self.cache.clear()
+			self.cache[target] = pattern
+		return default if pattern is None else dict.__getitem__(self, pattern)
+
+
+class Store(object):
+	'''SQLite database storing mappings like keys or ciphers. Each mapping is a
+	table indexed by its target. The database uses a write-ahead log and every
+	change is committed immediately, so nothing is lost if the client crashes.
+	The database and its journal files are only readable by the user.
+	'''
+
+	def __init__(self, path):
+		umask = os.umask(0o077)
+		try:
+			if path != ':memory:':
+				os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+				os.chmod(path, 0o600)
+			self.db = sqlite3.connect(path)
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+		finally:
+			os.umask(umask)
+
+	def load(self, table):
+		'''Create table if necessary and return all of its entries.
+		'''
+		with self.db:
+			self.db.execute('CREATE TABLE IF NOT EXISTS %s '
+					'(target TEXT PRIMARY KEY, value NOT NULL)' % table)
+		return self.db.execute('SELECT target, value FROM %s' % table).fetchall()
+
+	def set(self, table, items):
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % table,
+					items)
+
+	def delete(self, table, target):
+		with self.db:
+			self.db.execute('DELETE FROM %s WHERE target = ?' % table, (target,))
+
+	def clear(self, table):
+		with self.db:
+			self.db.execute('DELETE FROM %s' % table)
+
+	def close(self):
+		self.db.close()
+
+
+class StoredDict(dict):
+	'''Dictionary writing all changes through to a table of a Store. The table
+	is loaded on creation. Entries passed as items are added to the table, which
+	is used to move entries from the configuration file to the store.
+
+	:param store: Store to use
+	:param table: Name of the table
+	:param items: Additional entries to add to the table
+	'''
+
+	def __init__(self, store, table, items=()):
+		self.store = store
+		self.table = table
+		super(StoredDict, self).__init__(store.load(table))
+		self.update(items)
+
+	def __setitem__(self, key, value):
+		self.store.set(self.table, ((key, value),))
+		super(StoredDict, self).__setitem__(key, value)
+
+	def __delitem__(self, key):
+		super(StoredDict, self).__delitem__(key)
+		self.store.delete(self.table, key)
+
+	def pop(self, key, *args):
+		if key in self:
+			self.store.delete(self.table, key)
+		return super(StoredDict, self).pop(key, *args)
+
+	def popitem(self):
+		key, value = super(StoredDict, self).popitem()
+		self.store.delete(self.table, key)
+		return key, value
+
+	def setdefault(self, key, default=None):
+		if not key in self:
+			self[key] = default
+		return self[key]
+
+	def clear(self):
+		self.store.clear(self.table)
+		super(StoredDict, self).clear()
+
+	def update(self, *args, **kwargs):
+		items = dict(*args, **kwargs)
+		self.store.set(self.table, items.items())
+		super(StoredDict, self).update(items)
+
+	def __ior__(self, other):
+		self.update(other)
+		return self
+
+
+class StoredPatternDict(StoredDict, PatternDict):
+	'''PatternDict writing all changes through to a table of a Store.
+	'''
+
+
+def memory_report(name, entries, top=3, now=None):
+	'''Summarize the entries of an in-memory store in one line of a memory
+	usage report.
+
+	:param    name: Name of the store
+	:param entries: List of (sender, size in bytes, time of the oldest data or
+	                None) tuples, one per entry
+	:param     top: Number of senders using the most memory to list
+	:param     now: Current time
+	:returns: Line with number of entries, bytes, age of the oldest entry and
+	          the largest senders
+	'''
+	senders = {}
+	for sender, size, created in entries:
+		senders[sender] = senders.get(sender, 0) + size
+	line = '%-22s %6i entries %10i bytes' % (name, len(entries),
+			sum(senders.values()))
+	created = [created for sender, size, created in entries if created]
+	if created:
+		line += '  oldest %is' % ((now or time.time()) - min(created))
+	largest = sorted(senders.items(), key=lambda x: (-x[1], x[0]))[:top]
+	if largest:
+		line += '  largest: %s' % ', '.join(['%s %i' % x for x in largest])
+	return line
+
+
+def b64decode(data):
+	'''Decode base64 encoded data.
+
+	:raises ValueError: If data contains characters not used by base64 or
+	                    the padding is incorrect
+	'''
+	try:
+		if sys.version_info[0] < 3:
+			return base64.b64decode(data)
+		return base64.b64decode(data, validate=True)
+	except (TypeError, binascii.Error):
+		raise ValueError('Invalid base64 data')
+
+
+def gnupg(binary, stdin, *args):
+	'''Try to execute gpg with given input and options.
+
+	:param binary: GnuPG binary to use
+	:param  stdin: Input for GnuPG
+	:param   args: Additional command line options for GnuPG
+	:returns:      Tuple containing returncode, stdout and stderr
+	'''
+	if not binary:
+		return (99, '', 'GnuPG could not be found')
+	p = subprocess.Popen(
+			[binary, '--batch',  '--no-tty'] + list(args),
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = p.communicate(stdin)
+	return (p.returncode, out, err)
+
+
+def gpgme(stdin, *args):
+	'''Execute a GnuPG operation using GPGME instead of calling gpg directly.
+	Only the decryption of symmetrically encrypted messages is supported.
+
+	:param stdin: Input for GnuPG
+	:param  args: Command line options gpg would be called with
+	:returns:     Tuple containing returncode, stdout and stderr like gnupg() or
+	              None if GPGME is not available or the operation is not
+	              supported
+	'''
+	if not gpg or [arg for arg in args if arg != '-q'] != \
+			['--passphrase-fd', '-', '-d']:
+		return None
+	passphrase, data = bytes(stdin).split(b'\n', 1)
+	context = gpg.Context(offline=True)
+	context.pinentry_mode = gpg.constants.PINENTRY_MODE_LOOPBACK
+	context.set_passphrase_cb(
+			lambda hint, desc, prev_bad, hook=None: passphrase.decode('utf-8'))
+	try:
+		out = context.decrypt(data, verify=False)[0]
+	except gpg.errors.GpgError as e:
+		return (2, b'', str(e).encode('utf-8'))
+	return (0, out, b'')
+
+
+def find_gpg_binary(names=('gpg2','gpg')):
+	'''Check for GnuPG binary to use
+	:returns: Tuple with binary name and version.
+	'''
+	for binary in names:
+		try:
+			p = subprocess.Popen([binary, '--version'],
+					stdout=subprocess.PIPE,
+					stderr=subprocess.PIPE)
+		except OSError:
+			continue
+		version = p.communicate()[0].decode('utf-8').split('\n',1)[0]
+		if not p.returncode:
+			return binary, version
+	return None, None
+
+
+def passphrase_prefix(key):
+	'''Get the first line of the data passed to GnuPG. The passphrase is read
+	by GnuPG from this line (--passphrase-fd -).
+	'''
+	try:
+		return key.encode('utf-8') + b'\n'
+	except:
+		# For Python 2.x
+		return key + b'\n'
+
+
+def passphrase_input(key, data):
+	'''Prepend the passphrase to the data passed to GnuPG.
+	'''
+	return passphrase_prefix(key) + data
+
+
+def body_length(data, pos):
+	'''Parse a new format OpenPGP body length starting at pos.
+
+	:returns: Tuple containing the number of octets used for the length, the
+	          length of the body and if it is only the length of a partial body
+	'''
+	octets = bytearray(data[pos:pos+5])
+	try:
+		if octets[0] < 192:
+			return (1, octets[0], False)
+		if octets[0] < 224:
+			return (2, ((octets[0] - 192) << 8) + octets[1] + 192, False)
+		if octets[0] == 255:
+			return (5, (octets[1] << 24) | (octets[2] << 16) | (octets[3] << 8) |
+					octets[4], False)
+		return (1, 1 << (octets[0] & 0x1f), True)
+	except IndexError:
+		raise ValueError('Truncated packet header')
+
+
+def packet_header(data, pos):
+	'''Parse the header of the OpenPGP packet starting at pos.
+
+	:param data: Binary OpenPGP data
+	:param  pos: Position of the packet
+	:returns:    Tuple containing the packet tag, the length of the header, the
+	             length of the body (None if it extends to the end of the data)
+	             and if the length is only the length of a partial body
+	'''
+	octets = bytearray(data[pos:pos+5])
+	if not octets or not octets[0] & 0x80:
+		raise ValueError('Invalid packet header')
+	if octets[0] & 0x40:
+		# New format header
+		size, length, partial = body_length(data, pos + 1)
+		return (octets[0] & 0x3f, 1 + size, length, partial)
+	# Old format header
+	tag = (octets[0] >> 2) & 0x0f
+	if octets[0] & 0x03 == 3:
+		return (tag, 1, None, False)
+	header_len = 1 + (1 << (octets[0] & 0x03))
+	if len(octets) < header_len:
+		raise ValueError('Truncated packet header')
+	length = 0
+	for octet in octets[1:header_len]:
+		length = (length << 8) | octet
+	return (tag, header_len, length, False)
+
+
+def inspect(data, max_length=MAX_ENCRYPTED_LEN, complete=True):
+	'''Check the outer OpenPGP packets of a symmetrically encrypted message
+	without decrypting it. The message has to consist of a symmetric-key
+	encrypted session key packet followed by an encrypted data packet which
+	extends exactly to the end of the message.
+
+	:param       data: Binary OpenPGP message
+	:param max_length: Maximum length of the message
+	:param   complete: False if data is only the beginning of a message (e.g.
+	                   its first part). Only the packets in data are checked.
+	:returns:          Dictionary describing the cipher and S2K parameters used
+	:raises ValueError: If the message is malformed, truncated or too large
+	'''
+	if len(data) > max_length:
+		raise ValueError('Message too large (%i bytes)' % len(data))
+
+	# Symmetric-key encrypted session key packet
+	tag, header_len, length, partial = packet_header(data, 0)
+	if tag != 3 or partial or length is None:
+		raise ValueError('Message does not start with a symmetric-key encrypted '
+				'session key packet')
+	if not complete and len(data) < header_len + length:
+		return {}
+	body = bytearray(data[header_len:header_len+length])
+	if len(body) < length or length < 4:
+		raise ValueError('Truncated session key packet')
+	info = {'version': body[0]}
+	if body[0] == 4:
+		s2k = 2
+	elif body[0] == 5:
+		s2k = 3
+		info['aead'] = body[2]
+	else:
+		raise ValueError('Unsupported session key packet version %i' % body[0])
+	if not body[s2k] in S2K_TYPES:
+		raise ValueError('Unsupported S2K type %i' % body[s2k])
+	if length < s2k + S2K_LENGTHS[body[s2k]]:
+		raise ValueError('Truncated S2K specifier')
+	info['cipher'] = CIPHERS.get(body[1], str(body[1]))
+	info['s2k'] = S2K_TYPES[body[s2k]]
+	info['hash'] = HASHES.get(body[s2k+1], str(body[s2k+1]))
+	info['count'] = None
+	if body[s2k] == 3:
+		c = body[s2k+10]
+		info['count'] = (16 + (c & 15)) << ((c >> 4) + 6)
+
+	# Encrypted data packet. Its body might be split in several partial bodies.
+	pos = header_len + length
+	if not complete and len(data) < pos + 6:
+		return info
+	tag, header_len, length, partial = packet_header(data, pos)
+	if not tag in ENCRYPTED_PACKETS:
+		raise ValueError('Unexpected packet with tag %i' % tag)
+	info['packet'] = ENCRYPTED_PACKETS[tag]
+	if length is None or not complete:
+		return info
+	pos += header_len + length
+	while partial and pos <= len(data):
+		header_len, length, partial = body_length(data, pos)
+		pos += header_len + length
+	if pos > len(data):
+		raise ValueError('Truncated encrypted data packet')
+	if pos != len(data):
+		raise ValueError('Unexpected data after encrypted data packet')
+	return info
+
+
+def encrypt(binary, key, message, cipher=DEFAULT_CIPHER):
+	'''Encrypt a message symmetrically.
+
+	:param  binary: GnuPG binary to use
+	:param     key: Passphrase
+	:param message: Message to encrypt
+	:param  cipher: Symmetric cipher to use
+	:returns:       Tuple containing returncode, base64 encoded encrypted
+	                message and stderr
+	'''
+	try:
+		message = message.encode('utf-8')
+	except (UnicodeDecodeError, AttributeError):
+		pass
+	(ret, out, err) = gnupg(binary, passphrase_input(key, message),
+			'--symmetric', '--cipher-algo', cipher, '--passphrase-fd', '-')
+	if ret:
+		return (ret, '', err)
+	return (ret, base64.b64encode(out).decode('utf-8'), err)
+
+
+def decrypt(binary, key, message):
+	'''Decrypt a base64 encoded, symmetrically encrypted message.
+
+	:param  binary: GnuPG binary to use
+	:param     key: Passphrase
+	:param message: Base64 encoded message
+	:returns:       Tuple containing returncode, decrypted message and stderr
+	'''
+	try:
+		data = base64.b64decode(message)
+	except:
+		return (98, '', b'Could not Base64 decode message.')
+	return decrypt_data(binary, key, data)
+
+
+def decrypt_data(binary, key, data):
+	'''Decrypt a symmetrically encrypted message.
+
+	:param binary: GnuPG binary to use
+	:param    key: Passphrase
+	:param   data: Binary encrypted message
+	:returns:      Tuple containing returncode, decrypted message and stderr
+	'''
+	try:
+		inspect(data)
+	except ValueError as e:
+		return (97, '', ('Invalid encrypted message: %s' % e).encode('utf-8'))
+	(ret, out, err) = gnupg(binary, passphrase_input(key, bytes(data)),
+			'--passphrase-fd', '-', '-q', '-d')
+	if ret:
+		return (ret, '', err)
+	return (ret, out.decode('utf-8'), err)
+
+
+def hkdf(key, info, length=32):
+	'''Derive a key using HKDF with SHA-256 and without salt (RFC 5869).
+	'''
+	prk = hmac.new(b'\0' * 32, key, hashlib.sha256).digest()
+	okm = block = b''
+	i = 0
+	while len(okm) < length:
+		i += 1
+		block = hmac.new(prk, block + info + struct.pack('B', i),
+				hashlib.sha256).digest()
+		okm += block
+	return okm[:length]
+
+
+class ReplayError(ValueError):
+	'''Raised if a message encrypted with a session key was already received.
+	'''
+
+
+class EpochError(ValueError):
+	'''Raised if a message encrypted with a session key is from an epoch which
+	is over, e.g. if it is played back by a bouncer.
+	'''
+
+
+class Session:
+	'''Class used for encrypting messages for one target with AES-GCM instead of
+	GnuPG. The session key is derived once from the passphrase of the target.
+	Every hour (epoch), a new message key is derived from it for each sender
+	nick. Each message contains the epoch, a random id of the sender and a
+	counter, which are used as nonce and authenticated together with the
+	target. Messages with a counter not larger than the last one received from
+	the same sender are rejected as replayed.
+
+	Since the message keys depend on the nick, a nonce can only repeat if two
+	clients using the same nick (e.g. behind a bouncer) choose the same 32 bit
+	id within an epoch.'''
+
+	def __init__(self, passphrase, target):
+		try:
+			passphrase = passphrase.encode('utf-8')
+		except (UnicodeDecodeError, AttributeError):
+			pass
+		self.target  = target.lower().encode('utf-8')
+		self.key     = hashlib.pbkdf2_hmac('sha256', passphrase,
+				SESSION_SALT + self.target, SESSION_ITERATIONS)
+		self.sender  = os.urandom(4)
+		self.counter = 0
+		self.ciphers = {}
+		self.last    = {}
+
+	def cipher(self, epoch, nick):
+		'''Get the cipher for messages of nick in an epoch. Ciphers of old epochs
+		are dropped.
+		'''
+		nick = nick.lower().encode('utf-8')
+		if not (epoch, nick) in self.ciphers:
+			for old in [e for e in self.ciphers if e[0] < epoch - 1]:
+				del self.ciphers[old]
+			self.ciphers[(epoch, nick)] = AESGCM(hkdf(self.key,
+				b'IRCrypt epoch ' + str(epoch).encode('ascii') + b' ' + nick))
+		return self.ciphers[(epoch, nick)]
+
+	def encrypt(self, message, now=None, nick=''):
+		'''Encrypt a message.
+
+		:param message: Message to encrypt
+		:param     now: Current time
+		:param    nick: Own nick
+		:returns:       Base64 encoded encrypted message
+		'''
+		try:
+			message = message.encode('utf-8')
+		except (UnicodeDecodeError, AttributeError):
+			pass
+		self.counter += 1
+		epoch = int((time.time() if now is None else now) // REKEY_INTERVAL)
+		header = SESSION_HEADER.pack(SESSION_VERSION, epoch, self.sender,
+				self.counter)
+		data = self.cipher(epoch, nick).encrypt(header[5:], message,
+				header + self.target)
+		return base64.b64encode(header + data).decode('ascii')
+
+	def decrypt(self, data, now=None, nick='', live=True):
+		'''Decrypt a message.
+
+		:param data: Binary encrypted message
+		:param  now: Current time
+		:param nick: Nick of the sender
+		:param live: Reject replayed messages and messages from other epochs.
+		             Disable this for messages read from logs.
+		:returns:    Decrypted message
+		:raises ReplayError: If the message was already received
+		:raises  EpochError: If the epoch of the message is over
+		:raises  ValueError: If the message is invalid, from a future epoch or
+		                     was modified
+		'''
+		data = bytes(data)
+		if len(data) < SESSION_HEADER.size + 16:
+			raise ValueError('Message too short')
+		header = data[:SESSION_HEADER.size]
+		version, epoch, sender, counter = SESSION_HEADER.unpack(header)
+		if version != SESSION_VERSION:
+			raise ValueError('Unsupported version %i' % version)
+		sender = (nick.lower(), sender)
+		if live:
+			current = int((time.time() if now is None else now) // REKEY_INTERVAL)
+			if epoch < current - 1:
+				raise EpochError('Message from an old epoch')
+			if epoch > current + 1:
+				raise ValueError('Message from a future epoch')
+			if (epoch, counter) <= self.last.get(sender, (0, 0)):
+				raise ReplayError('Replayed message')
+		try:
+			message = self.cipher(epoch, nick).decrypt(header[5:],
+					data[SESSION_HEADER.size:], header + self.target)
+		except InvalidTag:
+			raise ValueError('Message could not be authenticated')
+		if live:
+			self.last[sender] = (epoch, counter)
+		return message.decode('utf-8')
+
+
+class SessionCache(dict):
+	'''Dictionary mapping targets to the passphrase and the Session used for
+	them.
+	'''
+
+	def session(self, target, key):
+		'''Get the session for target with the session key derived from key. The
+		session is created again if the key changed.
+		'''
+		session = self.get(target)
+		if not session or session[0] != key:
+			session = self[target] = (key, Session(key, target))
+		return session[1]
+
+
+def decrypt_session(sessions, target, key, message, nick):
+	'''Decrypt a message encrypted with a session key (>CRY2-) read e.g. from
+	a log. Since messages are no longer received live, neither replayed
+	messages nor messages from other epochs are rejected.
+
+	:param sessions: SessionCache
+	:param   target: Server and channel the message was sent to (server/channel)
+	:param      key: Passphrase
+	:param  message: Binary encrypted message
+	:param     nick: Nick of the sender
+	:returns:        Decrypted message
+	:raises ValueError: If the message cannot be decrypted
+	'''
+	if not AESGCM:
+		raise ValueError('The Python module cryptography is not installed')
+	if not target or not nick:
+		raise ValueError('Target and sender are needed for session keys')
+	return sessions.session(target.lower(), key).decrypt(message, nick=nick,
+			live=False)
+
+
+def irc_nick(line):
+	'''Get the nick of the sender of a raw IRC line or None.
+	'''
+	match = re.match(r'^(?:@\S+ )?:([^! ]+)', line)
+	return match.group(1) if match else None
+
+
+def frame(msg, pre='CRY', length=MAX_PART_LEN, forward=False, msgid=None):
+	'''Split encrypted message in blocks of at most length characters. The
+	blocks are returned in the order they are sent. By default, the last block
+	is sent first (>CRY-n). If forward is set, the first block is sent first
+	and each block contains the total number of blocks (>CRY-i/n), allowing the
+	receiver to start decrypting before the whole message is received.
+
+	If a message consists of several blocks and a message id is given, the id
+	is put in front of the block numbers (>CRY-id.n). The receiver then
+	reassembles the blocks independently of other messages of the sender.
+
+	:param     msg: Base64 encoded encrypted message
+	:param     pre: Protocol prefix of the parts
+	:param  length: Maximum length of a block
+	:param forward: Send first block first
+	:param   msgid: Message id of up to MSGID_LEN hexadecimal digits
+	:returns:       List of message parts
+	'''
+	msg = msg.rstrip()
+	blocks = [msg[i:i+length] for i in range(0, len(msg), length)]
+	tag = '%s-%s.' % (pre, msgid) if msgid and len(blocks) > 1 else pre + '-'
+	if forward:
+		return ['>%s%i/%i %s' % (tag, i, len(blocks), block)
+			for i, block in enumerate(blocks)]
+	return ['>%s%i %s' % (tag, i, block) for i, block in enumerate(blocks)][::-1]
+
+
+def split(cmd, pre, msg, length=MAX_PART_LEN, forward=False, msgid=None):
+	'''Convert encrypted message in length sized blocks, each prefixed by the
+	IRC command cmd.
+	'''
+	return '\n'.join(['%s:%s' % (cmd, part)
+		for part in frame(msg, pre, length, forward, msgid)])
+
+
+def parse_part(line, pre='CRY'):
+	'''Parse a message part.
+
+	:param line: Line containing a message part
+	:param  pre: Protocol prefix of the parts
+	:returns:    Tuple containing everything in front of the part, the number
+	             of the part, the total number of parts (None if parts are sent
+	             last part first), the message id (None if not set) and its
+	             content or None if the line does not contain a valid part.
+	'''
+	try:
+		before, part = line.split('>%s-' % pre, 1)
+		number, part = part.split(' ', 1)
+		msgid, tagged, number = number.rpartition('.')
+		number, forward, total = number.partition('/')
+		number = int(number)
+		total = int(total) if forward else None
+		if total is not None and not 0 <= number < total:
+			return None
+		# Every part contains at least one byte of the encrypted message
+		if max(number, total or 0) > MAX_ENCRYPTED_LEN:
+			return None
+		if tagged and (not 0 < len(msgid) <= MSGID_LEN
+				or msgid.strip('0123456789abcdef')):
+			return None
+		return (before, number, total, msgid or None, part.strip())
+	except ValueError:
+		return None
+
+
+class Profiler:
+	'''Class used for profiling the hooks of a WeeChat script. WeeChat looks up
+	callbacks by name, so while the profiler is running the functions are
+	replaced in the namespace of the script by wrappers collecting statistics.
+	Once it is stopped, the original functions are restored and profiling
+	costs nothing.
+	'''
+
+	def __init__(self, namespace, names):
+		self.namespace = namespace
+		self.names     = names
+		self.profile   = None
+		self.originals = {}
+
+	def start(self):
+		'''Start collecting new statistics.
+		'''
+		self.stop()
+		self.profile = cProfile.Profile()
+		for name in self.names:
+			function = self.namespace[name]
+			self.originals[name] = function
+			self.namespace[name] = self.wrap(function)
+
+	def wrap(self, function):
+		profile = self.profile
+		def wrapper(*args):
+			return profile.runcall(function, *args)
+		return wrapper
+
+	def stop(self):
+		'''Restore the original functions. Collected statistics are kept.
+		'''
+		self.namespace.update(self.originals)
+		self.originals.clear()
+
+	def running(self):
+		return bool(self.originals)
+
+	def dump(self, path):
+		'''Write collected statistics sorted by cumulative time to path.
+
+		:returns: False if no statistics were collected
+		'''
+		if not self.profile:
+			return False
+		try:
+			stats = pstats.Stats(self.profile)
+		except TypeError:
+			# No calls were profiled yet
+			return False
+		with open(path, 'w') as f:
+			stats.stream = f
+			stats.sort_stats('cumulative').print_stats()
+		return True
+
+
+def main(argv=None):
+	'''Command line interface. Messages are read line by line from stdin and
+	written to stdout.
+	'''
+	import argparse
+	parser = argparse.ArgumentParser(
+			description='Encrypt or decrypt IRCrypt messages')
+	parser.add_argument('mode', choices=['encrypt', 'decrypt'])
+	parser.add_argument('-k', '--key', required=True, help='passphrase')
+	parser.add_argument('-c', '--cipher', default=DEFAULT_CIPHER,
+			help='symmetric cipher used for encryption')
+	parser.add_argument('-b', '--binary', help='GnuPG binary to use')
+	parser.add_argument('-f', '--forward', action='store_true',
+			help='send encrypted message parts first part first')
+	parser.add_argument('-t', '--target',
+			help='server/channel of messages encrypted with session keys')
+	parser.add_argument('-n', '--nick', help='sender of messages encrypted with '
+			'session keys if not read from IRC lines')
+	args = parser.parse_args(argv)
+
+	binary = args.binary or find_gpg_binary(('gpg', 'gpg2'))[0]
+	if not binary:
+		sys.stderr.write('GnuPG could not be found\n')
+		return 1
+
+	status = 0
+	reassembler = DecodingReassembler()
+	sessions = SessionCache()
+	for line in iter(sys.stdin.readline, ''):
+		line = line.rstrip('\r\n')
+		if args.mode == 'encrypt':
+			(ret, out, err) = encrypt(binary, args.key, line, args.cipher)
+			if not ret:
+				out = '\n'.join(frame(out, forward=args.forward))
+		else:
+			pre = 'CRY2' if '>CRY2-' in line else 'CRY'
+			part = parse_part(line, pre)
+			if not part:
+				# Pass through everything which is not encrypted
+				out, ret = line, 0
+			else:
+				before, number, total, msgid, part = part
+				try:
+					message = reassembler.update((before, msgid, pre), number, part,
+							total=total)
+					if message is None:
+						continue
+					if pre == 'CRY2':
+						(ret, out, err) = (0, decrypt_session(sessions, args.target,
+							args.key, message, args.nick or irc_nick(before)), b'')
+					else:
+						(ret, out, err) = decrypt_data(binary, args.key, message)
+				except ValueError as e:
+					sys.stderr.write('%s\n' % e)
+					status = 1
+					continue
+				out = before + out
+		if ret:
+			sys.stderr.write(err.decode('utf-8') + '\n')
+			status = 1
+			continue
+		sys.stdout.write(out + '\n')
+		sys.stdout.flush()
+	return status
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,104 @@
+'''
+Microbenchmarks for IRCrypt. Run with:  python tests/benchmark.py
+'''
+import sys, os, timeit
+sys.path.append((os.path.dirname(__file__) or '.') + '/..')
+import ircrypt_core
+
+# The key exchange addon cannot be imported by name due to the dash
+keyex_path = (os.path.dirname(__file__) or '.') + '/../ircrypt-keyex.py'
+try:
+	import importlib.util
+	spec = importlib.util.spec_from_file_location('ircrypt_keyex', keyex_path)
+	ircrypt_keyex = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(ircrypt_keyex)
+except ImportError:
+	# For Python 2.x
+	import imp
+	ircrypt_keyex = imp.load_source('ircrypt_keyex', keyex_path)
+
+
+def xor_per_character(a, b):
+	'''Combination of key parts as done by previous versions of KeyExchange'''
+	return ''.join(chr(ord(x) ^ ord(y)) for x, y in zip(a, b))
+
+
+def bench_key_combination(sizes=(64, 256, 1024, 4096), number=2000):
+	'''Compare KeyExchange.update with the old per-character combination for
+	key parts of different sizes.
+	'''
+	print('Key combination (%i runs)' % number)
+	for size in sizes:
+		a, b = os.urandom(size), os.urandom(size)
+		a_str = ''.join(chr(x) for x in bytearray(a))
+		b_str = ''.join(chr(x) for x in bytearray(b))
+
+		def update():
+			key_ex = ircrypt_keyex.KeyExchange(False, False)
+			key_ex.update(a)
+			key_ex.update(b)
+
+		new = timeit.timeit(update, number=number)
+		old = timeit.timeit(lambda: xor_per_character(a_str, b_str),
+				number=number)
+		print('  %5i bytes: update %8.2f us   per character %8.2f us' %
+				(size, new / number * 1e6, old / number * 1e6))
+
+
+def bench_encryption(number=50):
+	'''Compare encrypting and decrypting messages with GnuPG and with a session
+	key (>CRY2-).
+	'''
+	import base64
+	binary = ircrypt_core.find_gpg_binary(('gpg', 'gpg2'))[0]
+	message = 'x' * 400
+	print('Encryption of a %i byte message (%i runs)' % (len(message), number))
+
+	def gnupg():
+		ret, out, err = ircrypt_core.encrypt(binary, 'key', message)
+		ircrypt_core.decrypt(binary, 'key', out)
+
+	print('  GnuPG        %10.2f us' %
+			(timeit.timeit(gnupg, number=number) / number * 1e6))
+	if not ircrypt_core.AESGCM:
+		print('  Session key  skipped (cryptography is not installed)')
+		return
+	sender = ircrypt_core.Session('key', 'server/#channel')
+	receiver = ircrypt_core.Session('key', 'server/#channel')
+
+	def session():
+		receiver.decrypt(base64.b64decode(sender.encrypt(message)))
+
+	number *= 1000
+	print('  Session key  %10.2f us' %
+			(timeit.timeit(session, number=number) / number * 1e6))
+
+
+def bench_backend(number=20):
+	'''Compare the latency of decrypting a message by calling the GnuPG binary
+	and by using GPGME. The time needed to start gpg without doing anything
+	shows how much of the latency of the binary is process creation.
+	'''
+	import base64
+	binary = ircrypt_core.find_gpg_binary(('gpg', 'gpg2'))[0]
+	ret, out, err = ircrypt_core.encrypt(binary, 'key', 'x' * 400)
+	stdin = ircrypt_core.passphrase_input('key', base64.b64decode(out))
+	args = ('--passphrase-fd', '-', '-q', '-d')
+	print('Decryption backends (%i runs)' % number)
+	print('  gpg startup  %10.2f us' % (timeit.timeit(
+		lambda: ircrypt_core.gnupg(binary, b'', '--version'),
+		number=number) / number * 1e6))
+	print('  subprocess   %10.2f us' % (timeit.timeit(
+		lambda: ircrypt_core.gnupg(binary, stdin, *args),
+		number=number) / number * 1e6))
+	if not ircrypt_core.gpg:
+		print('  gpgme        skipped (gpg is not installed)')
+		return
+	print('  gpgme        %10.2f us' % (timeit.timeit(
+		lambda: ircrypt_core.gpgme(stdin, *args), number=number) / number * 1e6))
+
+
+if __name__ == '__main__':
+	bench_key_combination()
+	bench_encryption()
+	bench_backend()
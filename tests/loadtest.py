@@ -0,0 +1,352 @@
+'''
+Load test for IRCrypt. Several simulated WeeChat clients, each running its own
+copy of ircrypt.py and ircrypt-keyex.py, are connected by a tiny IRC relay.
+They exchange keys and send encrypted messages to a channel. End-to-end
+throughput, latency and memory are reported. Run with:
+
+   python tests/loadtest.py [-c <clients>] [-n <messages>] [--session-keys]
+
+Everything runs offline in a single process. GnuPG is called like it is
+called by WeeChat and each client gets its own WeeChat home directory.
+'''
+import sys, os, time, shutil, tempfile, subprocess, types, collections
+import argparse
+try:
+	import resource
+except ImportError:
+	resource = None
+
+BASE = os.path.abspath((os.path.dirname(__file__) or '.') + '/..')
+sys.path.append(BASE)
+sys.path.append(os.path.join(BASE, 'tests'))
+import weechat
+
+# Name of the simulated IRC server
+SERVER = 'sim'
+
+# Channel used for the load test
+CHANNEL = '#load'
+
+
+class Client:
+	'''Simulated WeeChat connected to the relay.
+	'''
+
+	def __init__(self, relay, nick, home):
+		self.relay   = relay
+		self.nick    = nick
+		self.home    = home
+		self.options = {}
+		self.hooks   = collections.OrderedDict()
+		self.scripts = {}
+		self.output  = []
+		self.display = None
+		relay.connect(self)
+
+	def load(self, filename):
+		'''Load a script like WeeChat does. Each script of the client gets its own
+		API object.
+		'''
+		name = os.path.splitext(filename)[0]
+		api = weechat.WeeChat(self)
+		module = types.ModuleType('__main__')
+		module.__file__ = os.path.join(BASE, filename)
+		api.namespace = module.__dict__
+		saved = sys.modules.get('weechat')
+		sys.modules['weechat'] = api
+		try:
+			with open(module.__file__) as f:
+				exec(compile(f.read(), module.__file__, 'exec'), module.__dict__)
+		finally:
+			if saved is None:
+				sys.modules.pop('weechat', None)
+			else:
+				sys.modules['weechat'] = saved
+		self.scripts[name] = module
+		return module
+
+	def hook(self, hook):
+		name = 'hook-%i' % id(hook)
+		self.hooks[name] = hook
+		return name
+
+	def find(self, kind, name):
+		return [hook for hook in list(self.hooks.values())
+				if hook.kind == kind and hook.name == name]
+
+	def set(self, name, value):
+		'''Set a configuration option like /set does.
+		'''
+		self.options[name].api.config_option_set(name, value, 1)
+
+	def command(self, buffer, command):
+		'''Execute a command given by a script or the user.
+		'''
+		if command.startswith('/mute '):
+			command = command[len('/mute '):]
+			if command.startswith('-all '):
+				command = command[len('-all '):]
+		name, args = (command.lstrip('/').split(' ', 1) + [''])[:2]
+		if name in ('msg', 'notice'):
+			if args.startswith('-server '):
+				args = args.split(' ', 2)[2]
+			target, text = args.split(' ', 1)
+			self.send('PRIVMSG' if name == 'msg' else 'NOTICE', target, text)
+		elif name == 'quote':
+			if args.startswith('-server '):
+				args = args.split(' ', 2)[2]
+			info = weechat.parse_message(args)
+			self.send(info['command'], info['channel'], info['text'])
+		elif name == 'server' and args.startswith('fakerecv '):
+			self.receive(args[len('fakerecv '):])
+		else:
+			for hook in self.find('command', name):
+				hook(buffer, args)
+
+	def modify(self, name, string):
+		for hook in self.find('modifier', name):
+			string = hook(name, SERVER, string)
+			if not string:
+				break
+		return string
+
+	def send(self, command, target, text):
+		'''Send a message passing it through the modifiers like WeeChat does.
+		'''
+		lines = self.modify('irc_out_%s' % command.lower(),
+				'%s %s :%s' % (command, target, text))
+		for line in (lines or '').split('\n'):
+			if line:
+				self.relay.send(self, line)
+
+	def receive(self, line):
+		'''Receive a message from the relay.
+		'''
+		command = weechat.parse_message(line)['command']
+		line = self.modify('irc_in_%s' % command.lower(), line)
+		if line and self.display:
+			self.display(self, line)
+
+	def poll(self):
+		'''Run callbacks of finished processes and due timers.
+
+		:returns: Number of callbacks run
+		'''
+		now = time.time()
+		called = 0
+		for name, hook in list(self.hooks.items()):
+			if hook.kind == 'process' and hook.name.finished():
+				del self.hooks[name]
+				returncode, out, err = hook.name.result()
+				hook(hook.name.command, returncode, out, err)
+				called += 1
+			elif hook.kind == 'timer' and hook.name.next <= now:
+				timer = hook.name
+				timer.next = now + timer.interval
+				if timer.calls:
+					timer.calls -= 1
+					if not timer.calls:
+						del self.hooks[name]
+				hook(timer.calls if timer.calls else -1)
+				called += 1
+		return called
+
+
+class Relay:
+	'''Tiny IRC server relaying messages between the simulated clients. Messages
+	are queued and delivered in order.
+	'''
+
+	def __init__(self):
+		self.clients  = {}
+		self.channels = {}
+		self.queue    = collections.deque()
+
+	def connect(self, client):
+		self.clients[client.nick.lower()] = client
+
+	def join(self, client, channel):
+		self.channels.setdefault(channel.lower(), []).append(client)
+
+	def members(self, channel):
+		return self.channels.get(channel.lower(), [])
+
+	def send(self, sender, line):
+		target = line.split(' ', 2)[1]
+		if target[0] in '#&':
+			recipients = [c for c in self.members(target) if c is not sender]
+		else:
+			recipients = [self.clients[target.lower()]] \
+					if target.lower() in self.clients else []
+		line = ':%s!%s@%s %s' % (sender.nick, sender.nick, SERVER, line)
+		for client in recipients:
+			self.queue.append((client, line))
+
+	def deliver(self):
+		'''Deliver all queued messages.
+
+		:returns: Number of delivered messages
+		'''
+		delivered = 0
+		while self.queue:
+			client, line = self.queue.popleft()
+			client.receive(line)
+			delivered += 1
+		return delivered
+
+
+def run(relay, clients, done, timeout):
+	'''Run the event loop until done returns True.
+	'''
+	deadline = time.time() + timeout
+	while not done():
+		busy = relay.deliver()
+		for client in clients:
+			busy += client.poll()
+		if time.time() > deadline:
+			raise RuntimeError('Timeout')
+		if not busy:
+			time.sleep(0.001)
+
+
+def generate_key(client):
+	'''Generate the GnuPG key used by ircrypt-keyex of a client. The key is not
+	protected by a passphrase, since newer versions of GnuPG would ask for one
+	using pinentry.
+	'''
+	homedir = os.path.join(client.home, 'ircrypt')
+	os.mkdir(homedir, 0o700)
+	p = subprocess.Popen(['gpg', '--batch', '--no-tty', '--quiet', '--homedir',
+		homedir, '--gen-key'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE)
+	out, err = p.communicate(b'Key-Type: RSA\nKey-Length: 2048\n'
+			b'Subkey-Type: RSA\nSubkey-Length: 2048\nName-comment: ircrypt\n'
+			b'Expire-Date: 0\n%no-protection\n%commit\n')
+	if p.returncode:
+		raise RuntimeError(err.decode('utf-8', 'replace'))
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p * len(values)))] if values else 0
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Load test for IRCrypt')
+	parser.add_argument('-c', '--clients', type=int, default=2,
+			help='number of clients (default: 2)')
+	parser.add_argument('-n', '--messages', type=int, default=20,
+			help='messages sent by each client (default: 20)')
+	parser.add_argument('-l', '--length', type=int, default=100,
+			help='length of the messages (default: 100)')
+	parser.add_argument('-k', '--key-exchange', action='store_true',
+			help='exchange keys between the first and all other clients using '
+			'ircrypt-keyex (generates a GnuPG key for each client)')
+	parser.add_argument('-s', '--session-keys', action='store_true',
+			help='enable ircrypt.general.session_keys')
+	parser.add_argument('-f', '--forward-parts', action='store_true',
+			help='enable ircrypt.general.forward_parts')
+	parser.add_argument('-b', '--burst-threshold', type=int,
+			help='set ircrypt.burst.threshold')
+	parser.add_argument('-t', '--timeout', type=int, default=600,
+			help='timeout in seconds (default: 600)')
+	parser.add_argument('-v', '--verbose', action='store_true',
+			help='print messages of the clients')
+	args = parser.parse_args(argv)
+
+	home = tempfile.mkdtemp(prefix='ircrypt-load')
+	relay = Relay()
+	clients = []
+	try:
+		for i in range(args.clients):
+			client = Client(relay, 'client%i' % i, os.path.join(home, str(i)))
+			os.mkdir(client.home)
+			relay.join(client, CHANNEL)
+			client.load('ircrypt.py')
+			if args.session_keys:
+				client.set('ircrypt.general.session_keys', 'on')
+			if args.forward_parts:
+				client.set('ircrypt.general.forward_parts', 'on')
+			if args.burst_threshold is not None:
+				client.set('ircrypt.burst.threshold', str(args.burst_threshold))
+			clients.append(client)
+		run(relay, clients, lambda: all(c.scripts['ircrypt'].ircrypt_ready
+			for c in clients), args.timeout)
+
+		if args.key_exchange:
+			started = time.time()
+			for client in clients:
+				generate_key(client)
+				client.load('ircrypt-keyex.py')
+			run(relay, clients, lambda: all(c.scripts['ircrypt-keyex'].ircrypt_gpg_id
+				for c in clients), args.timeout)
+			print('Generated %i GnuPG keys in %.2f s' %
+					(len(clients), time.time() - started))
+			started = time.time()
+			for client in clients[1:]:
+				clients[0].command('', '/ircrypt-keyex start -server %s %s' %
+						(SERVER, client.nick))
+			run(relay, clients, lambda: not any(
+				c.scripts['ircrypt-keyex'].ircrypt_key_ex_memory for c in clients),
+				args.timeout)
+			exchanged = [c for c in clients[1:] if c.scripts['ircrypt'].ircrypt_keys
+					.get(('%s/%s' % (SERVER, clients[0].nick)).lower())]
+			print('Exchanged %i/%i keys in %.2f s' % (len(exchanged),
+				len(clients) - 1, time.time() - started))
+
+		for client in clients:
+			client.command('', '/ircrypt set-key -server %s %s secret' %
+					(SERVER, CHANNEL))
+
+		# Send messages round robin and measure the time until they are displayed
+		sent = {}
+		latencies = []
+		def display(client, line):
+			text = weechat.parse_message(line)['text'].split()
+			if text[:1] == ['load'] and (text[1], text[2]) in sent:
+				latencies.append(time.time() - sent[(text[1], text[2])])
+		for client in clients:
+			client.display = display
+		expected = args.messages * len(clients) * (len(clients) - 1)
+		started = time.time()
+		for i in range(args.messages):
+			for client in clients:
+				text = 'load %s %i ' % (client.nick, i)
+				sent[(client.nick, str(i))] = time.time()
+				client.send('PRIVMSG', CHANNEL,
+						text + 'x' * max(0, args.length - len(text)))
+			relay.deliver()
+			for client in clients:
+				client.poll()
+		run(relay, clients, lambda: len(latencies) >= expected, args.timeout)
+		duration = time.time() - started
+
+		spawns = sum(sum(value for (name, server), value in
+			client.scripts['ircrypt'].ircrypt_metrics.items()
+			if name == 'gpg_spawns') for client in clients)
+		print('Delivered %i messages in %.2f s (%.1f messages/s)' %
+				(len(latencies), duration, len(latencies) / duration))
+		print('Latency: median %.1f ms, 95%% %.1f ms, max %.1f ms' %
+				(1000 * percentile(latencies, 0.5),
+					1000 * percentile(latencies, 0.95), 1000 * max(latencies)))
+		print('GnuPG processes: %i' % spawns)
+		if resource:
+			print('Peak memory: %.1f MiB' %
+					(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+		if args.verbose:
+			for client in clients:
+				print('\n'.join('%s: %s' % (client.nick, x) for x in client.output))
+	finally:
+		for client in clients:
+			for name in list(client.hooks):
+				client.hooks[name].api.unhook(name)
+			if args.key_exchange:
+				subprocess.call(['gpgconf', '--homedir',
+					os.path.join(client.home, 'ircrypt'), '--kill', 'gpg-agent'],
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		shutil.rmtree(home, ignore_errors=True)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
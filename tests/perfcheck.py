@@ -0,0 +1,195 @@
+'''
+Performance regression check for the parts of IRCrypt not depending on GnuPG.
+Message splitting, reassembly, key lookup and the fast paths of the hooks are
+benchmarked against the mocked WeeChat API and compared with the baseline in
+perfcheck.json. Run with:
+
+   python tests/perfcheck.py [--threshold <ratio>] [--update]
+
+Each benchmark is timed several times. A benchmark only fails if the median of
+these runs is slower than the baseline by more than the threshold and by more
+than three times the median absolute deviation (MAD) of the runs, so that a
+few disturbed runs do not cause a failure. The baseline depends on the
+machine and needs to be updated (--update) when running the check somewhere
+else.
+'''
+import sys, os, json, timeit, argparse, base64
+sys.path.append((os.path.dirname(__file__) or '.') + '/..')
+import ircrypt
+import ircrypt_core
+
+BASELINE = os.path.join(os.path.dirname(__file__) or '.', 'perfcheck.json')
+
+# Configuration options are looked up by name in the mocked configuration
+ircrypt.ircrypt_config_option.update({
+	'unencrypted' : 'ircrypt.marker.unencrypted',
+	'trace'       : 'ircrypt.general.trace',
+	})
+
+# A long encrypted message (the content does not matter for splitting and
+# reassembly)
+MESSAGE = base64.b64encode(os.urandom(1500)).decode('ascii')
+PARTS = ircrypt.ircrypt_split_msg('PRIVMSG #test :', 'CRY', MESSAGE).split('\n')
+FORWARD_PARTS = ircrypt.ircrypt_split_msg('PRIVMSG #test :', 'CRY', MESSAGE,
+		True, 'abc').split('\n')
+PREFIX = ':testnick!~testuser@example.com '
+
+
+def bench_split():
+	ircrypt.ircrypt_split_msg('PRIVMSG #test :', 'CRY', MESSAGE)
+
+
+def bench_split_forward():
+	ircrypt.ircrypt_split_msg('PRIVMSG #test :', 'CRY', MESSAGE, True, 'abc')
+
+
+def bench_reassemble():
+	reassembler = ircrypt_core.Reassembler()
+	for line in PARTS:
+		before, number, total, msgid, content = ircrypt_core.parse_part(line)
+		reassembler.update('sender', number, content)
+
+
+def bench_reassemble_decoding():
+	reassembler = ircrypt_core.DecodingReassembler()
+	for line in PARTS:
+		before, number, total, msgid, content = ircrypt_core.parse_part(line)
+		reassembler.update('sender', number, content, b'secret\n', total)
+
+
+def bench_reassemble_forward():
+	reassembler = ircrypt_core.DecodingReassembler()
+	for line in FORWARD_PARTS:
+		before, number, total, msgid, content = ircrypt_core.parse_part(line)
+		reassembler.update(('sender', msgid), number, content, b'secret\n', total)
+
+
+def bench_key_lookup():
+	ircrypt.ircrypt_key('Server', '#Channel500')
+
+
+def bench_key_lookup_pattern():
+	# Not cached, so that the patterns are matched every time
+	ircrypt.ircrypt_keys.cache.clear()
+	ircrypt.ircrypt_key('Server', '#Team-Dev')
+
+
+def bench_decrypt_hook_no_key():
+	ircrypt.ircrypt_decrypt_hook('', '', 'otherserver',
+			PREFIX + 'PRIVMSG #test :Hello World')
+
+
+def bench_decrypt_hook_unencrypted():
+	ircrypt.ircrypt_decrypt_hook('', '', 'server',
+			PREFIX + 'PRIVMSG #test :Hello World')
+
+
+def bench_decrypt_hook_parts():
+	# All parts but the last one are only buffered
+	for line in PARTS[:-1]:
+		ircrypt.ircrypt_decrypt_hook('', '', 'server', PREFIX + line)
+	ircrypt.ircrypt_msg_memory.clear()
+
+
+def bench_encrypt_hook_no_key():
+	ircrypt.ircrypt_encrypt_hook('', '', 'otherserver', 'PRIVMSG #test :Hello')
+
+
+BENCHMARKS = [(name[len('bench_'):], function)
+		for name, function in sorted(globals().items())
+		if name.startswith('bench_')]
+
+
+def setup():
+	'''Prepare the state of IRCrypt used by the benchmarks.
+	'''
+	for i in range(1000):
+		ircrypt.ircrypt_keys['server/#channel%i' % i] = 'key%i' % i
+	for i in range(100):
+		ircrypt.ircrypt_keys['server%i/*' % i] = 'key%i' % i
+	ircrypt.ircrypt_keys['*/#team-*'] = 'team'
+	ircrypt.ircrypt_keys['server/#test'] = 'secret'
+
+
+def median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(function, repeat):
+	'''Time function several times. The number of calls per run is chosen so
+	that a run takes at least 10 ms.
+
+	:returns: Dictionary with median and MAD of the time per call in seconds
+	'''
+	timer = timeit.Timer(function)
+	number = 1
+	while timer.timeit(number) < 0.01:
+		number *= 10
+	times = [t / number for t in timer.repeat(repeat, number)]
+	center = median(times)
+	return {'median': center, 'mad': median([abs(t - center) for t in times])}
+
+
+def compare(current, baseline, threshold):
+	'''Check if a benchmark got slower than its baseline.
+
+	:returns: True if the slowdown exceeds both the threshold and the noise
+	'''
+	slowdown = current['median'] - baseline['median']
+	return slowdown > threshold * baseline['median'] and \
+			slowdown > 3 * max(current['mad'], baseline['mad'])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Performance regression check')
+	parser.add_argument('-t', '--threshold', type=float, default=0.25,
+			help='allowed slowdown (default: 0.25 = 25%%)')
+	parser.add_argument('-r', '--repeat', type=int, default=15,
+			help='number of runs per benchmark (default: 15)')
+	parser.add_argument('-b', '--baseline', default=BASELINE,
+			help='baseline file (default: tests/perfcheck.json)')
+	parser.add_argument('-u', '--update', action='store_true',
+			help='write the results as new baseline')
+	args = parser.parse_args(argv)
+
+	try:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	except (IOError, OSError, ValueError):
+		baseline = {}
+
+	setup()
+	results = {}
+	failed = []
+	for name, function in BENCHMARKS:
+		results[name] = current = measure(function, args.repeat)
+		base = baseline.get(name)
+		if args.update or not base:
+			status = 'new' if not base else ''
+		elif compare(current, base, args.threshold):
+			status = 'SLOWER'
+			failed.append(name)
+		else:
+			status = 'ok'
+		print('%-26s %10.2f us  %10s  %s' % (name, current['median'] * 1e6,
+			'%+.1f%%' % (100 * (current['median'] / base['median'] - 1))
+			if base else '', status))
+
+	if args.update:
+		with open(args.baseline, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+			f.write('\n')
+		print('Baseline written to %s' % args.baseline)
+		return 0
+	if failed:
+		print('Performance regression in: %s' % ', '.join(failed))
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
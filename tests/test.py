@@ -1,8 +1,39 @@
-import sys, os
+import sys, os, binascii
 sys.path.append((os.path.dirname(__file__) or '.') + '/..')
 import ircrypt
+import ircrypt_core
 import unittest
 
+# Configuration options are looked up by name in the mocked configuration
+ircrypt.ircrypt_config_option.update({
+	'burst_threshold' : 'ircrypt.burst.threshold',
+	'burst_processes' : 'ircrypt.burst.processes',
+	'forward_parts'   : 'ircrypt.general.forward_parts',
+	'message_ids'     : 'ircrypt.general.message_ids',
+	'session_keys'    : 'ircrypt.general.session_keys',
+	'metrics_file'    : 'ircrypt.metrics.file',
+	'trace'           : 'ircrypt.general.trace',
+	'store'           : 'ircrypt.general.store',
+	})
+
+# The key exchange addon and the log decryptor cannot be imported by name due
+# to the dash
+def load_source(name, filename):
+	path = (os.path.dirname(__file__) or '.') + '/../' + filename
+	try:
+		import importlib.util
+		spec = importlib.util.spec_from_file_location(name, path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		return module
+	except ImportError:
+		# For Python 2.x
+		import imp
+		return imp.load_source(name, path)
+
+ircrypt_keyex = load_source('ircrypt_keyex', 'ircrypt-keyex.py')
+ircrypt_logdecrypt = load_source('ircrypt_logdecrypt', 'ircrypt-logdecrypt.py')
+
 
 class TestSequenceFunctions(unittest.TestCase):
 
@@ -12,8 +43,35 @@ class TestSequenceFunctions(unittest.TestCase):
 
 
 	def test_check_binary(self):
-		ircrypt.ircrypt_check_binary()
-		self.assertTrue(ircrypt.weechat.config.get('ircrypt.general.binary'))
+		ircrypt.weechat.config.pop('ircrypt.general.binary', None)
+		ircrypt.weechat.processes.clear()
+		del ircrypt.weechat.commands[:]
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		loaded = []
+		cache_load = ircrypt.ircrypt_cache_load
+		ircrypt.ircrypt_cache_load = lambda: loaded.append(
+				ircrypt.ircrypt_gpg_binary())
+		ircrypt.ircrypt_check_binary(('nonexistent', 'gpg'))
+		self.assertFalse(ircrypt.ircrypt_ready)
+		# Messages for keyed channels are queued until GnuPG is found
+		self.assertEqual(ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+			'PRIVMSG #test :test'), '')
+		ircrypt.ircrypt_check_binary_cb('nonexistent gpg', 'nonexistent',
+				ircrypt.weechat.WEECHAT_HOOK_PROCESS_ERROR, '', '')
+		self.assertEqual(sorted(ircrypt.weechat.processes),
+				['gpg', 'nonexistent gpg'])
+		ircrypt.ircrypt_check_binary_cb('gpg', 'gpg',
+				ircrypt.weechat.WEECHAT_HOOK_PROCESS_RUNNING, 'gpg (GnuPG) 2', '')
+		# The cache is loaded once the binary is known
+		self.assertEqual(loaded, [])
+		ircrypt.ircrypt_check_binary_cb('gpg', 'gpg', 0, '.2.40\n', '')
+		ircrypt.ircrypt_cache_load = cache_load
+		self.assertEqual(loaded, ['gpg'])
+		self.assertTrue(ircrypt.ircrypt_ready)
+		self.assertEqual(ircrypt.weechat.config['ircrypt.general.binary'], 'gpg')
+		self.assertEqual(ircrypt.weechat.commands,
+				['/quote -server testserver PRIVMSG #test :test'])
+		ircrypt.weechat.processes.clear()
 
 
 	def test_gnupg(self):
@@ -27,6 +85,19 @@ class TestSequenceFunctions(unittest.TestCase):
 		self.assertEqual(out, b'test')
 
 
+	def test_gnupg_backend(self):
+		import base64
+		message = base64.b64decode(TestCore.encrypted['AES'])
+		ircrypt.weechat.config['ircrypt.general.backend'] = 'gpgme'
+		(ret, out, err) = ircrypt.ircrypt_gnupg(b'secret\n' + message,
+				'--passphrase-fd', '-', '-q', '-d')
+		(wrong, _, _) = ircrypt.ircrypt_gnupg(b'wrong\n' + message,
+				'--passphrase-fd', '-', '-q', '-d')
+		ircrypt.weechat.config['ircrypt.general.backend'] = 'subprocess'
+		self.assertEqual((ret, out), (0, b'Hello World'))
+		self.assertTrue(wrong)
+
+
 	def test_split_message(self):
 		cmd = 'PRIVMSG #test '
 		pre = 'CRY'
@@ -51,6 +122,7 @@ class TestSequenceFunctions(unittest.TestCase):
 		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
 		ircrypt.ircrypt_cipher['testserver/#test'] = 'TWOFISH'
 		ircrypt.ircrypt_config_option['sym_cipher'] = None
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
 		encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver', 'PRIVMSG #test :test')
 		self.assertTrue(encmsg.startswith('PRIVMSG #test :>CRY-0 '))
 		encmsg = ':testnick!~testuser@example.com ' + encmsg
@@ -58,6 +130,446 @@ class TestSequenceFunctions(unittest.TestCase):
 		self.assertEqual(decmsg, ':testnick!~testuser@example.com PRIVMSG #test :test')
 
 
+	def test_decrypt_too_long(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_breakers.clear()
+		prefix = ':testnick!~testuser@example.com PRIVMSG #test :'
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+			prefix + '>CRY-60000 Zm9v'), '')
+		line = prefix + '>CRY-59999 Zm9vYmFy'
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+			line), line)
+		self.assertEqual(ircrypt.ircrypt_msg_memory, {})
+		ircrypt.ircrypt_breakers.clear()
+
+
+	def test_decrypt_cache(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_cipher['testserver/#test'] = 'TWOFISH'
+		ircrypt.ircrypt_config_option['sym_cipher'] = None
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.cache.size'] = 10
+		ircrypt.ircrypt_decrypt_cache.clear()
+		encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver', 'PRIVMSG #test :test')
+		encmsg = ':testnick!~testuser@example.com ' + encmsg
+		ircrypt.ircrypt_decrypt_hook('', '', 'testserver', encmsg)
+		self.assertEqual(len(ircrypt.ircrypt_decrypt_cache), 1)
+		hits = ircrypt.ircrypt_cache_stats['hits']
+		decmsg = ircrypt.ircrypt_decrypt_hook('', '', 'testserver', encmsg)
+		self.assertEqual(decmsg, ':testnick!~testuser@example.com PRIVMSG #test :test')
+		self.assertEqual(ircrypt.ircrypt_cache_stats['hits'], hits + 1)
+		del ircrypt.weechat.config['ircrypt.cache.size']
+
+
+	def test_cache_lru(self):
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.cache.size'] = 2
+		ircrypt.ircrypt_decrypt_cache.clear()
+		ircrypt.ircrypt_cache_put('a', 'A')
+		ircrypt.ircrypt_cache_put('b', 'B')
+		self.assertEqual(ircrypt.ircrypt_cache_get('a'), 'A')
+		ircrypt.ircrypt_cache_put('c', 'C')
+		self.assertEqual(ircrypt.ircrypt_cache_get('b'), None)
+		self.assertEqual(list(ircrypt.ircrypt_decrypt_cache), ['a', 'c'])
+		del ircrypt.weechat.config['ircrypt.cache.size']
+
+
+	def test_cache_persistent(self):
+		import tempfile, shutil
+		directory = tempfile.mkdtemp()
+		ircrypt.ircrypt_config_option.update({
+			'cache_size'       : 'ircrypt.cache.size',
+			'cache_persistent' : 'ircrypt.cache.persistent',
+			'cache_passphrase' : 'ircrypt.cache.passphrase',
+			})
+		ircrypt.weechat.config.update({
+			'ircrypt.cache.size'       : 10,
+			'ircrypt.cache.persistent' : 'on',
+			'ircrypt.cache.passphrase' : 'cachekey',
+			'ircrypt.general.binary'   : ircrypt_core.find_gpg_binary(
+				('gpg', 'gpg2'))[0],
+			})
+		ircrypt.weechat.infos['weechat_dir'] = directory
+		try:
+			# A missing cache file is ignored
+			ircrypt.ircrypt_decrypt_cache.clear()
+			ircrypt.ircrypt_cache_load()
+			self.assertFalse(ircrypt.ircrypt_decrypt_cache)
+			# Round trip
+			ircrypt.ircrypt_cache_put('a', u'f\xfcrst')
+			ircrypt.ircrypt_cache_put('b', 'second message')
+			ircrypt.ircrypt_cache_save()
+			self.assertEqual(os.stat(ircrypt.ircrypt_cache_file()).st_mode & 0o777,
+					0o600)
+			ircrypt.ircrypt_decrypt_cache.clear()
+			ircrypt.ircrypt_cache_load()
+			self.assertEqual(list(ircrypt.ircrypt_decrypt_cache.items()),
+					[('a', u'f\xfcrst'), ('b', 'second message')])
+			# A corrupt cache file or a wrong passphrase is reported and ignored
+			ircrypt.weechat.config['ircrypt.cache.passphrase'] = 'wrong'
+			ircrypt.ircrypt_decrypt_cache.clear()
+			ircrypt.ircrypt_cache_load()
+			self.assertFalse(ircrypt.ircrypt_decrypt_cache)
+			with open(ircrypt.ircrypt_cache_file(), 'wb') as f:
+				f.write(b'corrupt')
+			del ircrypt.weechat.printed[:]
+			ircrypt.ircrypt_cache_load()
+			self.assertFalse(ircrypt.ircrypt_decrypt_cache)
+			self.assertTrue(ircrypt.weechat.printed[-1].startswith(
+				'Could not load decryption cache'))
+		finally:
+			for option in ('size', 'persistent', 'passphrase'):
+				del ircrypt.weechat.config['ircrypt.cache.' + option]
+			ircrypt.weechat.infos.pop('weechat_dir', None)
+			shutil.rmtree(directory)
+
+
+	def test_burst_active(self):
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 2
+		ircrypt.ircrypt_burst.arrivals.clear()
+		self.assertFalse(ircrypt.ircrypt_burst_active('testserver', '#test'))
+		self.assertFalse(ircrypt.ircrypt_burst_active('testserver', '#test'))
+		self.assertTrue(ircrypt.ircrypt_burst_active('testserver', '#test'))
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		self.assertFalse(ircrypt.ircrypt_burst_active('testserver', '#test'))
+
+
+	def test_burst_order(self):
+		del ircrypt.weechat.commands[:]
+		first = ircrypt.BurstMessage('testserver', '#test', 'testnick', 'a',
+				'pre ', 'key', '', 'digest1')
+		second = ircrypt.BurstMessage('testserver', '#test', 'testnick', 'b',
+				'pre ', 'key', '', 'digest2')
+		ircrypt.ircrypt_burst.queue('testserver.#test', first)
+		ircrypt.ircrypt_burst_add(second, 'second')
+		# The second message must wait for the first one
+		self.assertEqual(ircrypt.weechat.commands, [])
+		first.result = 'pre first'
+		ircrypt.ircrypt_burst_flush('testserver', '#test')
+		self.assertEqual(ircrypt.weechat.commands, [
+			'/server fakerecv pre first', '/server fakerecv pre second'])
+		self.assertFalse(ircrypt.ircrypt_burst.queues)
+		# Injected messages are passed through by the decrypt hook
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+			'pre first'), 'pre first')
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+			'pre second'), 'pre second')
+		self.assertFalse(ircrypt.ircrypt_burst.injected)
+
+
+	def test_stream(self):
+		import subprocess
+		del ircrypt.weechat.commands[:]
+		ircrypt.weechat.processes.clear()
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.general.forward_parts'] = 'on'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_breakers.clear()
+		ircrypt.MAX_PART_LEN = 24
+		encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+				'PRIVMSG #test :test')
+		ircrypt.MAX_PART_LEN = 300
+		ircrypt.weechat.config['ircrypt.general.forward_parts'] = 'off'
+		lines = encmsg.split('\n')
+		self.assertTrue(lines[0].startswith('PRIVMSG #test :>CRY-0/%i ' %
+			len(lines)))
+		# GnuPG is started with the first part and gets all parts
+		for line in lines:
+			self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+				':testnick!~testuser@example.com ' + line), '')
+		(name, stdin), = ircrypt.weechat.processes.items()
+		self.assertTrue(stdin.endswith('-----END PGP MESSAGE-----\n'))
+		p = subprocess.Popen([ircrypt.ircrypt_gpg_binary(), '--batch',
+			'--passphrase-fd', '-', '-q', '-d'], stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out, err = p.communicate(stdin.encode('utf-8'))
+		ircrypt.ircrypt_stream_process_cb(name, '', p.returncode,
+				out.decode('utf-8'), err.decode('utf-8'))
+		self.assertEqual(ircrypt.weechat.commands, ['/server fakerecv '
+			':testnick!~testuser@example.com PRIVMSG #test :test'])
+		self.assertFalse(ircrypt.ircrypt_streams)
+		self.assertFalse(ircrypt.ircrypt_streams.running)
+		ircrypt.ircrypt_burst.injected.clear()
+
+
+	def test_stream_checked(self):
+		import base64
+		ircrypt.weechat.processes.clear()
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_breakers.clear()
+		prefix = ':testnick!~testuser@example.com PRIVMSG #test :'
+		message = base64.b64encode(base64.b64decode(
+			TestCore.encrypted['AES'])[:24]).decode('ascii')
+		# No GnuPG process is started for a first part which is no encrypted
+		# message
+		ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+				prefix + '>CRY-0/2 dGVzdHRlc3R0ZXN0')
+		self.assertFalse(ircrypt.weechat.processes)
+		# or if messages of the sender are not decrypted
+		ircrypt.ircrypt_breakers[('testserver', 'testnick')] = \
+				ircrypt.CircuitBreaker()
+		ircrypt.ircrypt_breakers[('testserver', 'testnick')].blocked_until = \
+				ircrypt.time.time() + 60
+		for i in range(5):
+			ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+					prefix + '>CRY-0/2 ' + message)
+		self.assertFalse(ircrypt.weechat.processes)
+		ircrypt.ircrypt_breakers.clear()
+		ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+				prefix + '>CRY-0/2 ' + message)
+		self.assertEqual(len(ircrypt.weechat.processes), 1)
+		ircrypt.ircrypt_stream_stop(ircrypt.ircrypt_streams.popitem()[1])
+		ircrypt.ircrypt_msg_memory.clear()
+		ircrypt.weechat.processes.clear()
+
+
+	def test_stream_limit(self):
+		import base64
+		ircrypt.weechat.processes.clear()
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.weechat.config['ircrypt.burst.processes'] = 3
+		ircrypt.ircrypt_breakers.clear()
+		prefix = ':testnick!~testuser@example.com PRIVMSG #test :'
+		message = base64.b64encode(base64.b64decode(
+			TestCore.encrypted['AES'])[:24]).decode('ascii')
+		# Only a few processes are started for messages of one sender
+		for msgid in range(5):
+			ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+					prefix + '>CRY-%x.0/5 %s' % (msgid, message))
+		self.assertEqual(len(ircrypt.weechat.processes),
+				ircrypt.STREAMS_PER_SENDER)
+		self.assertEqual(len(ircrypt.ircrypt_streams), ircrypt.STREAMS_PER_SENDER)
+		# Messages which are not completed in time count as failure
+		name = list(ircrypt.ircrypt_streams.running)[0]
+		ircrypt.ircrypt_stream_process_cb(name, '',
+				ircrypt.weechat.WEECHAT_HOOK_PROCESS_ERROR, '', '')
+		self.assertEqual(len(ircrypt.ircrypt_streams), 1)
+		self.assertEqual(
+				ircrypt.ircrypt_breakers[('testserver', 'testnick')].failures, 1)
+		# The overall limit applies to all senders
+		ircrypt.weechat.config['ircrypt.burst.processes'] = 1
+		ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+				prefix + '>CRY-5.0/5 ' + message)
+		self.assertEqual(len(ircrypt.ircrypt_streams.running), 1)
+		for stream in list(ircrypt.ircrypt_streams.values()):
+			ircrypt.ircrypt_stream_stop(stream)
+		ircrypt.ircrypt_streams.clear()
+		ircrypt.ircrypt_msg_memory.clear()
+		ircrypt.ircrypt_breakers.clear()
+		ircrypt.weechat.processes.clear()
+		del ircrypt.weechat.config['ircrypt.burst.processes']
+
+
+	def test_trace(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_traces.clear()
+		encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+				'PRIVMSG #test :test')
+		line = ':testnick!~testuser@example.com ' + encmsg
+		ircrypt.ircrypt_decrypt_hook('', '', 'testserver', line)
+		self.assertFalse(ircrypt.ircrypt_traces)
+		ircrypt.weechat.config['ircrypt.general.trace'] = 'on'
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver', line),
+				':testnick!~testuser@example.com PRIVMSG #test :test')
+		ircrypt.weechat.config['ircrypt.general.trace'] = 'off'
+		(target, trace), = ircrypt.ircrypt_traces
+		self.assertEqual(target, 'testserver/#test')
+		self.assertEqual([stage for stage, end in trace],
+				['received', 'parse', 'key', 'parts', 'check', 'gpg', 'output'])
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'trace 3'), 'OK')
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'trace x'), 'ERROR')
+		ircrypt.ircrypt_traces.clear()
+
+
+	def test_message_ids(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.general.message_ids'] = 'on'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_breakers.clear()
+		ircrypt.MAX_PART_LEN = 24
+		first = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+				'PRIVMSG #test :first').split('\n')
+		second = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+				'PRIVMSG #test :second').split('\n')
+		ircrypt.MAX_PART_LEN = 300
+		ircrypt.weechat.config['ircrypt.general.message_ids'] = 'off'
+		# Parts of both messages are received interleaved
+		result = []
+		for a, b in zip(first, second):
+			for line in (a, b):
+				result.append(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+					':testnick!~testuser@example.com ' + line))
+		self.assertEqual([line for line in result if line], [
+			':testnick!~testuser@example.com PRIVMSG #test :first',
+			':testnick!~testuser@example.com PRIVMSG #test :second'])
+
+
+	@unittest.skipIf(not ircrypt_core.AESGCM, 'cryptography is not installed')
+	def test_session_keys(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.weechat.config['ircrypt.general.session_keys'] = 'on'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.cache.size'] = 10
+		ircrypt.weechat.infos['irc_nick'] = 'TestNick'
+		encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+				'PRIVMSG #test :test')
+		del ircrypt.weechat.infos['irc_nick']
+		ircrypt.weechat.config['ircrypt.general.session_keys'] = 'off'
+		self.assertTrue(encmsg.startswith('PRIVMSG #test :>CRY2-0 '))
+		# The receiver has its own session
+		ircrypt.ircrypt_sessions.clear()
+		line = ':testnick!~testuser@example.com ' + encmsg
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver', line),
+				':testnick!~testuser@example.com PRIVMSG #test :test')
+		# Replayed messages are shown without counting a failure
+		ircrypt.ircrypt_breakers.clear()
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver', line),
+				':testnick!~testuser@example.com PRIVMSG #test :test')
+		ircrypt.ircrypt_decrypt_cache.clear()
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver', line),
+				':testnick!~testuser@example.com PRIVMSG #test :' + ircrypt.REPLAYED)
+		self.assertFalse(ircrypt.ircrypt_breakers)
+		ircrypt.ircrypt_decrypt_cache.clear()
+		del ircrypt.weechat.config['ircrypt.cache.size']
+		# Queries are always encrypted with GnuPG
+		ircrypt.ircrypt_keys['testserver/query'] = 'testkey'
+		ircrypt.ircrypt_cipher['testserver/query'] = 'TWOFISH'
+		ircrypt.weechat.config['ircrypt.general.session_keys'] = 'on'
+		parse = ircrypt.weechat.info_get_hashtable
+		ircrypt.weechat.info_get_hashtable = lambda *args: {'channel': 'query',
+				'nick': 'testnick'}
+		try:
+			encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+					'PRIVMSG query :test')
+		finally:
+			ircrypt.weechat.info_get_hashtable = parse
+			ircrypt.weechat.config['ircrypt.general.session_keys'] = 'off'
+		del ircrypt.ircrypt_keys['testserver/query']
+		del ircrypt.ircrypt_cipher['testserver/query']
+		self.assertTrue(encmsg.startswith('PRIVMSG query :>CRY-0 '))
+
+
+	def test_circuit_breaker(self):
+		ircrypt.ircrypt_keys['testserver/#test'] = 'testkey'
+		ircrypt.ircrypt_config_option['cache_size'] = 'ircrypt.cache.size'
+		ircrypt.weechat.config['ircrypt.burst.threshold'] = 0
+		ircrypt.ircrypt_breakers.clear()
+		# 'Hello World' encrypted with a different key
+		garbage = ':testnick!~testuser@example.com PRIVMSG #test :>CRY-0 ' + \
+				TestCore.encrypted['AES']
+		for i in range(ircrypt.BREAKER_FAILURES):
+			self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+				garbage), garbage)
+		# Now the breaker is open and gpg is not called anymore
+		self.assertEqual(ircrypt.ircrypt_decrypt_hook('', '', 'testserver', garbage),
+				':testnick!~testuser@example.com PRIVMSG #test :' +
+				ircrypt.UNDECRYPTABLE)
+		breaker = ircrypt.ircrypt_breakers[('testserver', 'testnick')]
+		self.assertEqual(breaker.suppressed, 1)
+		self.assertEqual(ircrypt.ircrypt_sender_ciphers['testserver/testnick'],
+				('AES (iterated SHA1, 65011712 bytes, SEIPD)', 4))
+		# Changing the key resets the breaker
+		ircrypt.ircrypt_command_set_keys('testserver/#test', 'testkey')
+		self.assertFalse(ircrypt.ircrypt_breakers)
+
+
+	def test_circuit_breaker_expire(self):
+		ircrypt.ircrypt_breakers.clear()
+		ircrypt.ircrypt_breaker_failure('testserver', 'old', 'error', '')
+		ircrypt.ircrypt_breaker_failure('testserver', 'blocked', 'error', '')
+		old = ircrypt.ircrypt_breakers[('testserver', 'old')]
+		blocked = ircrypt.ircrypt_breakers[('testserver', 'blocked')]
+		old.modified = blocked.modified = \
+				ircrypt.time.time() - ircrypt.BREAKER_MAX_BACKOFF - 1
+		blocked.blocked_until = ircrypt.time.time() + 60
+		# Senders are forgotten once a new one fails
+		ircrypt.ircrypt_breaker_failure('testserver', 'new', 'error', '')
+		self.assertEqual(sorted(ircrypt.ircrypt_breakers), [
+			('testserver', 'blocked'), ('testserver', 'new')])
+		ircrypt.ircrypt_breakers.clear()
+
+
+	def test_sender_ciphers_limit(self):
+		ircrypt.ircrypt_sender_ciphers.clear()
+		packet = {'cipher': 'AES', 's2k': 'iterated', 'hash': 'SHA1', 'count': 0,
+				'packet': 'SEIPD'}
+		for i in range(ircrypt.SENDER_CIPHERS):
+			ircrypt.ircrypt_sender_cipher('testserver', 'nick%i' % i, packet)
+		ircrypt.ircrypt_sender_cipher('testserver', 'nick0', packet)
+		ircrypt.ircrypt_sender_cipher('testserver', 'new', packet)
+		# The sender who sent a message least recently is dropped
+		self.assertEqual(len(ircrypt.ircrypt_sender_ciphers),
+				ircrypt.SENDER_CIPHERS)
+		self.assertFalse('testserver/nick1' in ircrypt.ircrypt_sender_ciphers)
+		self.assertEqual(ircrypt.ircrypt_sender_ciphers['testserver/nick0'][1], 2)
+		ircrypt.ircrypt_sender_ciphers.clear()
+
+
+	def test_metrics(self):
+		import tempfile
+		ircrypt.ircrypt_metrics.clear()
+		ircrypt.ircrypt_latencies.clear()
+		ircrypt.ircrypt_metric_inc('gpg_spawns', 'testserver')
+		ircrypt.ircrypt_metric_inc('gpg_spawns', 'testserver')
+		ircrypt.ircrypt_metric_observe('decrypt', 'testserver', 0.3)
+		ircrypt.ircrypt_metric_observe('decrypt', 'testserver', 20)
+		ircrypt.weechat.infos['ircrypt_keyex_sessions'] = 'testserver=1'
+		text = ircrypt.ircrypt_metrics_text()
+		ircrypt.weechat.infos.clear()
+		for line in ('ircrypt_gpg_spawns_total{server="testserver"} 2',
+				'ircrypt_decrypt_seconds_bucket{server="testserver",le="0.25"} 0',
+				'ircrypt_decrypt_seconds_bucket{server="testserver",le="0.5"} 1',
+				'ircrypt_decrypt_seconds_bucket{server="testserver",le="+Inf"} 2',
+				'ircrypt_decrypt_seconds_sum{server="testserver"} 20.300000',
+				'ircrypt_decrypt_seconds_count{server="testserver"} 2',
+				'ircrypt_key_exchanges{server="testserver"} 1',
+				'# TYPE ircrypt_reassembly_bytes gauge'):
+			self.assertIn(line, text.split('\n'))
+
+		directory = tempfile.mkdtemp()
+		path = os.path.join(directory, 'ircrypt.prom')
+		ircrypt.weechat.config['ircrypt.metrics.file'] = path
+		ircrypt.ircrypt_metrics_write()
+		del ircrypt.weechat.config['ircrypt.metrics.file']
+		self.assertEqual(os.listdir(directory), ['ircrypt.prom'])
+		with open(path) as f:
+			self.assertIn('ircrypt_gpg_spawns_total{server="testserver"} 2', f.read())
+		os.remove(path)
+		os.rmdir(directory)
+		ircrypt.ircrypt_metrics.clear()
+		ircrypt.ircrypt_latencies.clear()
+
+
+	def test_profile(self):
+		import tempfile
+		hook = ircrypt.ircrypt_encrypt_hook
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'profile start'), 'OK')
+		self.assertEqual(ircrypt.weechat.signals[-1], ('ircrypt_profile', 'start'))
+		self.assertNotEqual(ircrypt.ircrypt_encrypt_hook, hook)
+		self.assertEqual(ircrypt.ircrypt_encrypt_hook('', '', 'noserver',
+			'PRIVMSG #test :test'), 'PRIVMSG #test :test')
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'profile stop'), 'OK')
+		self.assertEqual(ircrypt.ircrypt_encrypt_hook, hook)
+
+		directory = tempfile.mkdtemp()
+		ircrypt.weechat.infos['weechat_dir'] = directory
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'profile dump'), 'OK')
+		del ircrypt.weechat.infos['weechat_dir']
+		path = os.path.join(directory, 'ircrypt_profile.txt')
+		with open(path) as f:
+			self.assertIn('ircrypt_encrypt_hook', f.read())
+		os.remove(path)
+		os.rmdir(directory)
+		self.assertEqual(ircrypt.ircrypt_command('', '', 'profile'), 'ERROR')
+
+
 	def test_ircrypt_info(self):
 		ircrypt.ircrypt_info('test')
 		ircrypt.ircrypt_info('test', 'buffer')
@@ -91,6 +603,100 @@ class TestSequenceFunctions(unittest.TestCase):
 		self.assertEqual(ret, 'OK')
 
 
+	def test_pattern_keys(self):
+		ircrypt.ircrypt_keys['*/#pattern-*'] = 'testkey'
+		ircrypt.ircrypt_cipher['*/#pattern-*'] = 'TWOFISH'
+		try:
+			encmsg = ircrypt.ircrypt_encrypt_hook('', '', 'testserver',
+					'PRIVMSG #Pattern-Test :test')
+			self.assertTrue(encmsg.startswith('PRIVMSG #Pattern-Test :>CRY-0 '))
+			decmsg = ircrypt.ircrypt_decrypt_hook('', '', 'testserver',
+					':testnick!~testuser@example.com ' + encmsg)
+			self.assertEqual(decmsg, ':testnick!~testuser@example.com '
+					'PRIVMSG #Pattern-Test :test')
+		finally:
+			del ircrypt.ircrypt_keys['*/#pattern-*']
+			del ircrypt.ircrypt_cipher['*/#pattern-*']
+		self.assertEqual(ircrypt.ircrypt_key('testserver', '#pattern-test'), None)
+
+
+	@unittest.skipIf(not ircrypt_core.sqlite3, 'sqlite3 is not installed')
+	def test_store(self):
+		import tempfile, shutil
+		directory = tempfile.mkdtemp()
+		keys, cipher = ircrypt.ircrypt_keys, ircrypt.ircrypt_cipher
+		try:
+			ircrypt.ircrypt_keys = ircrypt_core.PatternDict({'s/#a' : 'key'})
+			ircrypt.ircrypt_cipher = ircrypt_core.PatternDict()
+			ircrypt.weechat.infos['weechat_dir'] = directory
+			ircrypt.weechat.config['ircrypt.general.store'] = '%h/ircrypt.db'
+			# Keys from the configuration file are moved to the store
+			ircrypt.ircrypt_store_open()
+			ircrypt.ircrypt_command_set_keys('s/#b', 'other')
+			ircrypt.ircrypt_command_set_cip('s/*', 'AES')
+			ircrypt.ircrypt_command_remove_keys('s/#a')
+			store = ircrypt_core.Store(directory + '/ircrypt.db')
+			self.assertEqual(store.load('keys'), [('s/#b', 'other')])
+			self.assertEqual(store.load('cipher'), [('s/*', 'AES')])
+			store.close()
+			del ircrypt.weechat.config_lines[:]
+			ircrypt.ircrypt_config_keys_write_cb('', '', 'keys')
+			self.assertEqual(ircrypt.weechat.config_lines, [('keys', '')])
+			# Keys are loaded from the store
+			ircrypt.ircrypt_keys = ircrypt_core.PatternDict()
+			ircrypt.ircrypt_store_open()
+			self.assertEqual(ircrypt.ircrypt_key('S', '#B'), 'other')
+			# and moved back to the configuration file without store
+			ircrypt.weechat.config['ircrypt.general.store'] = ''
+			ircrypt.ircrypt_store_config_cb('', '')
+			self.assertEqual(ircrypt.ircrypt_store, None)
+			del ircrypt.weechat.config_lines[:]
+			ircrypt.ircrypt_config_keys_write_cb('', '', 'keys')
+			self.assertEqual(ircrypt.weechat.config_lines,
+					[('keys', ''), ('s/#b', 'other')])
+		finally:
+			ircrypt.ircrypt_keys, ircrypt.ircrypt_cipher = keys, cipher
+			ircrypt.weechat.config.pop('ircrypt.general.store', None)
+			ircrypt.weechat.infos.pop('weechat_dir', None)
+			shutil.rmtree(directory)
+
+
+	def test_command_memory(self):
+		ircrypt.weechat.infos['ircrypt_keyex_memory'] = 'Key exchanges 0'
+		for memory in (ircrypt.ircrypt_decrypt_cache, ircrypt.ircrypt_streams,
+				ircrypt.ircrypt_streams.running, ircrypt.ircrypt_burst.queues,
+				ircrypt.ircrypt_burst.injected, ircrypt.ircrypt_breakers,
+				ircrypt.ircrypt_sender_ciphers):
+			memory.clear()
+		ircrypt.ircrypt_decrypt_cache['digest'] = 'plain'
+		stream = ircrypt.DecryptionStream('stream', None)
+		stream.out = 'out'
+		ircrypt.ircrypt_streams.start('catchword', stream, ('server', 'nick'))
+		msg = ircrypt.BurstMessage('server', '#test', 'nick', 'args', '', 'key',
+				None, None)
+		ircrypt.ircrypt_burst.queue('server.#test', msg)
+		ircrypt.ircrypt_breakers[('server', 'other')] = ircrypt.CircuitBreaker()
+		ircrypt.ircrypt_sender_ciphers['server/nick'] = ('AES', 1)
+		del ircrypt.weechat.printed[:]
+		try:
+			self.assertEqual(ircrypt.ircrypt_command('', '', 'memory'), 'OK')
+		finally:
+			del ircrypt.weechat.infos['ircrypt_keyex_memory']
+			ircrypt.ircrypt_decrypt_cache.clear()
+			ircrypt.ircrypt_streams.running.clear()
+			ircrypt.ircrypt_burst.queues.clear()
+			ircrypt.ircrypt_breakers.clear()
+			ircrypt.ircrypt_sender_ciphers.clear()
+		report = dict([(line[1:23].strip(), line[24:]) for line in
+			ircrypt.weechat.printed[0].split('\n')[1:]])
+		for name, size in (('Decryption cache', 5), ('Decryption streams', 3),
+				('Burst messages', 4), ('Circuit breakers', 11),
+				('Sender ciphers', 3)):
+			self.assertTrue(report[name].startswith('%6i entries %10i bytes' %
+				(1, size)), name)
+		self.assertIn('largest: server/nick 4', report['Burst messages'])
+
+
 	def test_command_set_cip(self):
 		try:
 			del ircrypt.ircrypt_cipher['testserver/#test']
@@ -113,15 +719,762 @@ class TestSequenceFunctions(unittest.TestCase):
 	def test_command_list(self):
 		cip = {'testserver/#test1' : 'TWOFISH', 'testserver/#test2' : 'AES'}
 		keys = {'testserver/#test1' : 'testkey', 'testserver/#test2' : 'testkey'}
-		ircrypt.ircrypt_cipher = {}
-		ircrypt.ircrypt_keys = {}
+		ircrypt.ircrypt_cipher = ircrypt_core.PatternDict()
+		ircrypt.ircrypt_keys = ircrypt_core.PatternDict()
 		ret = ircrypt.ircrypt_command_list()
 		self.assertEqual(ret, 'OK')
-		ircrypt.ircrypt_cipher = {'testserver/#test' : 'TWOFISH'}
-		ircrypt.ircrypt_keys = {'testserver/#test' : 'testkey'}
+		ircrypt.ircrypt_cipher = ircrypt_core.PatternDict(
+				{'testserver/#test' : 'TWOFISH'})
+		ircrypt.ircrypt_keys = ircrypt_core.PatternDict(
+				{'testserver/#test' : 'testkey'})
 		ret = ircrypt.ircrypt_command_list()
 		self.assertEqual(ret, 'OK')
 
 
+class TestCore(unittest.TestCase):
+
+	def test_frame(self):
+		msg = 'Loremipsumdolorsitametconsecteturadipiscing'
+		self.assertEqual(ircrypt_core.frame(msg, 'CRY', 25),
+				['>CRY-1 secteturadipiscing', '>CRY-0 Loremipsumdolorsitametcon'])
+
+
+	def test_memory_report(self):
+		self.assertEqual(ircrypt_core.memory_report('Parts', [
+			('s/a', 10, 100), ('s/b', 30, 90), ('s/a', 25, None)], 1, 110),
+			'Parts                       3 entries         65 bytes  oldest 20s  '
+			'largest: s/a 35')
+		self.assertEqual(ircrypt_core.memory_report('Keys', [], 0),
+			'Keys                        0 entries          0 bytes')
+
+
+	def test_pattern_dict(self):
+		keys = ircrypt_core.PatternDict({
+			'server/#test'     : 'exact',
+			'server/*'         : 'server',
+			'*/#testchan*'     : 'channel',
+			'*/#tea-par*'      : 'any server',
+			'other/#te*'       : 'other',
+			})
+		self.assertEqual(keys.match('server/#test'), 'exact')
+		self.assertEqual(keys.match('server/#foo'), 'server')
+		# The pattern with the most literal characters wins
+		self.assertEqual(keys.match('server/#testchan2'), 'channel')
+		self.assertEqual(keys.match('other/#tea'), 'other')
+		# Patterns for a specific server are preferred on a tie
+		self.assertEqual(keys.match('other/#tea-party'), 'other')
+		self.assertEqual(keys.match('third/#tea-party'), 'any server')
+		self.assertEqual(keys.match('third/#foo'), None)
+		self.assertEqual(keys.match('third/#foo', 'default'), 'default')
+		# Changes invalidate the index and the cached results
+		keys['third/*'] = 'third'
+		self.assertEqual(keys.match('third/#foo'), 'third')
+		del keys['server/*']
+		self.assertEqual(keys.match('server/#foo'), None)
+		keys.pop('*/#testchan*')
+		self.assertEqual(keys.match('server/#testchan2'), None)
+		keys.setdefault('*/#testchan*', 'channel')
+		self.assertEqual(keys.match('server/#testchan2'), 'channel')
+		while keys:
+			keys.popitem()
+		self.assertEqual(keys.match('server/#testchan2'), None)
+		# Regular expression characters are matched literally
+		keys['server/#a.b*'] = 'dot'
+		self.assertEqual(keys.match('server/#axb'), None)
+		self.assertEqual(keys.match('server/#a.bc'), 'dot')
+
+
+	@unittest.skipIf(not ircrypt_core.sqlite3, 'sqlite3 is not installed')
+	def test_stored_dict(self):
+		store = ircrypt_core.Store(':memory:')
+		stored = ircrypt_core.StoredPatternDict(store, 'keys', {'s/a' : 'x'})
+		stored['s/*'] = 'y'
+		stored.setdefault('s/b', 'z')
+		stored.setdefault('s/b', 'ignored')
+		stored.pop('s/a')
+		self.assertEqual(sorted(store.load('keys')), [('s/*', 'y'), ('s/b', 'z')])
+		self.assertEqual(stored.match('s/c'), 'y')
+		# Every write path reaches the store and invalidates the pattern index
+		while stored:
+			stored.popitem()
+		self.assertEqual(store.load('keys'), [])
+		self.assertEqual(stored.match('s/c'), None)
+		stored.update({'s/a' : 'x'})
+		del stored['s/a']
+		self.assertEqual(store.load('keys'), [])
+		store.close()
+
+
+	@unittest.skipIf(not ircrypt_core.sqlite3, 'sqlite3 is not installed')
+	def test_store_mode(self):
+		import tempfile, shutil, stat
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		path = directory + '/ircrypt.db'
+		umask = os.umask(0o022)
+		try:
+			store = ircrypt_core.Store(path)
+			store.load('keys')
+			store.set('keys', [('s/a', 'x')])
+		finally:
+			os.umask(umask)
+		# The database and its write-ahead log are private
+		for name in ('', '-wal', '-shm'):
+			self.assertEqual(stat.S_IMODE(os.stat(path + name).st_mode), 0o600)
+		store.close()
+		# Existing databases are made private as well
+		os.chmod(path, 0o644)
+		ircrypt_core.Store(path).close()
+		self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+
+	def test_parse_part(self):
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-12 abc'),
+				('PRIVMSG #test :', 12, None, None, 'abc'))
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-1/3 abc'),
+				('PRIVMSG #test :', 1, 3, None, 'abc'))
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-f3.1 abc'),
+				('PRIVMSG #test :', 1, None, 'f3', 'abc'))
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-f3.0/2 abc'),
+				('PRIVMSG #test :', 0, 2, 'f3', 'abc'))
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-3/3 abc'), None)
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-?.1 abc'), None)
+		# Message ids are hexadecimal numbers of up to three digits
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-fff.1 abc'),
+				('PRIVMSG #test :', 1, None, 'fff', 'abc'))
+		for msgid in ('1000', 'x1', 'A1', ''):
+			self.assertEqual(ircrypt_core.parse_part(
+				'PRIVMSG #test :>CRY-%s.1 abc' % msgid), None)
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :hello'), None)
+		self.assertEqual(ircrypt_core.parse_part('PRIVMSG #test :>CRY-x abc'), None)
+		# Messages with more parts than bytes allowed are rejected
+		self.assertEqual(ircrypt_core.parse_part(
+			'PRIVMSG #test :>CRY-0/99999999 abc'), None)
+		self.assertEqual(ircrypt_core.parse_part(
+			'PRIVMSG #test :>CRY-99999999 abc'), None)
+
+
+	def test_reassemble(self):
+		reassembler = ircrypt_core.Reassembler()
+		self.assertEqual(reassembler.update('a', 2, 'baz'), None)
+		self.assertEqual(reassembler.update('b', 1, 'other'), None)
+		self.assertEqual(reassembler.update('a', 1, 'bar'), None)
+		self.assertEqual(reassembler.update('a', 0, 'foo'), 'foobarbaz')
+		self.assertEqual(list(reassembler.memory), ['b'])
+		reassembler.memory['b'].modified -= ircrypt_core.MSG_PART_TIMEOUT + 1
+		reassembler.expire()
+		self.assertEqual(reassembler.memory, {})
+
+
+	def test_decoding_reassembler(self):
+		import base64
+		data = bytes(bytearray(range(256))) * 3
+		parts = [ircrypt_core.parse_part(part)[1:5:3] for part in
+				ircrypt_core.frame(base64.b64encode(data).decode('ascii'), 'CRY', 100)]
+		reassembler = ircrypt_core.DecodingReassembler()
+		for number, part in parts[:-1]:
+			self.assertEqual(reassembler.update('a', number, part, b'key\n'), None)
+		number, part = parts[-1]
+		self.assertEqual(reassembler.update('a', number, part, b'key\n'),
+				b'key\n' + data)
+		self.assertEqual(reassembler.memory, {})
+		# Single part
+		self.assertEqual(reassembler.update('a', 0, 'Zm9v'), b'foo')
+		# Corrupt parts are detected on arrival
+		self.assertEqual(reassembler.update('a', 2, parts[0][1]), None)
+		self.assertRaises(ValueError, reassembler.update, 'a', 1, 'Zm9v!!!!')
+		self.assertEqual(reassembler.memory, {})
+		self.assertEqual(reassembler.update('a', 2, parts[0][1]), None)
+		self.assertRaises(ValueError, reassembler.update, 'a', 1, 'Zm9v')
+
+
+	def test_decoding_reassembler_limit(self):
+		# Part numbers announcing a message larger than MAX_ENCRYPTED_LEN are
+		# rejected before the buffer is allocated
+		reassembler = ircrypt_core.DecodingReassembler()
+		self.assertEqual(reassembler.update('a', 60000, 'Zm9v'), None)
+		self.assertRaises(ValueError, reassembler.update, 'a', 59999,
+				'Zm9vYmFy')
+		self.assertEqual(reassembler.memory, {})
+		# The same applies to the total number of parts sent first part first
+		self.assertRaises(ValueError, reassembler.update, 'a', 0, 'Zm9vYmFy',
+				total=60000)
+		self.assertEqual(reassembler.memory, {})
+
+
+	def test_decoding_reassembler_origin(self):
+		# Only a limited number of messages per user is reassembled at once
+		reassembler = ircrypt_core.DecodingReassembler()
+		for msgid in range(ircrypt_core.MESSAGES_PER_SENDER + 1):
+			self.assertEqual(reassembler.update(('a', msgid), 1, 'Zm9v',
+				origin='a'), None)
+			reassembler.memory[('a', msgid)].modified -= 100 - msgid
+		self.assertEqual(reassembler.update(('b', 0), 1, 'Zm9v', origin='b'),
+				None)
+		self.assertEqual(len(reassembler.memory),
+				ircrypt_core.MESSAGES_PER_SENDER + 1)
+		self.assertFalse(('a', 0) in reassembler.memory)
+		self.assertEqual(reassembler.update(('a', 8), 0, 'YmFy', origin='a'),
+				b'barfoo')
+
+
+	def test_burst(self):
+		burst = ircrypt_core.Burst()
+		self.assertFalse(burst.active('s.#a', 1, now=0))
+		self.assertTrue(burst.active('s.#a', 1, now=0.5))
+		self.assertFalse(burst.active('s.#a', 1, now=2))
+		first, second, third = [ircrypt_core.BurstMessage('s', '#a', 'nick', x,
+			'pre ', 'key', '', x) for x in ('a', 'b', 'c')]
+		burst.add('s.#a', first)
+		burst.add('s.#a', second)
+		burst.add('s.#a', third, wait=False)
+		self.assertTrue(burst.active('s.#a', 1))
+		self.assertEqual(burst.messages, 3)
+		# Only as many messages as processes are started
+		self.assertIs(burst.next(1), first)
+		burst.running[first.digest] = first
+		self.assertEqual(burst.next(1), None)
+		# Messages are displayed in order
+		second.result = third.result = 'pre b'
+		self.assertEqual(burst.ready('s.#a'), [])
+		del burst.running[first.digest]
+		first.result = 'pre a'
+		self.assertEqual(burst.ready('s.#a'), [first, second, third])
+		self.assertFalse(burst.busy())
+		self.assertTrue(burst.passthrough('pre b'))
+		self.assertTrue(burst.passthrough('pre b'))
+		self.assertFalse(burst.passthrough('pre b'))
+
+
+	def test_streams(self):
+		streams = ircrypt_core.Streams()
+		stream = ircrypt_core.DecryptionStream(None, 'hook')
+		streams.start('a', stream, 'nick')
+		streams['a'] = stream
+		self.assertIs(streams.finish(stream.name, 0), stream)
+		self.assertEqual(stream.returncode, 0)
+		self.assertEqual(streams.finish(stream.name, 0), None)
+		# Streams waiting for parts are dropped once their process ended
+		self.assertFalse(streams)
+		# Only running processes have to be stopped
+		self.assertFalse(streams.stop(stream))
+		stream = ircrypt_core.DecryptionStream(None, 'hook')
+		streams.start('b', stream, 'nick')
+		self.assertTrue(streams.full('nick', 1, 2))
+		self.assertFalse(streams.full('other', 1, 2))
+		self.assertTrue(streams.full('other', 1, 1))
+		self.assertTrue(streams.stop(stream))
+		self.assertFalse(streams.running)
+
+
+	def test_hkdf(self):
+		# RFC 5869, test case 3
+		self.assertEqual(ircrypt_core.hkdf(b'\x0b' * 22, b'', 42),
+				binascii.unhexlify('8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879e'
+					'c3454e5f3c738d2d9d201395faa4b61a96c8'))
+
+
+	@unittest.skipIf(not ircrypt_core.gpg, 'gpg is not installed')
+	def test_gpgme(self):
+		import base64
+		message = base64.b64decode(self.encrypted['TWOFISH'])
+		self.assertEqual(ircrypt_core.gpgme(b'secret\n' + message,
+			'--passphrase-fd', '-', '-q', '-d'), (0, b'Hello World', b''))
+		self.assertEqual(ircrypt_core.gpgme(b'secret\n', '--symmetric'), None)
+
+
+	@unittest.skipIf(not ircrypt_core.AESGCM, 'cryptography is not installed')
+	def test_session(self):
+		import base64
+		sender = ircrypt_core.Session('key', 'server/#Test')
+		receiver = ircrypt_core.Session('key', 'server/#test')
+		first = base64.b64decode(sender.encrypt(u'f\xfcrst', 0))
+		second = base64.b64decode(sender.encrypt('second', 0))
+		self.assertEqual(receiver.decrypt(first, 0), u'f\xfcrst')
+		self.assertEqual(receiver.decrypt(second, 0), 'second')
+		# Replayed, from another channel or sender, modified or too old
+		self.assertRaises(ircrypt_core.ReplayError, receiver.decrypt, first, 0)
+		third = base64.b64decode(sender.encrypt('third', 0))
+		self.assertRaises(ValueError, receiver.decrypt, third, 0, 'other')
+		self.assertEqual(receiver.decrypt(third, 0), 'third')
+		other = ircrypt_core.Session('key', 'server/#other')
+		self.assertRaises(ValueError, other.decrypt, second, 0)
+		third = bytearray(base64.b64decode(sender.encrypt('third', 0)))
+		third[-1] ^= 1
+		self.assertRaises(ValueError, receiver.decrypt, third, 0)
+		fourth = base64.b64decode(sender.encrypt('fourth', 0))
+		self.assertRaises(ircrypt_core.EpochError, receiver.decrypt, fourth,
+				3 * ircrypt_core.REKEY_INTERVAL)
+		self.assertRaises(ValueError, receiver.decrypt,
+				base64.b64decode(sender.encrypt('fifth',
+					3 * ircrypt_core.REKEY_INTERVAL)), 0)
+		# Messages read from logs are neither too old nor replayed
+		self.assertEqual(receiver.decrypt(fourth, 3 * ircrypt_core.REKEY_INTERVAL,
+			live=False), 'fourth')
+		self.assertEqual(receiver.decrypt(first, live=False), u'f\xfcrst')
+
+
+	# 'Hello World' encrypted by GnuPG 2.2 with password 'secret' using every
+	# cipher offered for set-cipher
+	encrypted = {
+		'IDEA': 'jA0EAQMCxp1Eid6qCBv/0jgBw2T/xyQD9x0Ycps6DbG87GHmfZ43y1U6WE7HB/vpSoJA'
+			'znjGlcfwN+xBYMgf38lm8sMQozbH5w==',
+		'3DES': 'jA0EAgMCgqK/1n6ErCz/0jgBzqsMlRuCF96ob24tSXJbG7H2LYnRg8X3wQOEiCZ9klGH'
+			'rZHawRcOEgflU+LmYu5+m/rpzPojUg==',
+		'CAST5': 'jA0EAwMCfXC6Ypkljzb/0jgBXATbpWgqnM7+aDGhOduRPgB/v3frZhHSw+NDYek1AWK5'
+			'cMYevV6XapUYIPTWlutvk56SHIQ0cA==',
+		'BLOWFISH': 'jA0EBAMCp3lbTL3xzjX/0jgBpoF8/vJjC9KtWVvaRAL35YnYIFm98ZiUQhVep6m8FV'
+			'm7xbrUuPuFl3NPwt70I0hiSg3Yk7bvFQ==',
+		'AES': 'jA0EBwMCRvcW/w6hkcD/0kABsqU+IFbSka7X2Vnhos3inbbJXbzxKRLTrfv1s4TOd1ka8g'
+			'IxW811sdzfR3pm9Uf4qHMqNXXp4AA9t6MCadTw',
+		'AES192': 'jA0ECAMC9s8PUMDJIcD/0kABcCqjJY+8jgLTaIP369RczYzRbFwkk6iAeOOhRCbJNZI/'
+			'xS/YcZws7a6FWVHI3rw1ABrZz7wtpkWYVhqYwkRM',
+		'AES256': 'jA0ECQMCn6r/qwSWG/n/0kABoylQ33Imq1Ts9N07JHuKvJnqWCoNnSQjomdOEMBbrBRH'
+			'PC/ABz2xHv28vcVTftfczF0eFEiAj6jfzQ6aLokV',
+		'TWOFISH': 'jA0ECgMCMbBhJYyYerv/0kABaEFmL/w6k7FKYBtYvAEMFHIGjq1mdvyJqDL4/tcYSRx'
+			'fmdrnRe1Mhur8lXr8OuBPaF8PYGKXuNbthn/4Ggfw',
+		'CAMELLIA128': 'jA0ECwMCh/jtrZUDM37/0kABghSLY4GeI4fc1Eo9aG0BUosAalDoo+XzN4Javy1'
+			'WSjg1HO696r83XP77VP8eoI/6JSXG+clAN/DJXgB4Ihgm',
+		'CAMELLIA192': 'jA0EDAMCdcRxRoPw7a7/0kABfk1PzbbEIB/vtyit5R4yCnDA4Rfa7ip9CeKcE4I'
+			'vbzB49iIpSUk9RYDYwEGOFPSWDgYWY7wG7c3XXjMJxGJ4',
+		'CAMELLIA256': 'jA0EDQMCEdrHq58HP2r/0kABs5clKs6vApsiBebXfdMNDrDw5Tg2VUE7UtRiWDB'
+			'kk71klRLJzxBE1wIUkiYGirmlemqFC3qZglNbMWH+ukuz'}
+
+
+	def test_inspect(self):
+		import base64
+		for cipher, message in self.encrypted.items():
+			packet = ircrypt_core.inspect(base64.b64decode(message))
+			self.assertEqual(packet['cipher'], cipher)
+			self.assertEqual(packet['s2k'], 'iterated')
+			self.assertEqual(packet['hash'], 'SHA1')
+			self.assertEqual(packet['count'], 65011712)
+			self.assertEqual(packet['packet'], 'SEIPD')
+		# Encrypted data split into partial bodies
+		packet = ircrypt_core.inspect(b'\x8c\x04\x04\x09\x00\x08'
+				b'\xd2\xe1ab\xe0c\x02de')
+		self.assertEqual((packet['cipher'], packet['s2k'], packet['count']),
+				('AES256', 'simple', None))
+
+
+	def test_inspect_invalid(self):
+		import base64
+		message = base64.b64decode(self.encrypted['TWOFISH'])
+		for invalid in (b'', b'test', message[:10], message[:-1], message + b'x',
+				message[15:], b'\x8c\x04\x04\x09\x00\x08\xd2\xe1ab\xe0c'):
+			self.assertRaises(ValueError, ircrypt_core.inspect, invalid)
+		self.assertRaises(ValueError, ircrypt_core.inspect, message, 20)
+
+
+	def test_inspect_start(self):
+		import base64
+		message = base64.b64decode(self.encrypted['TWOFISH'])
+		# The beginning of a message is accepted if it is not complete
+		for length in (6, 10, 20, len(message) - 1):
+			ircrypt_core.inspect(message[:length], complete=False)
+		self.assertEqual(ircrypt_core.inspect(message[:30], complete=False)
+				['packet'], 'SEIPD')
+		for invalid in (b'', b'test', message[15:]):
+			self.assertRaises(ValueError, ircrypt_core.inspect, invalid,
+					complete=False)
+
+
+	def test_encrypt_decrypt(self):
+		binary = ircrypt_core.find_gpg_binary(('gpg', 'gpg2'))[0]
+		ret, out, err = ircrypt_core.encrypt(binary, 'key', 'test', 'AES')
+		self.assertFalse(ret)
+		ret, out, err = ircrypt_core.decrypt(binary, 'key', out)
+		self.assertFalse(ret)
+		self.assertEqual(out, 'test')
+
+
+	def test_command_line(self):
+		import subprocess
+		core = (os.path.dirname(__file__) or '.') + '/../ircrypt_core.py'
+		p = subprocess.Popen([sys.executable, core, 'encrypt', '-k', 'key'],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		encrypted = p.communicate(b'hello\nworld\n')[0]
+		self.assertEqual(encrypted.count(b'>CRY-0 '), 2)
+		p = subprocess.Popen([sys.executable, core, 'decrypt', '-k', 'key'],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.assertEqual(p.communicate(encrypted)[0], b'hello\nworld\n')
+
+
+	@unittest.skipIf(not ircrypt_core.AESGCM, 'cryptography is not installed')
+	def test_command_line_session(self):
+		import subprocess
+		core = (os.path.dirname(__file__) or '.') + '/../ircrypt_core.py'
+		sender = ircrypt_core.Session('key', 'server/#test')
+		encrypted = ''.join([':nick!u@h PRIVMSG #test :%s\n' % part for part in
+			ircrypt_core.frame(sender.encrypt('hello', 0, 'nick'), 'CRY2', 20)])
+		p = subprocess.Popen([sys.executable, core, 'decrypt', '-k', 'key', '-t',
+			'server/#Test'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		self.assertEqual(p.communicate(encrypted.encode('ascii'))[0],
+				b':nick!u@h PRIVMSG #test :hello\n')
+		# The channel is needed
+		p = subprocess.Popen([sys.executable, core, 'decrypt', '-k', 'key'],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+				stderr=subprocess.PIPE)
+		self.assertEqual(p.communicate(encrypted.encode('ascii'))[0], b'')
+		self.assertEqual(p.returncode, 1)
+
+
+class TestLogDecrypt(unittest.TestCase):
+
+	class Pool:
+		'''Pool running jobs immediately'''
+		class Result:
+			def __init__(self, value):
+				self.value = value
+			def ready(self):
+				return True
+			def get(self):
+				return self.value
+		def apply_async(self, func, args):
+			return self.Result(func(*args))
+
+
+	def test_weechat_log_target(self):
+		self.assertEqual(ircrypt_logdecrypt.weechat_log_target(
+			'/logs/irc.freenode.#IRCrypt.weechatlog'), ['freenode', '#IRCrypt'])
+		self.assertEqual(ircrypt_logdecrypt.weechat_log_target('znc.log'),
+				(None, None))
+
+
+	def test_parse_line(self):
+		parse = ircrypt_logdecrypt.parse_line
+		self.assertEqual(parse('2014-01-01 12:00:00\t@nick\t>CRY-1 abc'),
+				('2014-01-01 12:00:00\t@nick\t', 'nick', None, 1, None, None, 'abc'))
+		self.assertEqual(parse('[12:00:00] <nick> >CRY-0 abc'),
+				('[12:00:00] <nick> ', 'nick', None, 0, None, None, 'abc'))
+		self.assertEqual(parse(':nick!u@h PRIVMSG #test :>CRY-a1.0 abc'),
+				(':nick!u@h PRIVMSG #test :', 'nick', '#test', 0, None, 'a1', 'abc'))
+		self.assertEqual(parse('[12:00:00] <nick> hello'), None)
+
+
+	def test_process(self):
+		binary = ircrypt_core.find_gpg_binary(('gpg', 'gpg2'))[0]
+		lines = []
+		for i, nick in enumerate(['a', 'b', 'a']):
+			ret, out, err = ircrypt_core.encrypt(binary, 'key', 'msg %i' % i, 'AES')
+			for part in ircrypt_core.frame(out, length=40, forward=i == 1,
+					msgid='a%i' % i):
+				lines.append('[00:00:00] <%s> %s' % (nick, part))
+			lines.append('[00:00:00] <c> plain %i' % i)
+		decryptor = ircrypt_logdecrypt.LogDecryptor(binary,
+				{'server/#test': 'key'}, self.Pool(), 2)
+		self.assertEqual(list(decryptor.process(lines, 'server', '#test')), [
+			'[00:00:00] <a> msg 0', '[00:00:00] <c> plain 0',
+			'[00:00:00] <b> msg 1', '[00:00:00] <c> plain 1',
+			'[00:00:00] <a> msg 2', '[00:00:00] <c> plain 2'])
+
+
+	@unittest.skipIf(not ircrypt_core.AESGCM, 'cryptography is not installed')
+	def test_process_session(self):
+		sender = ircrypt_core.Session('key', 'server/#test')
+		lines = ['[00:00:00] <a> ' + part for part in
+				ircrypt_core.frame(sender.encrypt('msg', 0, 'a'), 'CRY2', 20)]
+		# Old and repeated messages are decrypted
+		decryptor = ircrypt_logdecrypt.LogDecryptor('gpg',
+				{'server/#test': 'key'}, self.Pool(), 2)
+		self.assertEqual(list(decryptor.process(lines * 2, 'server', '#test')),
+				['[00:00:00] <a> msg'] * 2)
+		self.assertEqual(decryptor.errors, 0)
+
+
+	def test_process_without_key(self):
+		# All parts of messages in channels without key are kept
+		lines = ['[00:00:00] <a> %s' % part
+				for part in ircrypt_core.frame('abcd' * 30, length=40)]
+		decryptor = ircrypt_logdecrypt.LogDecryptor('gpg',
+				{'server/#other': 'key'}, self.Pool(), 2)
+		self.assertEqual(list(decryptor.process(lines, 'server', '#test')), lines)
+		self.assertEqual(decryptor.errors, 0)
+		# Lines without nick and channel (e.g. ZNC logs with an empty nick)
+		lines = ['[00:00:00] <> >CRY-0 abcd']
+		self.assertEqual(list(decryptor.process(lines, 'server')), lines)
+
+
+class TestKeyExchange(unittest.TestCase):
+
+	# Global state of ircrypt-keyex modified by the tests
+	state = ('ircrypt_asym_id', 'ircrypt_asym_last_used', 'ircrypt_gpg_id',
+			'ircrypt_gpg_ready', 'ircrypt_bulk_timer', 'ircrypt_store')
+
+	def setUp(self):
+		self.saved = dict((name, getattr(ircrypt_keyex, name))
+				for name in self.state)
+		self.mocked = [(memory, dict(memory)) for memory in (ircrypt.weechat.config,
+			ircrypt.weechat.infos, ircrypt.weechat.timers,
+			ircrypt_keyex.ircrypt_config_option)]
+		ircrypt_keyex.ircrypt_asym_id = {}
+		ircrypt_keyex.ircrypt_asym_last_used = {}
+		ircrypt_keyex.ircrypt_config_option['prune_after'] = \
+				'ircrypt-keyex.general.prune_after'
+		del ircrypt.weechat.commands[:]
+		del ircrypt.weechat.printed[:]
+
+
+	def tearDown(self):
+		if ircrypt_keyex.ircrypt_store is not self.saved['ircrypt_store']:
+			ircrypt_keyex.ircrypt_store.close()
+		for name, value in self.saved.items():
+			setattr(ircrypt_keyex, name, value)
+		for memory, saved in self.mocked:
+			memory.clear()
+			memory.update(saved)
+		for memory in (ircrypt_keyex.ircrypt_key_ex_memory,
+				ircrypt_keyex.ircrypt_pub_keys_memory,
+				ircrypt_keyex.ircrypt_sym_key_memory):
+			memory.clear()
+		del ircrypt_keyex.ircrypt_bulk_key_ex[:]
+		del ircrypt_keyex.ircrypt_pending[:]
+
+
+	def test_update(self):
+		key_ex = ircrypt_keyex.KeyExchange(False, False)
+		key_ex.update(b'\x0f\xf0\x00\xaa')
+		self.assertEqual(key_ex.sym_key, bytearray(b'\x0f\xf0\x00\xaa'))
+		key_ex.update(b'\xff\xff\x01\xaa')
+		self.assertEqual(key_ex.sym_key, bytearray(b'\xf0\x0f\x01\x00'))
+		self.assertEqual(key_ex.parts, 2)
+
+
+	def test_update_leading_zeros(self):
+		keypart = os.urandom(64)
+		key_ex = ircrypt_keyex.KeyExchange(False, False)
+		key_ex.update(keypart)
+		key_ex.update(keypart)
+		self.assertEqual(key_ex.sym_key, bytearray(64))
+
+
+	def test_update_random(self):
+		a, b = os.urandom(64), os.urandom(64)
+		key_ex = ircrypt_keyex.KeyExchange(False, False)
+		key_ex.update(a)
+		key_ex.update(b)
+		expected = bytearray(x ^ y for x, y in zip(bytearray(a), bytearray(b)))
+		self.assertEqual(key_ex.sym_key, expected)
+
+
+	def test_key(self):
+		import base64
+		key_ex = ircrypt_keyex.KeyExchange(False, False)
+		key_ex.update(b'test')
+		self.assertEqual(key_ex.key(), base64.b64encode(b'test').decode('ascii'))
+
+
+	def test_wipe(self):
+		key_ex = ircrypt_keyex.KeyExchange(False, False)
+		key_ex.update(b'test')
+		sym_key = key_ex.sym_key
+		key_ex.wipe()
+		self.assertEqual(sym_key, bytearray(4))
+
+
+	def test_asym_id_read(self):
+		ircrypt_keyex.ircrypt_config_asym_id_read_cb('', '', '', 'Server/Nick',
+				'ABCDEF 1000')
+		self.assertEqual(ircrypt_keyex.ircrypt_asym_id['server/nick'], 'ABCDEF')
+		self.assertEqual(ircrypt_keyex.ircrypt_asym_last_used['server/nick'], 1000)
+		ircrypt_keyex.ircrypt_config_asym_id_read_cb('', '', '', 'server/old',
+				'ABCDEF')
+		self.assertEqual(ircrypt_keyex.ircrypt_asym_id['server/old'], 'ABCDEF')
+		self.assertTrue(ircrypt_keyex.ircrypt_asym_last_used['server/old'] > 1000)
+
+
+	def test_prune_shared_fingerprint(self):
+		import time
+		ircrypt_keyex.ircrypt_asym_id['server/a'] = 'ABCDEF'
+		ircrypt_keyex.ircrypt_asym_id['server/b'] = 'ABCDEF'
+		ircrypt_keyex.ircrypt_asym_last_used['server/a'] = 0
+		ircrypt_keyex.ircrypt_asym_last_used['server/b'] = int(time.time())
+		# The fingerprint is still used by server/b, so GnuPG is not called
+		self.assertEqual(ircrypt_keyex.ircrypt_prune(30), 1)
+		self.assertEqual(list(ircrypt_keyex.ircrypt_asym_id), ['server/b'])
+		self.assertEqual(ircrypt_keyex.ircrypt_prune(30), 0)
+
+
+	@unittest.skipIf(not ircrypt_core.sqlite3, 'sqlite3 is not installed')
+	def test_store(self):
+		import tempfile, shutil
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		ircrypt_keyex.ircrypt_asym_id = {'server/a' : 'ABCDEF'}
+		ircrypt_keyex.ircrypt_asym_last_used = {'server/a' : 42}
+		ircrypt.weechat.config['ircrypt.general.store'] = directory + '/ircrypt.db'
+		ircrypt_keyex.ircrypt_store_open()
+		ircrypt_keyex.ircrypt_asym_id_touch('server/a')
+		ircrypt_keyex.ircrypt_asym_id = {}
+		ircrypt_keyex.ircrypt_asym_last_used = {}
+		ircrypt_keyex.ircrypt_store_open()
+		self.assertEqual(ircrypt_keyex.ircrypt_asym_id, {'server/a' : 'ABCDEF'})
+		self.assertTrue(ircrypt_keyex.ircrypt_asym_last_used['server/a'] > 42)
+
+
+	def test_info_memory(self):
+		ircrypt_keyex.ircrypt_sym_key_memory['server/nick'] = ircrypt.MessageParts()
+		ircrypt_keyex.ircrypt_sym_key_memory['server/nick'].update(1, 'abc')
+		lines = ircrypt_keyex.ircrypt_info_memory_cb('', '', '').split('\n')
+		self.assertEqual(len(lines), 3)
+		self.assertTrue(lines[2].startswith('Symmetric key parts'))
+		self.assertTrue(lines[2].endswith('largest: server/nick 3'))
+
+
+	def setup_bulk(self):
+		ircrypt_keyex.ircrypt_gpg_id = 'ABCDEF'
+		ircrypt_keyex.ircrypt_config_option.update({
+			'max_concurrent' : 'ircrypt-keyex.bulk.max_concurrent',
+			'interval'       : 'ircrypt-keyex.bulk.interval',
+			'timeout'        : 'ircrypt-keyex.general.timeout',
+			})
+		ircrypt.weechat.config.update({
+			'ircrypt-keyex.bulk.max_concurrent' : 2,
+			'ircrypt-keyex.bulk.interval'       : 3,
+			'ircrypt-keyex.general.timeout'     : 300,
+			})
+
+
+	def test_bulk(self):
+		self.setup_bulk()
+		ircrypt.weechat.infos['irc_nick'] = 'Me'
+		# Duplicates and the own nick are removed
+		self.assertEqual(ircrypt_keyex.ircrypt_bulk_start('server',
+			['a', 'B', 'b', 'me', 'c', 'd'], 'buffer'), 'OK')
+		bulk, = ircrypt_keyex.ircrypt_bulk_key_ex
+		self.assertEqual(bulk.pending, ['a', 'B', 'c', 'd'])
+		self.assertEqual(ircrypt.weechat.timers['ircrypt_bulk_timer_cb'], 3000)
+		# At most max_concurrent key exchanges run at the same time
+		for i in range(3):
+			ircrypt_keyex.ircrypt_bulk_timer_cb('', 0)
+		self.assertEqual(sorted(bulk.active), ['server/a', 'server/b'])
+		self.assertEqual(len(ircrypt.weechat.commands), 2)
+		self.assertTrue(ircrypt.weechat.commands[0].startswith(
+			'/mute -all notice -server server a >KEY-EX-PING'))
+		ircrypt_keyex.ircrypt_key_ex_finish('server/a', True)
+		ircrypt_keyex.ircrypt_bulk_timer_cb('', 0)
+		self.assertEqual(sorted(bulk.active), ['server/b', 'server/c'])
+		# Stalled key exchanges are aborted by the reaper
+		ircrypt_keyex.ircrypt_key_ex_memory['server/b'].modified = 0
+		ircrypt_keyex.ircrypt_key_ex_reaper_cb('', 0)
+		self.assertEqual(bulk.failed, ['B'])
+		ircrypt_keyex.ircrypt_bulk_timer_cb('', 0)
+		ircrypt_keyex.ircrypt_key_ex_finish('server/c', True)
+		ircrypt_keyex.ircrypt_key_ex_abort('server/d')
+		# A summary is printed once all key exchanges are finished
+		ircrypt_keyex.ircrypt_bulk_timer_cb('', 0)
+		self.assertFalse(ircrypt_keyex.ircrypt_bulk_key_ex)
+		self.assertFalse(ircrypt.weechat.timers)
+		self.assertTrue(ircrypt.weechat.printed[-1].startswith(
+			'Key exchange on server server finished after'))
+		self.assertTrue(ircrypt.weechat.printed[-1].endswith(
+			'2 succeeded, 2 failed\nFailed: B d'))
+
+
+	def test_bulk_no_nicks(self):
+		self.setup_bulk()
+		self.assertEqual(ircrypt_keyex.ircrypt_bulk_start('server', [],
+			'buffer'), 'ERROR')
+		self.assertFalse(ircrypt_keyex.ircrypt_bulk_key_ex)
+		ircrypt_keyex.ircrypt_gpg_id = None
+		self.assertEqual(ircrypt_keyex.ircrypt_bulk_start('server', ['a'],
+			'buffer'), 'ERROR')
+
+
+	def test_key_ex_target(self):
+		self.assertEqual(ircrypt_keyex.ircrypt_key_ex_target('FreeNode', 'Nick'),
+				'freenode/nick')
+
+
+	def test_key_ex_reaper(self):
+		ircrypt_keyex.ircrypt_config_option['timeout'] = \
+				'ircrypt-keyex.general.timeout'
+		ircrypt.weechat.config['ircrypt-keyex.general.timeout'] = 300
+		for target in ('server/old', 'server/new'):
+			key_ex = ircrypt_keyex.KeyExchange(False, False)
+			key_ex.update(b'secret')
+			ircrypt_keyex.ircrypt_key_ex_memory[target] = key_ex
+			for memory in (ircrypt_keyex.ircrypt_pub_keys_memory,
+					ircrypt_keyex.ircrypt_sym_key_memory):
+				memory[target] = ircrypt.MessageParts()
+				memory[target].update(1, 'part')
+		old = ircrypt_keyex.ircrypt_key_ex_memory['server/old']
+		sym_key = old.sym_key
+		old.modified -= 301
+		# Orphaned message parts are removed as well
+		ircrypt_keyex.ircrypt_pub_keys_memory['server/orphan'] = \
+				ircrypt.MessageParts()
+		ircrypt_keyex.ircrypt_key_ex_reaper_cb('', 0)
+		self.assertEqual(sym_key, bytearray(6))
+		for memory in (ircrypt_keyex.ircrypt_key_ex_memory,
+				ircrypt_keyex.ircrypt_pub_keys_memory,
+				ircrypt_keyex.ircrypt_sym_key_memory):
+			self.assertEqual(list(memory), ['server/new'])
+
+
+	def test_queue_until_ready(self):
+		ircrypt_keyex.ircrypt_gpg_ready = False
+		notice = ':nick!~user@example.com NOTICE me :>KEY-EX-PING'
+		self.assertEqual(ircrypt_keyex.ircrypt_notice_hook('', '', 'server',
+			notice), '')
+		self.assertFalse(ircrypt_keyex.weechat.commands)
+		ircrypt_keyex.ircrypt_gpg_init_done()
+		self.assertTrue(ircrypt_keyex.ircrypt_gpg_ready)
+		self.assertEqual(ircrypt_keyex.weechat.commands,
+				['/server fakerecv ' + notice])
+
+
+	def test_prune_when_ready(self):
+		import time
+		ircrypt.weechat.config['ircrypt-keyex.general.prune_after'] = 30
+		ircrypt_keyex.ircrypt_asym_id['server/a'] = 'ABCDEF'
+		ircrypt_keyex.ircrypt_asym_id['server/b'] = 'ABCDEF'
+		ircrypt_keyex.ircrypt_asym_last_used['server/a'] = 0
+		ircrypt_keyex.ircrypt_asym_last_used['server/b'] = int(time.time())
+		# Unused public keys are removed once GnuPG is initialized
+		ircrypt_keyex.ircrypt_gpg_ready = False
+		ircrypt_keyex.ircrypt_gpg_init_done()
+		self.assertEqual(list(ircrypt_keyex.ircrypt_asym_id), ['server/b'])
+
+
+class TestLoadTest(unittest.TestCase):
+
+	def test_relay(self):
+		import tempfile, shutil
+		loadtest = load_source('loadtest', 'tests/loadtest.py')
+		home = tempfile.mkdtemp()
+		relay = loadtest.Relay()
+		clients = [loadtest.Client(relay, nick, home) for nick in ('a', 'b')]
+		received = []
+		for client in clients:
+			relay.join(client, '#test')
+			client.load('ircrypt.py')
+			client.command('', '/ircrypt set-key -server sim #test secret')
+			client.display = lambda client, line: received.append((client.nick,
+				line))
+		loadtest.run(relay, clients, lambda: all(c.scripts['ircrypt'].ircrypt_ready
+			for c in clients), 60)
+		# The tests above use the simple mock
+		self.assertIs(sys.modules['weechat'], ircrypt.weechat)
+		clients[0].send('PRIVMSG', '#test', 'Hello World')
+		self.assertIn('>CRY-0 ', relay.queue[0][1])
+		loadtest.run(relay, clients, lambda: received, 60)
+		self.assertEqual(received,
+				[('b', ':a!a@sim PRIVMSG #test :Hello World')])
+		shutil.rmtree(home)
+
+
+class TestPerfCheck(unittest.TestCase):
+
+	def test_compare(self):
+		perfcheck = load_source('perfcheck', 'tests/perfcheck.py')
+		base = {'median': 1.0, 'mad': 0.01}
+		self.assertFalse(perfcheck.compare({'median': 1.2, 'mad': 0.01}, base, 0.25))
+		self.assertTrue(perfcheck.compare({'median': 1.3, 'mad': 0.01}, base, 0.25))
+		# Too noisy to tell
+		self.assertFalse(perfcheck.compare({'median': 1.3, 'mad': 0.2}, base, 0.25))
+		self.assertEqual(perfcheck.median([3, 1, 2, 4]), 2.5)
+
+
 if __name__ == '__main__':
 	unittest.main()
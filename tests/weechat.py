@@ -1,10 +1,24 @@
 '''
-Some mock functions to use for testing weechat plug-ins
+Some mock functions to use for testing weechat plug-ins and a mock of the
+WeeChat API for the simulated clients of the load test
 '''
+import time, subprocess
 
 config = {}
+config_lines = []
+commands = []
+signals = []
+processes = {}
+timers = {}
+printed = []
 
 WEECHAT_RC_OK = 'OK'
+WEECHAT_RC_ERROR = 'ERROR'
+WEECHAT_CONFIG_OPTION_SET_OK_CHANGED = 'OK_CHANGED'
+WEECHAT_CONFIG_OPTION_SET_ERROR = 'SET_ERROR'
+WEECHAT_HOOK_PROCESS_RUNNING = -1
+WEECHAT_HOOK_PROCESS_ERROR = -2
+WEECHAT_HOOK_SIGNAL_STRING = 'string'
 
 def color(*args, **kwargs):
 	return ''
@@ -12,14 +26,28 @@ def color(*args, **kwargs):
 def config_string(key):
 	return config.get(key)
 
+def config_integer(key):
+	return int(config.get(key) or 0)
+
+def config_boolean(key):
+	return config.get(key) in (True, 'on')
+
 
 def prnt(_, arg):
-	#print(arg)
-	return
+	printed.append(arg)
 
 def config_option_set(key, val, _):
 	config[key] = val
 
+def config_write(config_file):
+	return WEECHAT_RC_OK
+
+def config_write_line(config_file, option, value):
+	config_lines.append((option, value))
+
+def string_eval_expression(expr, pointers, extra_vars, options):
+	return expr
+
 def info_get_hashtable(*args):
 	return {'channel':'#test', 'nick':'testnick'}
 
@@ -34,3 +62,317 @@ def prefix(*args):
 
 def current_buffer():
 	return ''
+
+def register(*args):
+	return False
+
+def command(buffer, cmd):
+	commands.append(cmd)
+
+def hook_process_hashtable(command, options, timeout, callback, data):
+	processes[data] = ''
+	return data
+
+def hook_set(hook, prop, value):
+	if prop == 'stdin':
+		processes[hook] += value
+
+def hook_timer(interval, align_second, max_calls, callback, data):
+	timers[callback] = interval
+	return callback
+
+def unhook(hook):
+	if hook in timers:
+		del timers[hook]
+	else:
+		del processes[hook]
+
+infos = {}
+
+def info_get(name, arguments):
+	return infos.get(name, '')
+
+def hook_signal_send(signal, type_data, signal_data):
+	signals.append((signal, signal_data))
+
+
+# Simulated clients
+
+def parse_message(message):
+	'''Parse an IRC message like WeeChat's irc_message_parse.
+	'''
+	prefix = ''
+	if message.startswith(':'):
+		prefix, message = (message[1:].split(' ', 1) + [''])[:2]
+	command, arguments = (message.split(' ', 1) + [''])[:2]
+	channel, text = (arguments.split(' :', 1) + [''])[:2]
+	return {
+		'nick': prefix.split('!', 1)[0],
+		'host': prefix,
+		'command': command,
+		'channel': channel,
+		'arguments': arguments,
+		'text': text}
+
+
+class Hook:
+	'''Callback registered by a script.
+	'''
+
+	def __init__(self, api, kind, name, callback, data):
+		self.api      = api
+		self.kind     = kind
+		self.name     = name
+		self.callback = callback
+		self.data     = data
+
+	def __call__(self, *args):
+		return self.api.namespace[self.callback](self.data, *args)
+
+
+class Process:
+	'''Process started by hook_process_hashtable.
+	'''
+
+	def __init__(self, command, options, timeout):
+		args = [command]
+		while 'arg%i' % len(args) in options:
+			args.append(options['arg%i' % len(args)])
+		self.command = command
+		self.popen   = subprocess.Popen(args, stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		self.timeout = time.time() + timeout / 1000.0 if timeout else None
+
+	def write(self, data):
+		self.popen.stdin.write(data.encode('utf-8'))
+		self.popen.stdin.flush()
+
+	def close(self):
+		self.popen.stdin.close()
+
+	def finished(self):
+		if self.timeout and time.time() > self.timeout:
+			self.popen.kill()
+		return self.popen.poll() is not None
+
+	def result(self):
+		if not self.popen.stdin.closed:
+			self.popen.stdin.close()
+		self.popen.stdin = None
+		out, err = self.popen.communicate()
+		return (self.popen.returncode, out.decode('utf-8', 'replace'),
+				err.decode('utf-8', 'replace'))
+
+
+class Timer:
+	'''Timer started by hook_timer.
+	'''
+
+	def __init__(self, interval, maxcalls):
+		self.interval = interval / 1000.0
+		self.next     = time.time() + self.interval
+		self.calls    = maxcalls
+
+
+class Option:
+	'''Configuration option created by config_new_option.
+	'''
+
+	def __init__(self, api, values, value, change_cb, change_data):
+		self.api         = api
+		self.values      = values.split('|') if values else []
+		self.value       = value
+		self.change_cb   = change_cb
+		self.change_data = change_data
+
+
+class WeeChat:
+	'''Mock of the WeeChat API for one script of a simulated client (see
+	tests/loadtest.py). Like in WeeChat, callbacks are given by name and are
+	looked up in the namespace of the script when they are called. The client
+	provides the configuration, the hooks and the connection to the other
+	clients.
+	'''
+
+	WEECHAT_RC_OK                        = 0
+	WEECHAT_RC_ERROR                     = -1
+	WEECHAT_CONFIG_READ_OK               = 0
+	WEECHAT_CONFIG_OPTION_SET_OK_CHANGED = 2
+	WEECHAT_CONFIG_OPTION_SET_ERROR      = -1
+	WEECHAT_HOOK_PROCESS_RUNNING         = -1
+	WEECHAT_HOOK_PROCESS_ERROR           = -2
+	WEECHAT_HOOK_SIGNAL_STRING           = 'string'
+
+	def __init__(self, client):
+		self.client    = client
+		self.namespace = {}
+
+	def register(self, *args):
+		return True
+
+	def color(self, name):
+		return ''
+
+	def prefix(self, name):
+		return ''
+
+	def prnt(self, buffer, message):
+		self.client.output.append(message)
+
+	def command(self, buffer, command):
+		self.client.command(buffer, command)
+
+	def current_buffer(self):
+		return ''
+
+	def buffer_search(self, plugin, name):
+		return name
+
+	def buffer_get_string(self, buffer, name):
+		server, channel = (buffer.split('.', 1) + [''])[:2]
+		return {'localvar_server': server, 'localvar_channel': channel}.get(name, '')
+
+	def string_eval_expression(self, expression, *args):
+		return expression
+
+	def info_get(self, name, arguments):
+		if name == 'weechat_dir':
+			return self.client.home
+		if name == 'irc_nick':
+			return self.client.nick
+		for hook in self.client.find('info', name):
+			return hook(name, arguments)
+		return ''
+
+	def info_get_hashtable(self, name, hashtable):
+		return parse_message(hashtable['message'])
+
+	def infolist_get(self, name, pointer, arguments):
+		if name == 'python_script':
+			return [-1, [{'filename': script.__file__} for script_name, script
+				in self.client.scripts.items() if script_name == arguments]]
+		if name == 'irc_nick':
+			server, channel = arguments.split(',', 1)
+			return [-1, [{'name': client.nick}
+				for client in self.client.relay.members(channel)]]
+		return [-1, []]
+
+	def infolist_next(self, infolist):
+		infolist[0] += 1
+		return infolist[0] < len(infolist[1])
+
+	def infolist_string(self, infolist, name):
+		return infolist[1][infolist[0]].get(name, '')
+
+	def infolist_free(self, infolist):
+		pass
+
+	# Configuration
+
+	def config_new(self, name, callback, data):
+		return name
+
+	def config_new_section(self, config_file, name, *args):
+		return '%s.%s' % (config_file, name)
+
+	def config_new_option(self, config_file, section, name, option_type,
+			description, values, minimum, maximum, default, value, null_allowed,
+			check_cb, check_data, change_cb, change_data, *args):
+		option = '%s.%s' % (section, name)
+		if option_type != 'integer':
+			values = ''
+		self.client.options[option] = Option(self, values, value, change_cb,
+				change_data)
+		return option
+
+	def config_get(self, name):
+		return name
+
+	def config_string(self, option):
+		option = self.client.options.get(option)
+		return option.value if option else ''
+
+	def config_integer(self, option):
+		option = self.client.options.get(option)
+		if not option:
+			return 0
+		if option.values:
+			return option.values.index(option.value)
+		return int(option.value)
+
+	def config_boolean(self, option):
+		return self.config_string(option) == 'on'
+
+	def config_option_set(self, name, value, run_callback):
+		option = self.client.options[name]
+		option.value = value
+		if run_callback and option.change_cb:
+			option.api.namespace[option.change_cb](option.change_data, name)
+		for hook in self.client.find('config', name):
+			hook(name, value)
+		return self.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
+
+	def config_read(self, config_file):
+		return self.WEECHAT_CONFIG_READ_OK
+
+	def config_reload(self, config_file):
+		return self.WEECHAT_CONFIG_READ_OK
+
+	def config_write(self, config_file):
+		return self.WEECHAT_RC_OK
+
+	def config_write_line(self, config_file, name, value):
+		pass
+
+	def config_free(self, config_file):
+		pass
+
+	# Hooks
+
+	def hook_modifier(self, name, callback, data):
+		return self.client.hook(Hook(self, 'modifier', name, callback, data))
+
+	def hook_command(self, name, description, args, args_description,
+			completion, callback, data):
+		return self.client.hook(Hook(self, 'command', name, callback, data))
+
+	def hook_config(self, name, callback, data):
+		return self.client.hook(Hook(self, 'config', name, callback, data))
+
+	def hook_signal(self, name, callback, data):
+		return self.client.hook(Hook(self, 'signal', name, callback, data))
+
+	def hook_info(self, name, description, args_description, callback, data):
+		return self.client.hook(Hook(self, 'info', name, callback, data))
+
+	def hook_timer(self, interval, align, maxcalls, callback, data):
+		hook = Hook(self, 'timer', Timer(interval, maxcalls), callback, data)
+		return self.client.hook(hook)
+
+	def hook_process_hashtable(self, command, options, timeout, callback, data):
+		try:
+			process = Process(command, options, timeout)
+		except OSError:
+			return ''
+		return self.client.hook(Hook(self, 'process', process, callback, data))
+
+	def hook_set(self, hook, name, value):
+		process = self.client.hooks[hook].name
+		if name == 'stdin':
+			process.write(value)
+		elif name == 'stdin_close':
+			process.close()
+
+	def unhook(self, hook):
+		hook = self.client.hooks.pop(hook, None)
+		if hook and hook.kind == 'process' and not hook.name.finished():
+			hook.name.popen.kill()
+			hook.name.result()
+
+	def hook_signal_send(self, name, signal_type, data):
+		for hook in self.client.find('signal', name):
+			hook(name, data)
+		return self.WEECHAT_RC_OK
+
+	def bar_item_new(self, name, callback, data):
+		return name